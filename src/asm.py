@@ -1,15 +1,23 @@
 import argparse
 import sys
 import os
+import re
 
-from typing import Any
 from rich.console import Console
 from enum import Enum
+from array import array
 from emu import ins_codes
+from emu import image
+from emu import srcmap
+from emu.memory import CELL_TYPE
+
+import objfile
 
 
 version_string = "v0.0.1"
 
+CACHE_DIR = ".spk8cache" # Assembled objects, by the hash of their source
+
 
 # Define the instructions and their corresponding opcodes
 INSTRUCTIONS = {
@@ -19,8 +27,8 @@ INSTRUCTIONS = {
     "mov": {"opcode": 0x03, "args": 3},
     "jne": {"opcode": 0x04, "args": 2},
     "je": {"opcode": 0x05, "args": 2},
-    "jnz": {"opcode": 0x06, "args": 2},
-    "jz": {"opcode": 0x07, "args": 2},
+    "jnz": {"opcode": 0x06, "args": 1},
+    "jz": {"opcode": 0x07, "args": 1},
     "add": {"opcode": 0x08, "args": 2},
     "sub": {"opcode": 0x09, "args": 2},
     "mul": {"opcode": 0x0A, "args": 2},
@@ -34,33 +42,61 @@ INSTRUCTIONS = {
     "nor": {"opcode": 0x12, "args": 2},
     "inc": {"opcode": 0x13, "args": 1},
     "dec": {"opcode": 0x14, "args": 1},
-    "uld": {"opcode": 0x15, "args": 0}
+    "uld": {"opcode": 0x15, "args": 0},
+    "jnew": {"opcode": 0x16, "args": 2, "word": True},
+    "jew": {"opcode": 0x17, "args": 2, "word": True},
+    "jnzw": {"opcode": 0x18, "args": 1, "word": True},
+    "jzw": {"opcode": 0x19, "args": 1, "word": True},
+    "jmpw": {"opcode": 0x1A, "args": 1, "word": True}
 }
 
-# Define the data and text headers and their corresponding characters
+# Define the jumps that have a word form, for targets past the first 256 cells. Instructions
+# with "word" take their last argument as a word (hi, lo)
+WORD_JUMPS = {
+    "jne": "jnew",
+    "je": "jew",
+    "jnz": "jnzw",
+    "jz": "jzw",
+    "jmp": "jmpw"
+}
+
+# Define the headers and their corresponding cells
 HEADERS = {
-    "data": chr(0x10FFFF),
-    "text": chr(0x10FFFD)
+    "data": ins_codes.HEADER_DATA,
+    "rom": ins_codes.HEADER_ROM,
+    "text": ins_codes.HEADER_TEXT
 }
 
-# Define the label dictionary to store label addresses
+# Define the image section kind each header starts
+SECTIONS = {
+    "data": image.SECTION_DATA,
+    "rom": image.SECTION_ROM,
+    "text": image.SECTION_TEXT
+}
+
+# Define the assembler directives, which start with a dot like headers
+DIRECTIVES = {
+    "include" # .include "path", relative to the including file
+}
+
+# Define the label dictionary to store label addresses, filled for each object assembled
 LABELS = {}
 
 # Define the register table used for parsing later
 REGISTERS = {
-    "eax": chr(0x10FF8),
-    "ebx": chr(0x10FF9),
-    "ecx": chr(0x10FFA),
-    "edx": chr(0x10FFB),
-    "ax": chr(0x10FC),
-    "bx": chr(0x10FD),
-    "cx": chr(0x10FE),
-    "dx": chr(0x10FF),
-    "bax": chr(0x11000),
-    "bbx": chr(0x11001),
-    "bcx": chr(0x11002),
-    "bdx": chr(0x11003),
-    "rs": chr(0x11004)
+    "eax": ins_codes.Code_EAX,
+    "ebx": ins_codes.Code_EBX,
+    "ecx": ins_codes.Code_ECX,
+    "edx": ins_codes.Code_EDX,
+    "ax": ins_codes.Code_AX,
+    "bx": ins_codes.Code_BX,
+    "cx": ins_codes.Code_CX,
+    "dx": ins_codes.Code_DX,
+    "bax": ins_codes.Code_BAX,
+    "bbx": ins_codes.Code_BBX,
+    "bcx": ins_codes.Code_BCX,
+    "bdx": ins_codes.Code_BDX,
+    "rs": ins_codes.Code_RS
 }
 
 console = Console()
@@ -74,201 +110,426 @@ class TokenType(Enum):
     Label = 5
     Register = 6
     Comment = 7
+    Identifier = 8 # A label used as an argument
+    Directive = 9
+
+
+class Token:
+    """A token and where it starts in the source, both counted from 1.
+    """
+    __slots__ = ("type", "value", "line", "column")
+
+    def __init__(self, type: TokenType, value, line: int, column: int):
+        self.type = type
+        self.value = value
+        self.line = line
+        self.column = column
+
+    def __repr__(self):
+        return f"Token({self.type.name}, {self.value!r}, {self.line}:{self.column})"
+
+
+# Define the lexer. Each match skips the whitespace and commas before one token, and
+# `lastgroup` names the kind of token it found
+TOKEN_REGEX = re.compile(r"""
+    [ \t\r\n,]*
+    (?:
+        (?P<word>[A-Za-z_][A-Za-z0-9_]*:?)      # Instructions, registers and labels
+      | (?P<number>[0-9][0-9A-Za-z_]*)          # Decimal, hex, octal or binary
+      | (?P<string>"[^"]*"?|'[^']*'?)           # No escapes, the parser expands \n
+      | (?P<comment>\*[^\n]*)                   # Runs to the end of the line
+      | (?P<header>\.[A-Za-z_]*)
+      | (?P<error>.)
+      | (?P<end>$)                               # Blanks at the end of the buffer
+    )
+""", re.VERBOSE)
+
+
+# Group the tokens into statements, the first pass. Each statement is a list:
+#   ["header", token, name]
+#   ["label", token, name]
+#   ["string", token, cells]
+#   ["ins", token, name, argument tokens]
+#   ["include", token, path]
+def collect_statements(tokens: list[Token]):
+    statements = []
+    append = statements.append
+    seen = set() # Label names
+
+    # Enum members are slow to look up, and this runs for every token
+    instruction, label, header, comment, directive, string = (
+        TokenType.Instruction, TokenType.Label, TokenType.Header, TokenType.Comment, TokenType.Directive, TokenType.String
+    )
+    argument_types = (TokenType.Number, TokenType.Register, TokenType.Identifier)
 
+    count = len(tokens)
+    pos = 0
 
-def parse_tokens(tokens: list[dict[str, Any]], output_file: str):
-    # Handle errors
-    assert type(tokens) == list, "Type of `tokens` is not list"
-    assert type(output_file) == str, "Type of `output_file` is not str"
-
-    if os.path.isfile(output_file):
-        file = open(output_file, "w", encoding="utf-16")
-    else:
-        file = open(output_file, "a", encoding="utf-16")
+    while pos < count:
+        tok = tokens[pos]
+        kind = tok.type
 
-    output_buffer = ""
+        if kind is instruction:
+            args = tokens[pos + 1:pos + 1 + INSTRUCTIONS[tok.value]["args"]]
+            if len(args) < INSTRUCTIONS[tok.value]["args"]:
+                return None, f"Invalid number of arguments for {tok.value} instruction at line {tok.line}, column {tok.column}"
 
-    pos = 0
+            for arg in args:
+                if arg.type not in argument_types:
+                    return None, f"Invalid argument \"{arg.value}\" for {tok.value} instruction at line {arg.line}, column {arg.column}"
 
-    while pos < len(tokens):
-        tok = tokens[pos]
+            append(["ins", tok, tok.value, args])
+            pos += len(args)
+        elif kind is label:
+            name = tok.value[:-1]
 
-        if tok["type"] == TokenType.Header:
-            output_buffer += HEADERS[tok["value"]]
-        elif tok["type"] == TokenType.Comment:
-            pos += 1
-            continue
-        elif tok["type"] == TokenType.Label:
-            pos += 1
+            if name in INSTRUCTIONS or name.lower() in REGISTERS:
+                return None, f"Label \"{name}\" is a reserved word at line {tok.line}, column {tok.column}"
+            if name in seen:
+                return None, f"Label \"{name}\" is defined twice at line {tok.line}, column {tok.column}"
 
-            if tokens[pos]["type"] == TokenType.String:
-                string = tokens[pos]["value"].replace("\\n", "\n")
+            seen.add(name)
+            append(["label", tok, name])
 
-                for char in string:
-                    output_buffer += char
-            else:
-                return f"Cannot have label with specified type at token \"{tokens[pos]['value']}\""
-        elif tok["type"] == TokenType.Instruction:
-            try:
-                test = INSTRUCTIONS[tok["value"]]
-            except KeyError:
-                return f"Invalid instruction \"{tok['value']}\""
-
-            if tok["value"] == INSTRUCTIONS["nop"]:
-                continue # Nop instruction, reduce file size by ignoring them
-            
-            output_buffer += chr(INSTRUCTIONS[tok["value"]]["opcode"])
-            
-            for i in range(INSTRUCTIONS[tok["value"]]["args"]):
+            # A label followed by a string labels the string's cells
+            if pos + 1 < count and tokens[pos + 1].type is string:
                 pos += 1
-                if pos >= len(tokens):
-                    return f"Invalid number of arguments for {tok['value']} instruction"
-
-                if tokens[pos]["type"] == TokenType.Number:
-                    output_buffer += chr(tokens[pos]["value"])
-                elif tokens[pos]["type"] == TokenType.Register:
-                    if REGISTERS.get(tokens[pos]["value"]):
-                        output_buffer += REGISTERS[tokens[pos]["value"]]
+                value = tokens[pos].value.replace("\\n", "\n")
+                append(["string", tokens[pos], array(CELL_TYPE, map(ord, value))])
+        elif kind is header:
+            append(["header", tok, tok.value])
+        elif kind is comment:
+            pass
+        elif kind is directive: # .include "path"
+            pos += 1
+            if pos >= count or tokens[pos].type is not string:
+                return None, f"Expected a path after .{tok.value} at line {tok.line}, column {tok.column}"
+
+            append(["include", tok, tokens[pos].value])
         else:
-            return f"Expected instruction, header, or label at token \"{tokens[pos]['value']}\""
+            return None, f"Expected instruction, header, or label at token \"{tok.value}\" (line {tok.line}, column {tok.column})"
 
         pos += 1
 
-    file.write(output_buffer)
-    file.close()
+    return statements, None
 
-    return None
 
+# Return which arguments of an instruction are words (hi, lo) rather than single cells
+def word_arguments(name: str, args: list[Token]) -> set:
+    if INSTRUCTIONS[name].get("word"):
+        return {len(args) - 1}
+    if name == "mov" and args[0].value == ins_codes.Addr_RegIm16 and args[0].type == TokenType.Number:
+        return {2}
+    return set()
 
-# Tokenize an input buffer so that it can be parsed later
-def tokenize(buffer: str):
+
+# Return how many cells a statement assembles to
+def statement_size(statement: list) -> int:
+    kind = statement[0]
+
+    if kind == "header":
+        return 1
+    elif kind == "label" or kind == "include":
+        return 0
+    elif kind == "string":
+        return len(statement[2])
+
+    _, _, name, args = statement
+    return 1 + len(args) + len(word_arguments(name, args))
+
+
+# Assign every label its offset, the second pass. Jumps start in their short form and switch
+# to the word form when their target doesn't fit in a cell byte. That moves the labels after
+# them, so repeat until nothing changes. Jumps only ever grow, so this always stops.
+# A relocatable object doesn't know where it will be linked, so its jumps to labels are
+# always words, as are jumps to labels in other objects
+def resolve_labels(statements: list, relocatable: bool = False):
+    while True:
+        LABELS.clear()
+        address = 0
+
+        for statement in statements:
+            if statement[0] == "label":
+                LABELS[statement[2]] = address
+            address += statement_size(statement)
+
+        grown = False
+
+        for statement in statements:
+            if statement[0] != "ins" or statement[2] not in WORD_JUMPS:
+                continue
+
+            target = statement[3][-1]
+
+            if target.type != TokenType.Identifier:
+                wide = target.value > 0xFF
+            elif relocatable or target.value not in LABELS:
+                wide = True
+            else:
+                wide = LABELS[target.value] > 0xFF
+
+            if wide:
+                statement[2] = WORD_JUMPS[statement[2]]
+                grown = True
+
+        if not grown:
+            return
+
+
+# Assemble tokens into an object. Label arguments are left as relocations for the linker, and
+# where each statement's cells start is kept for the source map
+def assemble_object(tokens: list[Token], relocatable: bool = False):
+    statements, error = collect_statements(tokens)
+    if error:
+        return None, error
+
+    resolve_labels(statements, relocatable)
+
+    obj = objfile.ObjectFile(symbols=dict(LABELS))
+    output_buffer = obj.cells
+    emit = output_buffer.append
+    mark = obj.lines.extend
+    identifier, number = TokenType.Identifier, TokenType.Number
+
+    for statement in statements:
+        kind = statement[0]
+
+        if kind != "label" and kind != "include":
+            mark((len(output_buffer), statement[1].line))
+
+        if kind == "ins":
+            _, tok, name, args = statement
+            words = word_arguments(name, args)
+
+            emit(INSTRUCTIONS[name]["opcode"])
+
+            for i, arg in enumerate(args):
+                if arg.type is identifier:
+                    obj.relocations.append([len(output_buffer), i in words, arg.value, arg.line, arg.column])
+                    output_buffer.extend((0, 0) if i in words else (0,))
+                    continue
+
+                value = arg.value if arg.type is number else REGISTERS[arg.value.lower()]
+
+                if i in words:
+                    if not 0 <= value <= 0xFFFF:
+                        return None, f"Value {value} does not fit in a word at line {arg.line}, column {arg.column}"
+                    output_buffer.extend((value >> 8, value & 0xFF))
+                else:
+                    emit(value)
+        elif kind == "header":
+            obj.sections.append([SECTIONS[statement[2]], len(output_buffer)])
+            emit(HEADERS[statement[2]])
+        elif kind == "string":
+            output_buffer.extend(statement[2])
+        elif kind == "include":
+            obj.includes.append(statement[2])
+
+    mark((len(output_buffer), 0)) # Whatever follows isn't from this source
+
+    return obj, None
+
+
+# Assemble tokens into image sections, `(kind, address, cells)` tuples, without touching disk
+def link_tokens(tokens: list[Token]):
+    obj, error = assemble_object(tokens)
+    if error:
+        return None, error
+
+    if obj.includes:
+        return None, f"Cannot include \"{obj.includes[0]}\" without the source's path, use `build`"
+
+    return objfile.link([obj])
+
+
+# Write image sections to `output_file`, or to stdout if it is "-"
+def write_image(output_file: str, sections: list):
+    if output_file == "-":
+        image.write(sys.stdout.buffer, sections)
+        sys.stdout.buffer.flush()
+    else:
+        image.save(output_file, sections)
+
+
+def parse_tokens(tokens: list[Token], output_file: str):
     # Handle errors
-    assert type(buffer) == str, "Type of `buffer` is not str"
+    assert type(tokens) == list, "Type of `tokens` is not list"
+    assert type(output_file) == str, "Type of `output_file` is not str"
 
-    pos = 0
-    column = 1
-    row = 0
+    sections, error = link_tokens(tokens)
+    if error:
+        return error
 
-    length = len(buffer)
+    write_image(output_file, sections)
 
-    error = None
-    tokens = []
+    return None
 
-    chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_"
-    numbers = "1234567890"
 
-    while pos < length:
-        current_character = buffer[pos]
+# Load the object for the source file at `path`, from `cache` if its source hasn't changed
+def load_object(path: str, relocatable: bool, cache):
+    with open(path, "rb") as f:
+        source = f.read()
 
-        if current_character == " " or current_character == "/t":
-            column += 1
-            pos += 1
-            continue
-        elif current_character == "\n":
-            column = 1
-            row += 1
-            pos += 1
-            continue
-        elif current_character == "\"":
-            res = ""
+    key = objfile.source_key(source, relocatable)
+    obj = cache.get(key) if cache else None
 
-            pos += 1
-            column += 1
+    if obj is None:
+        try:
+            buffer = source.decode("utf-8")
+        except UnicodeDecodeError as e:
+            return None, f"{path}: {e}"
 
-            while pos < length and buffer[pos] != "\"":
-                res += buffer[pos]
-                pos += 1
-                column += 1
+        tokens, error = tokenize(buffer)
+        if not error:
+            obj, error = assemble_object(tokens, relocatable)
+        if error:
+            return None, f"{path}: {error}"
 
-            tokens.append({"type": TokenType.String, "value": res})
-        elif current_character == "\'":
-            res = ""
-            
-            pos += 1
-            column += 1
+        if cache:
+            cache.put(key, obj)
 
-            while pos < length and buffer[pos] != "\'":
-                res += buffer[pos]
-                pos += 1
-                column += 1
+    obj.name = path
+    return obj, None
 
-            tokens.append({"type": TokenType.String, "value": res})
-        elif current_character == "*":
-            res = ""
 
-            while pos < length and buffer[pos] != "\n":
-                res += buffer[pos]
-                pos += 1
-                column += 1
+# Load the objects of the project rooted at source file `path`: the root file first, to be linked at
+# address 0, then every file it includes, directly or not, once each in the order they're first
+# included. Only sources that changed since they were cached are tokenized and parsed again
+def build_objects(path: str, cache_dir: str = None):
+    cache = objfile.ObjectCache(cache_dir) if cache_dir else None
 
-            tokens.append({"type": TokenType.Comment, "value": res})
-        elif current_character == ".":
-            res = ""
+    objects = []
+    seen = set()
+    pending = [(path, False)] # Stack of (path, relocatable) to load
 
-            pos += 1
+    while pending:
+        source, relocatable = pending.pop()
 
-            while pos < length and buffer[pos] in chars:
-                res += buffer[pos]
-                pos += 1
-                column += 1
-            
-            if HEADERS.get(res):
-                tokens.append({"type": TokenType.Header, "value": res})
-            else:
-                error = f"Invalid header at line {row}, column {column}"
-                break
-        elif current_character == ",":
-            pos += 1
-            column += 1
+        real = os.path.realpath(source)
+        if real in seen:
             continue
-        elif current_character in chars:
-            res = ""
+        seen.add(real)
 
-            while pos < length and (buffer[pos] in chars or buffer[pos] == ":"):
-                res += buffer[pos]
-                pos += 1
-                column += 1
-            
-            if INSTRUCTIONS.get(res):
-                tokens.append({"type": TokenType.Instruction, "value": res})
-            else:
-                if res.endswith(":"):
-                    tokens.append({"type": TokenType.Label, "value": res})
-                else:
-                    if REGISTERS.get(res.lower()):
-                        tokens.append({"type": TokenType.Register, "value": res})
-                    else:
-                        error = f"Invalid syntax at line {row}, column {column}"
-                        break
-        elif current_character in numbers:
-            res = ""
-
-            is_hex = False
-
-            while pos < length and (buffer[pos] in numbers or buffer[pos] in chars or buffer[pos] == "x"):
-                res += buffer[pos]
-                pos += 1
-                column += 1
+        try:
+            obj, error = load_object(source, relocatable, cache)
+        except OSError as e:
+            return None, f"Cannot read {source}: {e.strerror}"
+        if error:
+            return None, error
 
-            try:
-                res.index("x")
-                is_hex = not is_hex
-            except ValueError:
-                is_hex = False
+        objects.append(obj)
+
+        base = os.path.dirname(source)
+        pending.extend((os.path.normpath(os.path.join(base, include)), True) for include in reversed(obj.includes))
+
+    return objects, None
+
+
+# Assemble the project rooted at source file `path` into image sections
+def build_sections(path: str, cache_dir: str = None):
+    objects, error = build_objects(path, cache_dir)
+    if error:
+        return None, error
+
+    return objfile.link(objects)
+
+
+# Assemble the project rooted at source file `path` and write its image to `output_file`, and
+# its source map to `map_file` if given
+def build(path: str, output_file: str, cache_dir: str = None, map_file: str = None):
+    objects, error = build_objects(path, cache_dir)
+    if error:
+        return error
+
+    sections, error = objfile.link(objects)
+    if error:
+        return error
+
+    write_image(output_file, sections)
+
+    if map_file:
+        srcmap.save(map_file, objfile.source_map(objects))
 
+    return None
+
+
+# Tokenize an input buffer so that it can be parsed later
+def tokenize(buffer: str):
+    # Handle errors
+    assert type(buffer) == str, "Type of `buffer` is not str"
+
+    line = 1
+    line_start = 0 # Offset of the current line, for columns
+    end = 0 # End of the previous token
+
+    error = None
+    tokens = []
+    append = tokens.append
+    words = {} # Word -> token type, most words repeat
+
+    for match in TOKEN_REGEX.finditer(buffer):
+        kind = match.lastgroup
+        res = match.group(kind)
+        start = match.start(kind)
+
+        if start != end and "\n" in buffer[end:start]: # The token starts a new line
+            line += buffer.count("\n", end, start)
+            line_start = buffer.rindex("\n", end, start) + 1
+        end = match.end()
+        column = start - line_start + 1
+
+        if kind == "word":
+            token_type = words.get(res)
+            if token_type is None:
+                if res in INSTRUCTIONS:
+                    token_type = TokenType.Instruction
+                elif res.endswith(":"):
+                    token_type = TokenType.Label
+                elif res.lower() in REGISTERS:
+                    token_type = TokenType.Register
+                else:
+                    token_type = TokenType.Identifier
+                words[res] = token_type
+
+            append(Token(token_type, res, line, column))
+        elif kind == "number":
             try:
-                tokens.append({"type": TokenType.Number, "value": int(res.lower(), 0)})
+                append(Token(TokenType.Number, int(res.lower(), 0), line, column))
             except ValueError:
-                error = f"Malformed number \"{res}\" at line {row}, column {column}"
+                error = f"Malformed number \"{res}\" at line {line}, column {column}"
                 break
-        else:
-            error = f"Unrecognized token \"{current_character}\" at line {row}, column {column}"
+        elif kind == "comment":
+            append(Token(TokenType.Comment, res, line, column))
+        elif kind == "string":
+            # Unterminated strings run to the end of the buffer
+            value = res[1:-1] if len(res) > 1 and res[-1] == res[0] else res[1:]
+            append(Token(TokenType.String, value, line, column))
+
+            if "\n" in res: # Strings can span lines
+                line += res.count("\n")
+                line_start = start + res.rindex("\n") + 1
+        elif kind == "header":
+            if res[1:] in HEADERS:
+                append(Token(TokenType.Header, res[1:], line, column))
+            elif res[1:] in DIRECTIVES:
+                append(Token(TokenType.Directive, res[1:], line, column))
+            else:
+                error = f"Invalid header at line {line}, column {column}"
+                break
+        elif kind == "error":
+            error = f"Unrecognized token \"{res}\" at line {line}, column {column}"
             break
 
-        pos += 1
-
     return tokens, error
 
+# Assemble source text into image sections in memory, e.g. to run it without an image file
+def assemble_sections(buffer: str):
+    tokens, error = tokenize(buffer)
+    if error:
+        return None, error
+
+    return link_tokens(tokens)
+
 # Function to assemble the input file
 def assemble(buffer: str, output_file: str):
     # Handle errors
@@ -297,14 +558,25 @@ def main():
 
     positional_args = parser.add_argument_group("positional arguments")
     positional_args.add_argument("--file", "-f", help="The source file.")
-    positional_args.add_argument("--output", "-o", help="The output file's name.", default="output.mem")
+    positional_args.add_argument("--output", "-o", help="The output file's name, `-` for stdout.", default="output.spk")
 
     optional_args = parser.add_argument_group("optional arguments")
     optional_args.add_argument("--verbose", "-v", help="Print more information in a verbose format.", action="store_true")
     optional_args.add_argument("--version", "-V", help="Print version and exit.", action="store_true")
+    optional_args.add_argument("--cache", "-c", help=f"Where to cache assembled objects, default is {CACHE_DIR} next to the source.")
+    optional_args.add_argument("--no-cache", help="Assemble every source file from scratch.", action="store_true")
+    optional_args.add_argument("--stdout", help="Write the image to stdout, same as `--output -`.", action="store_true")
+    optional_args.add_argument("--map", "-m", help=f"Where to write the source map, default is the output's name plus {srcmap.EXTENSION}.")
+    optional_args.add_argument("--no-map", help="Don't write a source map.", action="store_true")
 
     args = parser.parse_args()
 
+    if args.stdout:
+        args.output = "-"
+
+    if args.output == "-":
+        console.file = sys.stderr # Keep messages out of the image
+
     if args.version: # Show version and exit
         console.print("[bold bright_green]SPK-8 Assembler[/bold bright_green]")
         console.print(f"[dim white]{version_string}[/dim white]")
@@ -314,22 +586,28 @@ def main():
         console.print("[bold red]fatal: no input file[/bold red]")
         sys.exit()
 
-    try:
-        # Read the input file
-        f = open(args.file, "r", encoding="utf-8")
-        buffer = f.read()
-    except FileNotFoundError:
-        # The input file doesn't exist
+    if not os.path.isfile(args.file): # The input file doesn't exist
         console.print("[bold red]fatal: input file doesn't exist[/bold red]")
         sys.exit()
-    except Exception as e:
-        # Any other FS related error
-        console.print(f"[bold red]fatal: {e}[/bold red]")
-        sys.exit()
-    
-    assemble(buffer, args.output)
 
-    f.close() # No memory leaks!
+    if args.no_cache:
+        cache_dir = None
+    else:
+        cache_dir = args.cache or os.path.join(os.path.dirname(args.file), CACHE_DIR)
+
+    if args.no_map:
+        map_file = None
+    elif args.map:
+        map_file = args.map
+    else:
+        map_file = None if args.output == "-" else args.output + srcmap.EXTENSION
+
+    error = build(args.file, args.output, cache_dir, map_file)
+    if error:
+        console.print(f"[bold red]error: {error}[/bold red]")
+        return
+
+    console.print("[bold green]Assembled successfully.[/bold green]")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+"""Benchmark for the SPK-8 assembler. Run from `src` the same way as `asm.py`:
+
+    python asm_bench.py -s 1
+
+Generates a source of the given size in MB and times tokenizing and parsing it. With
+`-p FILES` the source is split into a project of that many files instead, and the script
+times a clean build, a rebuild with nothing changed and a rebuild after a one-line edit:
+
+    python asm_bench.py -s 1 -p 50
+
+For the "before" figure, run this same script against the assembler from the baseline
+commit. The generated source avoids tabs, which the baseline tokenizer rejects:
+
+    git worktree add ../spk8-baseline 41a264c
+    cp src/asm_bench.py ../spk8-baseline/src/
+    cd ../spk8-baseline/src && python asm_bench.py -s 1
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import asm
+
+
+BLOCK = """.data
+message_{name}: "Block {n} says hello\\n"
+.text
+* Print block {n}'s message
+mov 0x07, eax, 4
+mov 0x07, ebx, 1
+mov 0x07, edx, 20
+int 0x80
+uld
+mov 0x07, ecx, {n}
+add ecx, 0x1F
+mul ecx, 2
+inc ecx
+"""
+
+
+def source(size: int, first: int = 0) -> str:
+    """Build a valid program of at least `size` characters, numbering its blocks from `first`.
+    """
+    blocks = []
+    length = 0
+    n = first
+
+    while length < size:
+        name = "".join(chr(ord("a") + int(digit)) for digit in str(n)) # Labels can't hold digits in the baseline
+        block = BLOCK.format(n=n, name=name)
+        blocks.append(block)
+        length += len(block)
+        n += 1
+
+    return "".join(blocks) + "hlt\n"
+
+def project(directory: str, size: int, files: int) -> str:
+    """Write a project of `files` sources totalling about `size` characters into `directory`,
+    and return the path of its root file.
+    """
+    root = os.path.join(directory, "main.asm")
+    includes = []
+
+    for i in range(1, files):
+        name = "part%d.asm" % i
+        includes.append('.include "%s"\n' % name)
+
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(source(size // files, i * 100000))
+
+    with open(root, "w") as f:
+        f.write("".join(includes) + source(size // files))
+
+    return root
+
+def best_of(repeat: int, function, *args) -> tuple:
+    """Return the fastest of `repeat` calls to `function` and its last result.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(prog="asm_bench", description="Benchmark the SPK-8 assembler.")
+    parser.add_argument("-s", "--size", type=float, help="source size in MB, default is 1", default=1)
+    parser.add_argument("-p", "--project", type=int, help="split the source into this many files and time incremental builds")
+    parser.add_argument("-r", "--repeat", type=int, help="runs of each stage, the fastest is reported", default=3)
+    args = parser.parse_args()
+
+    if args.project:
+        bench_project(int(args.size * 2**20), args.project)
+        return
+
+    buffer = source(int(args.size * 2**20))
+    lines = buffer.count("\n")
+
+    seconds, (tokens, error) = best_of(args.repeat, asm.tokenize, buffer)
+    if error:
+        raise SystemExit("error: %s" % error)
+    print("tokenize  %8.3fs  %10.0f lines/s  %10d tokens" % (seconds, lines / seconds, len(tokens)))
+
+    fd, path = tempfile.mkstemp(suffix=".spk")
+    os.close(fd)
+    try:
+        seconds, error = best_of(args.repeat, asm.parse_tokens, tokens, path)
+        if error:
+            raise SystemExit("error: %s" % error)
+        print("parse     %8.3fs  %10.0f lines/s" % (seconds, lines / seconds))
+    finally:
+        os.remove(path)
+
+def bench_project(size: int, files: int):
+    with tempfile.TemporaryDirectory() as directory:
+        root = project(directory, size, files)
+        output = os.path.join(directory, "out.spk")
+        cache = os.path.join(directory, asm.CACHE_DIR)
+
+        def timed(label: str):
+            start = time.perf_counter()
+            error = asm.build(root, output, cache)
+            if error:
+                raise SystemExit("error: %s" % error)
+            print("%-10s %8.3fs" % (label, time.perf_counter() - start))
+
+        timed("clean")
+        timed("unchanged")
+
+        with open(root, "a") as f:
+            f.write("inc ecx\n")
+        timed("one edit")
+
+
+if __name__ == "__main__":
+    main()
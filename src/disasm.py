@@ -0,0 +1,188 @@
+"""The disassembler for the SPK-8. Turns a program image back into assembly, using the
+assembler's own instruction and register tables. Run from `src` the same way as `asm.py`:
+
+    python disasm.py -f output.spk
+    python disasm.py -f output.spk -m output.spk.map -o output.lst
+
+The source map the assembler wrote next to the image, if there is one, puts the labels back
+and names the source line of every instruction.
+"""
+import argparse
+import sys
+
+from rich.console import Console
+from emu import image
+from emu import ins_codes
+from emu import srcmap
+
+from asm import INSTRUCTIONS, REGISTERS, HEADERS, version_string
+
+
+# Define the reverse tables for decoding
+OPCODES = {info["opcode"]: name for name, info in INSTRUCTIONS.items()}
+REGISTER_NAMES = {code: name for name, code in REGISTERS.items()}
+HEADER_NAMES = {cell: name for name, cell in HEADERS.items()}
+
+STRING_LIMIT = 48 # Characters per string line in data and rom
+RAW_LIMIT = 5 # Cells shown per line, longer strings are cut short
+
+console = Console(stderr=True)
+
+
+# Format an argument cell, naming registers and, for jump targets, labels
+def argument(value: int, source_map=None, target: bool = False) -> str:
+    if target and source_map is not None:
+        symbol = source_map.symbol(value)
+        if symbol is not None and symbol[1] == 0:
+            return symbol[0]
+
+    if value in REGISTER_NAMES:
+        return REGISTER_NAMES[value]
+
+    return hex(value)
+
+
+# Decode the instruction at `cells[i]`. Returns `(text, size)`, or None if it isn't one
+def decode(cells, i: int, source_map=None):
+    name = OPCODES.get(cells[i])
+    if name is None:
+        return None
+
+    info = INSTRUCTIONS[name]
+    count = info["args"]
+    values = []
+    at = i + 1
+
+    for n in range(count):
+        # Same rule as the assembler's `word_arguments`
+        word = (info.get("word") and n == count - 1) or (name == "mov" and n == 2 and values[0] == ins_codes.Addr_RegIm16)
+        size = 2 if word else 1
+
+        if at + size > len(cells):
+            return None # Cut off by the end of the section
+
+        values.append(cells[at] << 8 | cells[at + 1] if word else cells[at])
+        at += size
+
+    jumps = name.startswith("j") # Their last argument is an address
+    args = [argument(value, source_map, jumps and n == count - 1) for n, value in enumerate(values)]
+
+    return (name + " " + ", ".join(args)).rstrip(), at - i
+
+
+# Split data cells into string literals where they're printable, and numbers where not.
+# Returns `(text, cells)` for each part
+def strings(cells) -> list:
+    parts = []
+    run = []
+
+    def flush():
+        if run:
+            parts.append(('"%s"' % "".join(run), len(run)))
+            run.clear()
+
+    for cell in cells:
+        char = chr(cell) if cell < 0x110000 else None
+
+        if char is not None and (char == "\n" or char.isprintable()) and char != '"':
+            run.append("\\n" if char == "\n" else char)
+            if len(run) >= STRING_LIMIT:
+                flush()
+        else:
+            flush()
+            parts.append(("* %s" % hex(cell), 1)) # Not a character, the assembler can't write these
+
+    flush()
+
+    return parts
+
+
+# Disassemble image sections, `(kind, address, cells)` tuples, into lines of text
+def disassemble(sections: list, source_map=None) -> list:
+    output = []
+    append = output.append
+    labels = {}
+
+    if source_map is not None:
+        labels = {address: name for address, name in zip(source_map.symbol_addresses, source_map.symbols)}
+
+    def line(address: int, cells, text: str):
+        where = source_map.line(address) if source_map is not None else None
+        raw = " ".join("%x" % cell for cell in cells[:RAW_LIMIT]) + (" .." if len(cells) > RAW_LIMIT else "")
+        append(("%06x  %-24s  %-32s %s" % (address, raw, text, "* %s:%d" % where if where else "")).rstrip())
+
+    for kind, base, cells in sections:
+        mode = {image.SECTION_DATA: "data", image.SECTION_ROM: "rom"}.get(kind, "text")
+        i = 0
+
+        while i < len(cells):
+            address = base + i
+            if address in labels:
+                append("%s:" % labels[address])
+
+            cell = cells[i]
+
+            if cell in HEADER_NAMES:
+                mode = HEADER_NAMES[cell]
+                line(address, cells[i:i + 1], "." + mode)
+                i += 1
+                continue
+
+            decoded = decode(cells, i, source_map) if mode == "text" else None
+            if decoded is not None:
+                text, size = decoded
+                line(address, cells[i:i + size], text)
+                i += size
+                continue
+
+            # Data, or a string in text, runs up to the next label, header or (in text) opcode
+            end = i + 1
+            while end < len(cells) and base + end not in labels and cells[end] not in HEADER_NAMES:
+                if mode == "text" and cells[end] in OPCODES:
+                    break
+                end += 1
+
+            for text, size in strings(cells[i:end]):
+                line(base + i, cells[i:i + size], text)
+                i += size
+
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="spk8-disasm", description="The disassembler for the SPK-8.")
+    parser.add_argument("--file", "-f", help="The image to disassemble.", required=True)
+    parser.add_argument("--map", "-m", help=f"The image's source map, default is the image's name plus {srcmap.EXTENSION} if it exists.")
+    parser.add_argument("--output", "-o", help="Write the listing to this file instead of stdout.")
+    parser.add_argument("--version", "-V", help="Print version and exit.", action="version", version=version_string)
+    args = parser.parse_args()
+
+    try:
+        entry, sections = image.read(args.file)
+    except OSError as e:
+        console.print(f"[bold red]fatal: can't read {args.file}: {e.strerror}[/bold red]")
+        sys.exit(1)
+    except (UnicodeDecodeError, ValueError) as e:
+        console.print(f"[bold red]fatal: {args.file} is not an image: {e}[/bold red]")
+        sys.exit(1)
+
+    if args.map:
+        try:
+            source_map = srcmap.load(args.map)
+        except (OSError, ValueError) as e:
+            console.print(f"[bold red]fatal: can't read source map {args.map}: {e}[/bold red]")
+            sys.exit(1)
+    else:
+        source_map = srcmap.find(args.file)
+
+    listing = ["* %s, entry %s" % (args.file, hex(entry))] + disassemble(sections, source_map)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write("\n".join(listing) + "\n")
+    else:
+        print("\n".join(listing))
+
+
+if __name__ == "__main__":
+    main()
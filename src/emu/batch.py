@@ -0,0 +1,150 @@
+"""Headless batch runner for the SPK-8 emulator. Runs many program images across a process
+pool and writes one JSON line per run. Run from `src/emu` the same way as `main.py`:
+
+    python batch.py programs/ -o report.jsonl
+    python batch.py manifest.txt -j 8 -b 1000000 -t 10
+
+A manifest is a text file with one image path per line, relative to the manifest.
+Blank lines and lines starting with `#` are skipped.
+
+Each report line holds the image path, the exit reason (see `CPU.Execute`, plus "timeout"
+and "error"), the instructions retired and cycles run, the final PC and registers, everything
+the program wrote, a SHA-256 of the framebuffer's RGB pixels and the wall-clock time of the run.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import signal
+import sys
+import time
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from cpu import CPU
+from memory import Memory
+from image import load
+from srcmap import find
+from framebuffer import Headless
+
+
+IMAGE_EXTENSIONS = (".spk", ".mem")
+
+REGISTERS = ["EAX", "EBX", "ECX", "EDX", "AX", "BX", "CX", "DX", "BAX", "BBX", "BCX", "BDX", "RS"]
+
+
+class Timeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise Timeout()
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """Raise `Timeout` in the block after `seconds` of wall-clock time. Needs `SIGALRM`,
+    so on platforms without it only the instruction budget applies.
+    """
+    if not seconds or not hasattr(signal, "setitimer"):
+        yield
+        return
+
+    previous = signal.signal(signal.SIGALRM, _alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def find_images(source: str) -> list:
+    """Return the image paths in directory `source`, or listed in manifest file `source`.
+    """
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(source)
+            for name in names if name.endswith(IMAGE_EXTENSIONS)
+        )
+
+    base = os.path.dirname(source)
+    with open(source, "r") as f:
+        lines = [line.strip() for line in f]
+
+    return [os.path.join(base, line) for line in lines if line and not line.startswith("#")]
+
+def run_one(path: str, budget: int = None, timeout: float = None, memory_size: int = 2**16) -> dict:
+    """Run the image at `path` headless and return its report.
+    """
+    output = io.StringIO()
+    screen = Headless(output)
+    cpu = CPU(screen)
+    log = io.StringIO() # Anything the CPU prints, e.g. invalid opcodes
+    error = None
+
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            memory = Memory(memory_size)
+            entry, _ = load(path, memory)
+
+            cpu.LoadMemory(memory)
+            cpu.PC = entry
+            cpu.source_map = find(path) # Errors name the source line, if the image has a map
+
+            with deadline(timeout):
+                reason = cpu.Execute(budget)
+    except Timeout:
+        reason = "timeout"
+    except Exception as e:
+        reason = "error"
+        error = "%s: %s" % (type(e).__name__, e)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "image": path,
+        "exit": reason,
+        "error": error,
+        "instructions": cpu.instructions_retired,
+        "cycles": cpu.cycles,
+        "pc": cpu.PC,
+        "registers": {name: getattr(cpu, name) for name in REGISTERS},
+        "output": output.getvalue(),
+        "log": log.getvalue(),
+        "framebuffer": hashlib.sha256(screen.tobytes()).hexdigest(),
+        "seconds": round(elapsed, 6),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(prog="spk8-batch", description="Run many SPK-8 program images headless and write a JSONL report.")
+    parser.add_argument("source", help="a directory of images (searched recursively), or a manifest file listing them")
+    parser.add_argument("-o", "--output", help="the report file, default is stdout", default="-")
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes, default is one per core", default=os.cpu_count())
+    parser.add_argument("-b", "--budget", type=int, help="stop each program after this many instructions")
+    parser.add_argument("-t", "--timeout", type=float, help="stop each program after this many seconds")
+    parser.add_argument("-m", "--memory", help="how many cells of memory each CPU gets, default is 64K", default=2**16, type=int)
+    args = parser.parse_args()
+
+    images = find_images(args.source)
+    worker = partial(run_one, budget=args.budget, timeout=args.timeout, memory_size=args.memory)
+    chunksize = max(1, len(images) // (args.jobs * 4)) # Fewer round trips without starving workers at the end
+
+    reasons = Counter()
+    start = time.perf_counter()
+
+    with open(args.output, "w") if args.output != "-" else contextlib.nullcontext(sys.stdout) as report:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            for result in pool.map(worker, images, chunksize=chunksize):
+                report.write(json.dumps(result) + "\n")
+                reasons[result["exit"]] += 1
+
+    summary = ", ".join("%d %s" % (count, reason) for reason, count in reasons.most_common())
+    print("Ran %d image(s) in %.2fs: %s" % (len(images), time.perf_counter() - start, summary or "nothing to run"), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Benchmarks for the SPK-8 emulator. Run from `src/emu` the same way as `main.py`:
+
+    python bench.py -n 200000
+
+Pass `-i` to run the same programs on the interpreter alone, without predecoded blocks.
+
+For the "before" figure, run this same script against the original if/elif interpreter
+from the baseline commit. The script only uses APIs that exist there:
+
+    git worktree add ../spk8-baseline 41a264c
+    cp src/emu/bench.py ../spk8-baseline/src/emu/
+    cd ../spk8-baseline/src/emu && python bench.py -n 200000
+"""
+
+import argparse
+import time
+
+from cpu import CPU
+from memory import Memory
+from ins_codes import *
+
+
+def tight_loop(iterations: int) -> tuple:
+    """Build a program that counts RS up to `iterations` with INC/JNE.
+
+    Returns the program cells and how many instructions it retires.
+    """
+    program = [
+        MOV, Addr_RegIm8, Code_RS, 0, # 0: mov rs, 0
+        INC, Code_RS,                 # 4: inc rs
+        JNE, iterations, 4,           # 6: jne iterations, 4
+        HLT                           # 9: hlt
+    ]
+
+    return program, 2 + iterations * 2
+
+def arithmetic(iterations: int) -> tuple:
+    """Build an ALU-heavy loop that mixes register and immediate operands.
+
+    Returns the program cells and how many instructions it retires.
+    """
+    program = [
+        MOV, Addr_RegIm8, Code_ECX, 0,     # 0: mov ecx, 0
+        ADD, Code_EAX, 3,                  # 4: add eax, 3
+        MOV, Addr_RegIm8, Code_EAX, Code_RS,
+        SUB, Code_EAX, 1,                  # sub eax, 1
+        MOV, Addr_RegIm8, Code_EAX, Code_RS,
+        MUL, Code_EBX, 2,                  # mul ebx, 2
+        AND, Code_EAX, Code_EBX,           # and eax, ebx
+        INC, Code_ECX,                     # inc ecx
+        MOV, Addr_RegIm8, Code_RS, Code_ECX,
+        JNE, iterations, 4,                # jne iterations, 4
+        HLT
+    ]
+
+    return program, 2 + iterations * 9
+
+def nested_loop(outer: int, inner: int) -> tuple:
+    """Build two nested counting loops, the shape most guest programs spend their time in.
+
+    Returns the program cells and how many instructions it retires.
+    """
+    program = [
+        MOV, Addr_RegIm8, Code_ECX, 0,     # 0: mov ecx, 0
+        MOV, Addr_RegIm8, Code_RS, 0,      # 4: mov rs, 0
+        INC, Code_RS,                      # 8: inc rs
+        JNE, inner, 8,                     # 10: jne inner, 8
+        INC, Code_ECX,                     # 13: inc ecx
+        MOV, Addr_RegIm8, Code_RS, Code_ECX,
+        JNE, outer, 4,                     # 19: jne outer, 4
+        HLT
+    ]
+
+    return program, 2 + outer * (4 + inner * 2)
+
+def run(name: str, program: list, instructions: int, repeat: int = 5, predecode: bool = True):
+    best = None
+
+    for _ in range(repeat):
+        memory = Memory()
+        for i, cell in enumerate(program):
+            memory.data[i] = cell
+
+        cpu = CPU(None)
+        cpu.LoadMemory(memory)
+        cpu.predecode = predecode
+
+        start = time.perf_counter()
+        cpu.Execute()
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print("%-12s %10d instructions  %8.3fs  %12.0f ins/s" % (name, instructions, best, instructions / best))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the SPK-8 emulator.")
+    parser.add_argument("-n", "--iterations", type=int, default=200000, help="loop iterations per benchmark")
+    parser.add_argument("-i", "--interpret", action="store_true", help="disable predecoded basic blocks and only run the interpreter")
+    args = parser.parse_args()
+
+    predecode = not args.interpret
+
+    run("tight-loop", *tight_loop(args.iterations), predecode=predecode)
+    run("arithmetic", *arithmetic(args.iterations // 4), predecode=predecode)
+    run("nested-loop", *nested_loop(args.iterations // 100, 100), predecode=predecode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""The clock module for the SPK-8 emulator. Counts the cycles each instruction costs and
+can pace the CPU to a fixed clock rate.
+
+By default the CPU runs as fast as the host allows, which `CPU.Execute` can cap with an
+instruction budget. With `Clock(mhz)` execution is throttled to that rate: the CPU checks
+in once every `SYNC_INTERVAL` seconds of guest time and sleeps off whatever it is ahead,
+so it never busy-waits.
+"""
+import time
+
+from ins_codes import *
+
+
+SYNC_INTERVAL = 0.01 # Seconds of guest time between sleeps when throttled
+
+DEFAULT_CYCLES = 2 # Anything not in the table, including invalid opcodes
+SEGMENT_CYCLES = 1 # Running a linked section header
+
+# Cycles per opcode
+CYCLES = [DEFAULT_CYCLES] * OPCODE_COUNT
+
+CYCLES[NOP] = 1
+CYCLES[INT] = 7
+CYCLES[HLT] = 1
+CYCLES[MOV] = 3
+CYCLES[JNE] = 3
+CYCLES[JE] = 3
+CYCLES[JNZ] = 3
+CYCLES[JZ] = 3
+CYCLES[ADD] = 2
+CYCLES[SUB] = 2
+CYCLES[MUL] = 4
+CYCLES[DIV] = 8
+CYCLES[JMP] = 3
+CYCLES[AND] = 2
+CYCLES[INC] = 2
+CYCLES[DEC] = 2
+CYCLES[ULD] = 4
+CYCLES[BRK] = 7
+CYCLES[JNEW] = 4 # Word jumps fetch one more cell
+CYCLES[JEW] = 4
+CYCLES[JNZW] = 4
+CYCLES[JZW] = 4
+CYCLES[JMPW] = 4
+
+MAX_CYCLES = max(CYCLES + [SEGMENT_CYCLES]) # The most any one instruction costs
+
+
+def cost(ins: int) -> int:
+    """Return the cycles the cell `ins` costs when it is executed.
+    """
+    return CYCLES[ins] if ins < OPCODE_COUNT else SEGMENT_CYCLES
+
+
+class Clock:
+    def __init__(self, mhz: float = None):
+        self.mhz = mhz # None runs at full speed
+
+        self.cycles = 0 # Cycles run by the last `Execute`
+        self.elapsed = 0.0 # Host seconds the last `Execute` took
+
+        self.__start = 0.0
+        self.__base = 0 # Cycle count the guest time is measured from
+
+    def __next(self, cycles: int) -> float:
+        if not self.mhz:
+            return float("inf")
+        return cycles + max(1, int(self.mhz * 1e6 * SYNC_INTERVAL))
+
+    def start(self, cycles: int = 0) -> float:
+        """Start timing a run and return the cycle count to call `sync` at.
+        """
+        self.__start = time.perf_counter()
+        self.__base = cycles
+
+        return self.__next(cycles)
+
+    def sync(self, cycles: int) -> float:
+        """Sleep until the host catches up with `cycles` at the clock rate, and return the
+        cycle count to call `sync` at next.
+        """
+        now = time.perf_counter()
+        ahead = (cycles - self.__base) / (self.mhz * 1e6) - (now - self.__start)
+
+        if ahead > 0:
+            time.sleep(ahead)
+        elif ahead < -SYNC_INTERVAL:
+            # The host fell behind, e.g. a slow syscall. Don't run flat out to make it up
+            self.__start = now
+            self.__base = cycles
+
+        return self.__next(cycles)
+
+    def stop(self, cycles: int):
+        self.cycles = cycles
+        self.elapsed = time.perf_counter() - self.__start
+
+    @property
+    def effective_mhz(self) -> float:
+        """The clock rate the last run actually reached.
+        """
+        return self.cycles / self.elapsed / 1e6 if self.elapsed else 0.0
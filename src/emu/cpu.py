@@ -1,8 +1,16 @@
-from memory import Memory
-from typing import Any
+import copy
+import sys
+
+from array import array
+from collections import namedtuple
+from memory import Memory, CELL_TYPE, PAGE_BITS
 from ins_codes import *
-from screen import writes, clear, draw_pix, set_colour, reset_scroll
-from fs import mkdir, create_file, writef, ls, rm, cd
+from decode import BlockCache, translate, BLOCK_LIMIT
+from linker import link
+from clock import Clock, CYCLES, MAX_CYCLES, SEGMENT_CYCLES
+from palette import PALETTE_SIZE, DEFAULT_COLOURS, unpack, codes
+from srcmap import describe
+import fs
 
 
 class Flags:
@@ -24,6 +32,29 @@ class Flags:
         ps = self.Z << 7 | self.C << 6 | self.O << 5 | self.S << 4 | self.B << 3 | self.T << 2 | self.I << 1 | self.E
         return ps
 
+# Registers with an operand code, in code order
+REGISTER_COUNT = Code_RS - Code_EAX + 1
+RS = Code_RS - Code_EAX # Register file slot of the result register
+
+
+def _register(code: int) -> property:
+    """Named accessor for the register file slot of register `code`.
+    """
+    index = code - Code_EAX
+
+    def get(self):
+        return self.regs[index]
+
+    def set(self, value):
+        self.regs[index] = value
+
+    return property(get, set)
+
+
+# A saved machine, see `CPU.Snapshot`
+State = namedtuple("State", ["regs", "index", "pc", "flags", "data_index", "in_interrupt", "ram", "memory", "screen", "fs"])
+
+
 class CPU:
 
     Syscall = 0x80
@@ -47,46 +78,127 @@ class CPU:
     Sys_Open = 0x05
     Sys_Close = 0x06
     Sys_Create = 0x08
+    Sys_Seek = 0x13
+    Sys_Core = 0x14
     Sys_Time = 0x0D
     Sys_fTime = 0x23
 
-    def __init__(self, screen):
+    EAX = _register(Code_EAX) # Extended (32-bit), A, X (General Purpose)
+    EBX = _register(Code_EBX)
+    ECX = _register(Code_ECX)
+    EDX = _register(Code_EDX)
+
+    AX = _register(Code_AX) # 16-bits
+    BX = _register(Code_BX)
+    CX = _register(Code_CX)
+    DX = _register(Code_DX)
+    BAX = _register(Code_BAX) # B (8-bit), A, X (General Purpose)
+    BBX = _register(Code_BBX)
+    BCX = _register(Code_BCX)
+    BDX = _register(Code_BDX)
+
+    RS = _register(Code_RS) # Result register
+
+    def __init__(self, screen, filesystem: fs.FileSystem = None):
         self.PC = 0 # Program counter
         self.PS = Flags()
 
-        # Registers
-        self.EAX = 0 # Extended (32-bit), A, X (General Purpose)
-        self.EBX = 0
-        self.ECX = 0
-        self.EDX = 0
+        # Register file, indexed by register code - Code_EAX
+        self.regs = [0] * REGISTER_COUNT
 
         self.EDI = 0 # Destination index
         self.ESI = 0 # Source index
         self.ESP = 0 # Stack pointer
         self.EBP = 0 # Address offset
 
-        self.AX = 0 # 16-bits
-        self.BX = 0
-        self.CX = 0
-        self.DX = 0
-        self.BAX = 0 # B (8-bit), A, X (General Purpose)
-        self.BBX = 0
-        self.BCX = 0
-        self.BDX = 0
-
-        self.RS = 0 # Result register
-
-        self.memory = Memory().data
+        self.ram = Memory()
+        self.memory = self.ram.data
         self.buffer = len(self.memory)
-        self.original_memory = Memory()
+        self.original_memory = self.ram
+        self.boot = self.ram.snapshot() # Memory as loaded, for restarts
         self.debug = False
+        self.source_map = None # A `srcmap.SourceMap` to name addresses in errors with, if the program has one
         self.in_interrupt = False
+        self.interrupt = 0 # Code of the interrupt being handled
         self.screen = screen
+        self.filesystem = filesystem if filesystem is not None else fs.FileSystem() # Unmounted, file syscalls fail
+        self.files = fs.FileTable(self.filesystem) # Open files, by descriptor
+
+        self.data_index = 0
+        self.links = {} # Header address -> Segment, see `linker`
+        self.__ops = self.__BuildDispatch()
+
+        self.predecode = True # Run straight-line text from predecoded basic blocks
+        self.blocks = BlockCache()
+        self.core = 0 # This CPU's number in a `machine.Machine`
+        self.peers = () # Block caches of the other cores sharing memory, see `machine`
+        self.clock = Clock() # Full speed, set `clock.mhz` to throttle
+        self.instructions_retired = 0 # By the last `Execute`
+        self.cycles = 0 # By the last `Execute`
 
     def LoadMemory(self, memory: Memory):
+        self.ram = memory
         self.memory = memory.data
         self.buffer = len(self.memory)
         self.original_memory = memory
+        self.boot = memory.snapshot()
+        self.data_index = 0 # Nothing copied to the variable area yet
+        self.links = link(self.memory)
+        self.blocks.clear()
+
+    def __Invalidate(self, start: int, end: int):
+        # Drop the blocks decoded from [start, end), on this core and any sharing its memory
+        self.blocks.invalidate(start, end)
+        for blocks in self.peers:
+            blocks.invalidate(start, end)
+
+    def __Written(self, start: int, end: int):
+        # Every write to memory outside of loading goes through here
+        self.__Invalidate(start, end)
+        self.ram.touch(start, end)
+
+    def __RestoreMemory(self, ram: Memory, pages: tuple):
+        if ram is not self.ram:
+            self.ram = ram
+            self.memory = ram.data
+            self.buffer = len(self.memory)
+            self.links = link(self.memory)
+            self.blocks.clear()
+
+        for page in ram.restore(pages):
+            self.__Invalidate(page << PAGE_BITS, (page + 1) << PAGE_BITS)
+
+    def Snapshot(self) -> State:
+        """Save the whole machine: registers, flags, PC, memory, the screen and the virtual
+        filesystem. Memory pages are shared with the previous snapshot until they are written,
+        so a snapshot only copies what changed since the last one.
+        """
+        return State(
+            tuple(self.regs), (self.EDI, self.ESI, self.ESP, self.EBP), self.PC, copy.copy(self.PS),
+            self.data_index, self.in_interrupt, self.ram, self.ram.snapshot(),
+            self.screen.snapshot() if self.screen is not None else None,
+            (self.filesystem.snapshot(), self.files.snapshot())
+        )
+
+    def Restore(self, state: State):
+        """Put the machine back to a `Snapshot`. Only memory pages written since, or that
+        differ between the two snapshots, are copied back.
+        """
+        self.regs[:] = state.regs
+        self.EDI, self.ESI, self.ESP, self.EBP = state.index
+        self.PC = state.pc
+        self.PS = copy.copy(state.flags)
+        self.data_index = state.data_index
+        self.in_interrupt = state.in_interrupt
+
+        self.__RestoreMemory(state.ram, state.memory)
+
+        if state.screen is not None and self.screen is not None:
+            self.screen.restore(state.screen)
+
+        disk, files = state.fs
+        self.filesystem.restore(disk)
+        self.files.restore(files)
 
     def __FetchByte(self) -> int:
         value = self.memory[self.PC]
@@ -94,98 +206,26 @@ class CPU:
 
         return value
     
-    def __FetchWord(self) -> int:
-        return self.__FetchByte() << 8 | self.__FetchByte()
-    
-    def __WriteReg(self, code: int, value: int) -> None:
-        if code == Code_EAX:
-            self.EAX = value
-
-        elif code == Code_EBX:
-            self.EBX = value
-
-        elif code == Code_ECX:
-            self.ECX = value
-
-        elif code == Code_EDX:
-            self.EDX = value
-
-        elif code == Code_AX:
-            self.AX = value
-
-        elif code == Code_BX:
-            self.BX = value
-
-        elif code == Code_CX:
-            self.CX = value
-
-        elif code == Code_DX:
-            self.DX = value
-
-        elif code == Code_BAX:
-            self.BAX = value
-
-        elif code == Code_BBX:
-            self.BBX = value
-
-        elif code == Code_BCX:
-            self.BCX = value
-
-        elif code == Code_BDX:
-            self.BDX = value
-
-        elif code == Code_RS:
-            self.RS = value
-
-    def __IsReg(self, code: int):
-        if code == Code_EAX:
-            return [True, self.EAX]
-        elif code == Code_EBX:
-            return [True, self.EBX]
-        elif code == Code_ECX:
-            return [True, self.ECX]
-        elif code == Code_EDX:
-            return [True, self.EDX]
-        elif code == Code_AX:
-            return [True, self.AX]
-        elif code == Code_BX:
-            return [True, self.BX]
-        elif code == Code_CX:
-            return [True, self.CX]
-        elif code == Code_DX:
-            return [True, self.DX]
-        elif code == Code_BAX:
-            return [True, self.BAX]
-        elif code == Code_BBX:
-            return [True, self.BBX]
-        elif code == Code_BCX:
-            return [True, self.BCX]
-        elif code == Code_BDX:
-            return [True, self.BDX]
-        elif code == Code_RS:
-            return [True, self.RS]
-        return [False, 0]
-
     def __RaiseInterrupt(self, code: int, **kwargs) -> None:
         try:
             string = "CPU: Interrupt: "
 
             if code == self.InvalidOpcode:
                 if 'opcode' in kwargs:
-                    string += "InvalidOpcode: %s at address %s" % (hex(kwargs['opcode']), hex(self.PC))
+                    string += "InvalidOpcode: %s at address %s" % (hex(kwargs['opcode']), describe(self.source_map, self.PC))
                 else:
-                    string += "InvalidOpcode: Unkown at address %s" % hex(self.PC)
+                    string += "InvalidOpcode: Unkown at address %s" % describe(self.source_map, self.PC)
                 
             elif code == self.OutOfMemory:
-                string += "OutOfMemory: %s" % hex(self.PC)
+                string += "OutOfMemory: %s" % describe(self.source_map, self.PC)
 
             elif code == self.SingleStepInterrupt:
-                string += "SingleStepInterrupt: %s" % hex(self.PC)
+                string += "SingleStepInterrupt: %s" % describe(self.source_map, self.PC)
                 input(string)
                 return
             
             elif code == self.Breakpoint:
-                string += "Breakpoint: %s" % hex(self.PC-1)
+                string += "Breakpoint: %s" % describe(self.source_map, self.PC-1)
                 input(string)
                 return
 
@@ -193,420 +233,565 @@ class CPU:
             if self.debug:
                 print("CPU: Interrupt: DoubleFault: Origin: %s" % e)
 
-            raise Exception(string + "DoubleFault: %s" % hex(self.PC))
+            raise Exception(string + "DoubleFault: %s" % describe(self.source_map, self.PC))
         
         raise Exception(string)
     
+    def __Cells(self, address: int, count: int) -> tuple:
+        # Clamp `count` cells from `address` to memory, as `(start, end)`
+        start = min(address, len(self.memory))
+        return start, min(start + count, len(self.memory))
+
     def __HandleSyscall(self):
         if self.EAX == self.Sys_Write:
-            if self.EBX == 1: # Draw text at cursor pos
-                string = ''
-                counter = 0
-
-                while counter < self.EDX:
-                    char = self.memory[self.VarLoc + counter]
-                    string += chr(char)
-                    counter += 1
+            if self.EBX >= fs.FD_BASE: # Write EDX cells from VarLoc + ECX to descriptor EBX
+                start, end = self.__Cells(self.VarLoc + self.ECX, self.EDX)
+                try:
+                    self.RS = self.files.write(self.EBX, self.ram.dump(start, end - start)) // 4 # Cells written
+                except OSError as e:
+                    self.RS = 0
+                    if self.debug:
+                        print("CPU: Interrupt: Syscall: Write: %s: %s" % (self.EBX, e))
+
+                if self.debug:
+                    print("CPU: Interrupt: Syscall: Write: %s <- %d" % (self.EBX, self.RS))
+            elif self.EBX == 1: # Draw text at cursor pos
+                string = self.ram.dump(self.VarLoc, self.EDX).decode("utf-32-le", "surrogatepass")
                 if self.debug:
                     print("CPU: Interrupt: Syscall: Write: Stdout: %s" % string)
-                writes(self.screen, string)
+                self.screen.writes(string)
             elif self.EBX == 2: # Clear screen
-                if self.EDX == 0x0:
-                    clear(self.screen, "black")
-                elif self.EDX == 0x1:
-                    clear(self.screen, "blue3")
-                elif self.EDX == 0x2:
-                    clear(self.screen, "green3")
-                elif self.EDX == 0x3:
-                    clear(self.screen, "cyan3")
-                elif self.EDX == 0x4:
-                    clear(self.screen, "red3")
-                elif self.EDX == 0x5:
-                    clear(self.screen, "magenta3")
-                elif self.EDX == 0x6:
-                    clear(self.screen, "brown3")
-                elif self.EDX == 0x7:
-                    clear(self.screen, "gray")
-                elif self.EDX == 0x8:
-                    clear(self.screen, "gray3")
-                elif self.EDX == 0x9:
-                    clear(self.screen, "blue")
-                elif self.EDX == 0xA:
-                    clear(self.screen, "green")
-                elif self.EDX == 0xB:
-                    clear(self.screen, "cyan")
-                elif self.EDX == 0xC:
-                    clear(self.screen, "red")
-                elif self.EDX == 0xD:
-                    clear(self.screen, "magenta")
-                elif self.EDX == 0xE:
-                    clear(self.screen, "yellow")
-                elif self.EDX == 0xF:
-                    clear(self.screen, "white")
+                colour = int(self.EDX) # The framebuffer stores codes in bytes, and DIV leaves floats
+                if 0 <= colour < PALETTE_SIZE:
+                    self.screen.clear(colour)
 
                 if self.debug:
-                    print(f"CPU: Interrupt: Syscall: Write: Clear: {hex(self.EDX)}")
+                    print(f"CPU: Interrupt: Syscall: Write: Clear: {hex(colour)}")
             elif self.EBX == 3: # Draw graphics pixel
-                if self.EDX == 0x0:
-                    draw_pix(self.screen, (self.AX, self.BX), "black")
-                elif self.EDX == 0x1:
-                    draw_pix(self.screen, (self.AX, self.BX), "blue3")
-                elif self.EDX == 0x2:
-                    draw_pix(self.screen, (self.AX, self.BX), "green3")
-                elif self.EDX == 0x3:
-                    draw_pix(self.screen, (self.AX, self.BX), "cyan3")
-                elif self.EDX == 0x4:
-                    draw_pix(self.screen, (self.AX, self.BX), "red3")
-                elif self.EDX == 0x5:
-                    draw_pix(self.screen, (self.AX, self.BX), "magenta3")
-                elif self.EDX == 0x6:
-                    draw_pix(self.screen, (self.AX, self.BX), "brown3")
-                elif self.EDX == 0x7:
-                    draw_pix(self.screen, (self.AX, self.BX), "gray")
-                elif self.EDX == 0x8:
-                    draw_pix(self.screen, (self.AX, self.BX), "gray3")
-                elif self.EDX == 0x9:
-                    draw_pix(self.screen, (self.AX, self.BX), "blue")
-                elif self.EDX == 0xA:
-                    draw_pix(self.screen, (self.AX, self.BX), "green")
-                elif self.EDX == 0xB:
-                    draw_pix(self.screen, (self.AX, self.BX), "cyan")
-                elif self.EDX == 0xC:
-                    draw_pix(self.screen, (self.AX, self.BX), "red")
-                elif self.EDX == 0xD:
-                    draw_pix(self.screen, (self.AX, self.BX), "magenta")
-                elif self.EDX == 0xE:
-                    draw_pix(self.screen, (self.AX, self.BX), "yellow")
-                elif self.EDX == 0xF:
-                    draw_pix(self.screen, (self.AX, self.BX), "white")
+                colour = int(self.EDX)
+                if 0 <= colour < PALETTE_SIZE:
+                    self.screen.draw_pix((int(self.AX), int(self.BX)), colour)
 
                 if self.debug:
-                    print(f"CPU: Interrupt: Syscall: Write: DrawPixel: {hex(self.EDX)}")
+                    print(f"CPU: Interrupt: Syscall: Write: DrawPixel: {hex(colour)}")
             elif self.EBX == 4: # Set current text colour
-                if self.EDX == 0x0:
-                    set_colour("black")
-                elif self.EDX == 0x1:
-                    set_colour("blue3")
-                elif self.EDX == 0x2:
-                    set_colour("green3")
-                elif self.EDX == 0x3:
-                    set_colour("cyan3")
-                elif self.EDX == 0x4:
-                    set_colour("red3")
-                elif self.EDX == 0x5:
-                    set_colour("magenta3")
-                elif self.EDX == 0x6:
-                    set_colour("brown3")
-                elif self.EDX == 0x7:
-                    set_colour("gray")
-                elif self.EDX == 0x8:
-                    set_colour("gray3")
-                elif self.EDX == 0x9:
-                    set_colour("blue")
-                elif self.EDX == 0xA:
-                    set_colour("green")
-                elif self.EDX == 0xB:
-                    set_colour("cyan")
-                elif self.EDX == 0xC:
-                    set_colour("red")
-                elif self.EDX == 0xD:
-                    set_colour("magenta")
-                elif self.EDX == 0xE:
-                    set_colour("yellow")
-                elif self.EDX == 0xF:
-                    set_colour("white")
+                colour = int(self.EDX)
+                if 0 <= colour < PALETTE_SIZE:
+                    self.screen.set_colour(colour)
+            elif self.EBX == 5: # Set palette colours ECX.. from the 0xRRGGBB cells in the data segment
+                start = int(self.ECX)
+                colours = [unpack(cell) for cell in self.ram.view(self.VarLoc, int(self.EDX))]
+                self.screen.set_palette(start, colours)
+
+                if self.debug:
+                    print(f"CPU: Interrupt: Syscall: Write: SetPalette: {hex(start)} {len(colours)}")
+            elif self.EBX == 6: # Blit a CX by DX block of colour codes from the data segment, offset ECX, to (AX, BX)
+                width, height = int(self.CX), int(self.DX)
+                self.screen.blit((int(self.AX), int(self.BX)), width, codes(self.ram.view(self.VarLoc + int(self.ECX), width * height)))
+
+                if self.debug:
+                    print(f"CPU: Interrupt: Syscall: Write: Blit: {width}x{height}")
+            elif self.EBX == 7: # Fill a CX by DX rectangle at (AX, BX)
+                colour = int(self.EDX)
+                if 0 <= colour < PALETTE_SIZE:
+                    self.screen.fill_rect((int(self.AX), int(self.BX)), (int(self.CX), int(self.DX)), colour)
+
+                if self.debug:
+                    print(f"CPU: Interrupt: Syscall: Write: FillRect: {hex(colour)}")
+            elif self.EBX == 8: # Draw a horizontal span CX pixels long from (AX, BX)
+                colour = int(self.EDX)
+                if 0 <= colour < PALETTE_SIZE:
+                    self.screen.fill_rect((int(self.AX), int(self.BX)), (int(self.CX), 1), colour)
+
+                if self.debug:
+                    print(f"CPU: Interrupt: Syscall: Write: HSpan: {hex(colour)}")
+        elif self.EAX == self.Sys_Open or self.EAX == self.Sys_Create: # Open (or create) the file named by EDX cells at VarLoc + ECX
+            path = self.ram.dump(self.VarLoc + self.ECX, self.EDX).decode("utf-32-le", "surrogatepass")
+            try:
+                self.RS = self.files.open(path, self.EAX == self.Sys_Create) # Its descriptor
+            except (OSError, ValueError) as e:
+                self.RS = 0
+                if self.debug:
+                    print("CPU: Interrupt: Syscall: Open: %s: %s" % (path, e))
+
+            if self.debug:
+                print("CPU: Interrupt: Syscall: Open: %s -> %s" % (path, self.RS))
+        elif self.EAX == self.Sys_Read: # Read up to EDX cells from descriptor EBX to VarLoc + ECX
+            start, end = self.__Cells(self.VarLoc + self.ECX, self.EDX)
+            try:
+                with memoryview(self.memory) as cells:
+                    count = self.files.read(self.EBX, cells[start:end].cast("B")) // 4
+            except OSError:
+                count = 0
+
+            if sys.byteorder == "big":
+                swapped = array(CELL_TYPE, self.memory[start:start + count])
+                swapped.byteswap()
+                self.memory[start:start + count] = swapped
+
+            self.__Written(start, start + count)
+            self.RS = count # Cells read, 0 at the end of the file
+
+            if self.debug:
+                print("CPU: Interrupt: Syscall: Read: %s -> %d" % (self.EBX, count))
+        elif self.EAX == self.Sys_Close: # Close descriptor EBX
+            try:
+                self.RS = 1 if self.files.close(self.EBX) else 0
+            except OSError:
+                self.RS = 0
+
+            if self.debug:
+                print("CPU: Interrupt: Syscall: Close: %s" % self.EBX)
+        elif self.EAX == self.Sys_Seek: # Move descriptor EBX to ECX cells from the start, its position or the end (EDX 0, 1, 2)
+            try:
+                self.RS = self.files.seek(self.EBX, self.ECX * 4, self.EDX) // 4 # The new position in cells
+            except OSError:
+                self.RS = 0
+
+            if self.debug:
+                print("CPU: Interrupt: Syscall: Seek: %s -> %d" % (self.EBX, self.RS))
+        elif self.EAX == self.Sys_Core: # Which core of a `machine.Machine` this is, 0 on its own
+            self.RS = self.core
+
+            if self.debug:
+                print("CPU: Interrupt: Syscall: Core: %d" % self.core)
         elif self.EAX == self.Sys_RestartSyscall: # Restart cpu
             if self.debug:
                 print("CPU: Interrupt: Syscall: Restart")
             self.R = True
-            self.LoadMemory(self.original_memory)
+            self.__RestoreMemory(self.original_memory, self.boot) # Undo everything the program wrote
 
             self.PC = 0 # Program counter
 
             # Registers
-            self.EAX = 0 # Extended (32-bit), A, X (General Purpose)
-            self.EBX = 0
-            self.ECX = 0
-            self.EDX = 0
+            self.regs[:] = [0] * REGISTER_COUNT
 
             self.EDI = 0 # Destination index
             self.ESI = 0 # Source index
             self.ESP = 0 # Stack pointer
             self.EBP = 0 # Address offset
-
-            self.AX = 0 # 16-bits
-            self.BX = 0
-            self.CX = 0
-            self.DX = 0
-            self.BAX = 0 # B (8-bit), A, X (General Purpose)
-            self.BBX = 0
-            self.BCX = 0
-            self.BDX = 0
-
-            self.RS = 0 # Result register
-            clear(self.screen)
-            set_colour()
-            reset_scroll()
+            self.screen.clear()
+            self.screen.set_colour()
+            self.screen.set_palette(0, DEFAULT_COLOURS)
+            self.screen.reset_scroll()
 
     def __HandleInterrupt(self) -> None:
-        if self.memory[self.IntLoc] == self.Syscall:
+        if self.interrupt == self.Syscall:
             self.__HandleSyscall()
         else:
-            self.__RaiseInterrupt(self.memory[self.IntLoc])
+            self.__RaiseInterrupt(self.interrupt)
 
         self.in_interrupt = True
         self.PS.E = 0
     
-    def Execute(self) -> Any:
-        current_header = "text"
-        data_index = 0
-
-        while self.PC < len(self.memory):
-            if self.PS.T:
-                self.__RaiseInterrupt(self.SingleStepInterrupt)
-
-            if self.PS.R:
-                self.PS.R = False
-                self.PS = Flags()
-                break
-
-            ins = self.__FetchByte()
-            var_data_len = self.VarLoc + data_index
-
-            if ins == HEADER_DATA:
-                current_header = "data"
-                continue
-            elif ins == HEADER_ROM:
-                current_header = "rom"
-                continue
-            elif ins == HEADER_TEXT:
-                current_header = "text"
-                continue
-            
-            if current_header == "text":
-                if ins == HEADER_DATA or ins == HEADER_ROM or ins == HEADER_TEXT:
-                    continue # Skip headers
+    def __OpNop(self):
+        pass # Do nothing lmao
+
+    def __OpBreakpoint(self):
+        self.__RaiseInterrupt(self.Breakpoint)
+
+    def __OpMov(self):
+        pc = self.PC
+        mode = self.memory[pc]
+
+        if mode == Addr_RegIm8:
+            reg = self.memory[pc + 1]
+            value = self.memory[pc + 2]
+            self.PC = pc + 3
+        elif mode == Addr_RegIm16:
+            reg = self.memory[pc + 1]
+            value = self.memory[pc + 2] << 8 | self.memory[pc + 3]
+            self.PC = pc + 4
+        else:
+            self.PC = pc + 1
+            return
 
-                if ins == NOP:
-                    pass # Do nothing lmao
+        if Code_EAX <= value <= Code_RS:
+            value = self.regs[value - Code_EAX]
 
-                elif ins == 0xCC:
-                    self.__RaiseInterrupt(self.Breakpoint)
+        if Code_EAX <= reg <= Code_RS:
+            self.regs[reg - Code_EAX] = value
 
-                elif ins == MOV:
-                    mode = self.__FetchByte()
+    def __OpInt(self):
+        int_code = self.__FetchByte()
+        self.interrupt = int_code # Read back from here, other cores can write the cell meanwhile
+        self.memory[self.IntLoc] = int_code
+        self.__Written(self.IntLoc, self.IntLoc + 1)
+        self.__HandleInterrupt()
 
-                    if mode == Addr_RegIm8:
-                        reg = self.__FetchByte()
-                        value = self.__FetchByte()
+    def __OpJmp(self):
+        self.PC = self.memory[self.PC]
 
-                        is_reg = self.__IsReg(value)
+    def __FetchOperands(self) -> tuple:
+        """Fetch two ALU operands, resolving register codes to their values.
+        """
+        value1 = self.memory[self.PC]
+        value2 = self.memory[self.PC + 1]
+        self.PC += 2
 
-                        if is_reg[0] == True:
-                            self.__WriteReg(reg, is_reg[1])
-                        else:
-                            self.__WriteReg(reg, value)
-                    elif mode == Addr_RegIm16:
-                        reg = self.__FetchByte()
-                        value = self.__FetchWord()
+        if Code_EAX <= value1 <= Code_RS:
+            value1 = self.regs[value1 - Code_EAX]
+        if Code_EAX <= value2 <= Code_RS:
+            value2 = self.regs[value2 - Code_EAX]
 
-                        is_reg = self.__IsReg(value)
+        return value1, value2
 
-                        if is_reg[0] == True:
-                            self.__WriteReg(reg, is_reg[1])
-                        else:
-                            self.__WriteReg(reg, value)
+    def __OpAdd(self):
+        number1, number2 = self.__FetchOperands()
+        self.regs[RS] = number1 + number2
 
-                elif ins == INT:
-                    int_code = self.__FetchByte()
-                    self.memory[self.IntLoc] = int_code
-                    self.__HandleInterrupt()
+    def __OpSub(self):
+        number1, number2 = self.__FetchOperands()
+        self.regs[RS] = number1 - number2
 
-                elif ins == JMP:
-                    value = self.__FetchByte()
-                    self.PC = value
+    def __OpMul(self):
+        number1, number2 = self.__FetchOperands()
+        self.regs[RS] = number1 * number2
 
-                elif ins == ADD:
-                    value1 = self.__FetchByte()
-                    value2 = self.__FetchByte()
+    def __OpDiv(self):
+        number1, number2 = self.__FetchOperands()
+        self.regs[RS] = number1 / number2
 
-                    is_reg1 = self.__IsReg(value1)
-                    is_reg2 = self.__IsReg(value2)
+    def __OpInc(self):
+        reg = self.memory[self.PC]
+        self.PC += 1
 
-                    number1 = 0
-                    number2 = 0
+        if Code_EAX <= reg <= Code_EDX or reg == Code_RS:
+            self.regs[reg - Code_EAX] += 1
 
-                    if is_reg1[0] == False:
-                        number1 = value1
-                    elif is_reg1[0] == True:
-                        number1 = is_reg1[1]
-
-                    if is_reg2[0] == False:
-                        number2 = value2
-                    elif is_reg2[0] == True:
-                        number2 = is_reg2[1]
+    def __OpDec(self):
+        reg = self.memory[self.PC]
+        self.PC += 1
 
-                    self.__WriteReg(Code_RS, number1 + number2)
-
-                elif ins == SUB:
-                    value1 = self.__FetchByte()
-                    value2 = self.__FetchByte()
-
-                    is_reg1 = self.__IsReg(value1)
-                    is_reg2 = self.__IsReg(value2)
-
-                    number1 = 0
-                    number2 = 0
+        if Code_EAX <= reg <= Code_EDX or reg == Code_RS:
+            self.regs[reg - Code_EAX] -= 1
 
-                    if is_reg1[0] == False:
-                        number1 = value1
-                    elif is_reg1[0] == True:
-                        number1 = is_reg1[1]
+    def __OpJne(self):
+        pc = self.PC
 
-                    if is_reg2[0] == False:
-                        number2 = value2
-                    elif is_reg2[0] == True:
-                        number2 = is_reg2[1]
+        if self.regs[RS] != self.memory[pc]:
+            self.PC = self.memory[pc + 1]
+        else:
+            self.PC = pc + 2
 
-                    self.__WriteReg(Code_RS, number1 - number2)
+    def __OpJe(self):
+        pc = self.PC
 
-                elif ins == MUL:
-                    value1 = self.__FetchByte()
-                    value2 = self.__FetchByte()
+        if self.regs[RS] == self.memory[pc]:
+            self.PC = self.memory[pc + 1]
+        else:
+            self.PC = pc + 2
 
-                    is_reg1 = self.__IsReg(value1)
-                    is_reg2 = self.__IsReg(value2)
+    def __OpJz(self):
+        if self.regs[RS] == 0:
+            self.PC = self.memory[self.PC]
+        else:
+            self.PC += 1
+
+    def __OpJnz(self):
+        if self.regs[RS] != 0:
+            self.PC = self.memory[self.PC]
+        else:
+            self.PC += 1
 
-                    number1 = 0
-                    number2 = 0
+    def __OpJmpWord(self):
+        pc = self.PC
+        self.PC = self.memory[pc] << 8 | self.memory[pc + 1]
 
-                    if is_reg1[0] == False:
-                        number1 = value1
-                    elif is_reg1[0] == True:
-                        number1 = is_reg1[1]
+    def __OpJneWord(self):
+        pc = self.PC
 
-                    if is_reg2[0] == False:
-                        number2 = value2
-                    elif is_reg2[0] == True:
-                        number2 = is_reg2[1]
+        if self.regs[RS] != self.memory[pc]:
+            self.PC = self.memory[pc + 1] << 8 | self.memory[pc + 2]
+        else:
+            self.PC = pc + 3
 
-                    self.__WriteReg(Code_RS, number1 * number2)
+    def __OpJeWord(self):
+        pc = self.PC
 
-                elif ins == DIV:
-                    value1 = self.__FetchByte()
-                    value2 = self.__FetchByte()
+        if self.regs[RS] == self.memory[pc]:
+            self.PC = self.memory[pc + 1] << 8 | self.memory[pc + 2]
+        else:
+            self.PC = pc + 3
 
-                    is_reg1 = self.__IsReg(value1)
-                    is_reg2 = self.__IsReg(value2)
+    def __OpJzWord(self):
+        pc = self.PC
 
-                    number1 = 0
-                    number2 = 0
+        if self.regs[RS] == 0:
+            self.PC = self.memory[pc] << 8 | self.memory[pc + 1]
+        else:
+            self.PC = pc + 2
 
-                    if is_reg1[0] == False:
-                        number1 = value1
-                    elif is_reg1[0] == True:
-                        number1 = is_reg1[1]
+    def __OpJnzWord(self):
+        pc = self.PC
 
-                    if is_reg2[0] == False:
-                        number2 = value2
-                    elif is_reg2[0] == True:
-                        number2 = is_reg2[1]
+        if self.regs[RS] != 0:
+            self.PC = self.memory[pc] << 8 | self.memory[pc + 1]
+        else:
+            self.PC = pc + 2
 
-                    self.__WriteReg(Code_RS, number1 / number2)
+    def __OpAnd(self):
+        number1, number2 = self.__FetchOperands()
 
-                elif ins == INC:
-                    reg = self.__FetchByte()
+        if number1 > 0 and number2 > 0:
+            self.regs[RS] = 1
+        else:
+            self.regs[RS] = 0
 
-                    if reg == Code_EAX:
-                        self.EAX += 1
-                    elif reg == Code_EBX:
-                        self.EBX += 1
-                    elif reg == Code_ECX:
-                        self.ECX += 1
-                    elif reg == Code_EDX:
-                        self.EDX += 1
-                    elif reg == Code_RS:
-                        self.RS += 1
+    def __OpUld(self):
+        for i in range(self.VarLoc, self.VarLoc+self.data_index):
+            self.memory[i] = 0x0
+        self.__Written(self.VarLoc, self.VarLoc + self.data_index)
+        self.data_index = 0x0
 
-                elif ins == DEC:
-                    reg = self.__FetchByte()
+    def __OpSegment(self, segment):
+        # A linked section header, run in place of the section
+        if segment.header == HEADER_DATA:
+            cells = array(CELL_TYPE, [cell for cell in self.memory[segment.start:segment.end] if cell])
+            start = self.VarLoc + self.data_index
 
-                    if reg == Code_EAX:
-                        self.EAX -= 1
-                    elif reg == Code_EBX:
-                        self.EBX -= 1
-                    elif reg == Code_ECX:
-                        self.ECX -= 1
-                    elif reg == Code_EDX:
-                        self.EDX -= 1
-                    elif reg == Code_RS:
-                        self.RS -= 1
+            if start + len(cells) > len(self.memory):
+                raise IndexError("data segment at %s does not fit in memory" % describe(self.source_map, segment.start - 1))
 
-                elif ins == JNE:
-                    value = self.__FetchByte()
-                    jmp_loc = self.__FetchByte()
+            self.memory[start:start + len(cells)] = cells
+            self.__Written(start, start + len(cells))
+            self.data_index += len(cells)
 
-                    if self.RS != value:
-                        self.PC = jmp_loc
-
-                elif ins == JE:
-                    value = self.__FetchByte()
-                    jmp_loc = self.__FetchByte()
-
-                    if self.RS == value:
-                        self.PC = jmp_loc
-
-                elif ins == JZ:
-                    jmp_loc = self.__FetchByte()
-
-                    if self.RS == 0:
-                        self.PC = jmp_loc
+        if segment.header != HEADER_TEXT:
+            self.PC = segment.end
 
-                elif ins == JNZ:
-                    jmp_loc = self.__FetchByte()
-
-                    if self.RS != 0:
-                        self.PC = jmp_loc
+    def __OpHlt(self):
+        return True # Stop the CPU
 
-                elif ins == AND:
-                    value1 = self.__FetchByte()
-                    value2 = self.__FetchByte()
-
-                    is_reg1 = self.__IsReg(value1)
-                    is_reg2 = self.__IsReg(value2)
-
-                    number1 = 0
-                    number2 = 0
-
-                    if is_reg1[0] == False:
-                        number1 = value1
-                    elif is_reg1[0] == True:
-                        number1 = is_reg1[1]
-
-                    if is_reg2[0] == False:
-                        number2 = value2
-                    elif is_reg2[0] == True:
-                        number2 = is_reg2[1]
-
-                    if number1 > 0 and number2 > 0:
-                        self.__WriteReg(Code_RS, 1)
-                    else:
-                        self.__WriteReg(Code_RS, 0)
-
-                elif ins == ULD:
-                    for i in range(self.VarLoc, self.VarLoc+data_index):
-                        self.memory[i] = 0x0
-                    data_index = 0x0
-
-                elif ins == HLT:
-                    break # Stop the CPU
+    def __OpInvalid(self):
+        # Invalid Opcode
+        ins = self.memory[self.PC - 1]
+        var_data_len = self.VarLoc + self.data_index
+
+        if self.PC - 1 != self.IntLoc and (self.PC - 1 < self.VarLoc or self.PC - 1 > var_data_len):
+            print("InvalidOpcode: %s at address %s" % (hex(ins), describe(self.source_map, self.PC-1)))
+
+    def __BuildDispatch(self) -> list:
+        """Build the opcode dispatch table. Every slot without a handler, including the
+        reserved INB, OUTB, OR, CMP and NOR opcodes, raises the invalid opcode handler.
+        """
+        ops = [self.__OpInvalid] * OPCODE_COUNT
+
+        ops[NOP] = self.__OpNop
+        ops[INT] = self.__OpInt
+        ops[HLT] = self.__OpHlt
+        ops[MOV] = self.__OpMov
+        ops[JNE] = self.__OpJne
+        ops[JE] = self.__OpJe
+        ops[JNZ] = self.__OpJnz
+        ops[JZ] = self.__OpJz
+        ops[ADD] = self.__OpAdd
+        ops[SUB] = self.__OpSub
+        ops[MUL] = self.__OpMul
+        ops[DIV] = self.__OpDiv
+        ops[JMP] = self.__OpJmp
+        ops[INB] = self.__OpInvalid
+        ops[OUTB] = self.__OpInvalid
+        ops[AND] = self.__OpAnd
+        ops[OR] = self.__OpInvalid
+        ops[CMP] = self.__OpInvalid
+        ops[NOR] = self.__OpInvalid
+        ops[INC] = self.__OpInc
+        ops[DEC] = self.__OpDec
+        ops[ULD] = self.__OpUld
+        ops[JNEW] = self.__OpJneWord
+        ops[JEW] = self.__OpJeWord
+        ops[JNZW] = self.__OpJnzWord
+        ops[JZW] = self.__OpJzWord
+        ops[JMPW] = self.__OpJmpWord
+        ops[BRK] = self.__OpBreakpoint
+
+        return ops
+
+    def __Step(self) -> bool:
+        """Fetch and run a single instruction. Returns True if the CPU halted.
+        """
+        ins = self.memory[self.PC]
+        self.PC += 1
+
+        if ins < OPCODE_COUNT:
+            return self.__ops[ins]()
+
+        segment = self.links.get(self.PC - 1)
+        if segment is None:
+            return self.__OpInvalid()
+
+        return self.__OpSegment(segment)
+
+    def __Translate(self, pc: int):
+        block, end = translate(self.memory, self.regs, pc)
+        self.blocks.add(pc, end, block)
+
+        return block
+
+    def Execute(self, budget: int = None, observer=None) -> str:
+        """Run until the CPU stops and return why:
+
+            "halt"     a HLT instruction
+            "end"      the PC ran off the end of memory
+            "restart"  the restart flag was set
+            "budget"   `budget` instructions were retired
+
+        The instructions retired and cycles run are left in `instructions_retired` and
+        `cycles`, and `clock` paces the run and measures its effective clock rate.
+
+        With an observer (a `profiler.Profiler` or `trace.Recorder`), the program runs on a
+        separate loop that hands it every instruction instead. An observer with a `block`
+        method is handed each predecoded block once it has run instead of its instructions.
+        """
+        if observer is not None:
+            return self.__ExecuteObserved(budget, observer)
+
+        blocks = self.blocks.blocks
+        ops = self.__ops
+        memory = self.memory
+        size = len(memory)
+        flags = self.PS # Only replaced by a restart, which ends the run
+        clock = self.clock
+        limit = float("inf") if budget is None else budget
+        retired = 0
+        cycles = 0
+        sync = clock.start(cycles)
+        stop = 0 # Blocks that end by here run back to back, nothing else can be due before it
+        reason = "end"
+
+        try:
+            while self.PC < size:
+                block = None
+                if self.predecode:
+                    block = blocks.get(self.PC)
+                    if block is None:
+                        block = self.__Translate(self.PC)
+
+                    if block and retired + block[3] <= stop:
+                        block_ops, jump, end, count, block_cycles, _ = block
+                        for op in block_ops:
+                            op()
+
+                        self.PC = jump() if jump else end
+                        retired += count
+                        cycles += block_cycles
+                        continue
+
+                if flags.T:
+                    self.__RaiseInterrupt(self.SingleStepInterrupt)
+
+                if flags.R:
+                    flags.R = False
+                    self.PS = Flags()
+                    reason = "restart"
+                    break
+
+                if retired >= limit:
+                    reason = "budget"
+                    break
+
+                if cycles >= sync:
+                    sync = clock.sync(cycles)
+
+                if block and not flags.T:
+                    # Blocks only change registers and memory, so the next check is due at the
+                    # budget or the clock sync, whichever comes first. The sync may be up to a
+                    # block late, near the budget single step to stop exactly on it
+                    stop = min(limit, retired + max(BLOCK_LIMIT, (sync - cycles) / MAX_CYCLES))
+                    if retired + block[3] <= stop:
+                        continue
+
+                ins = memory[self.PC]
+                retired += 1
+                if ins < OPCODE_COUNT:
+                    cycles += CYCLES[ins]
+                    self.PC += 1
+                    halted = ops[ins]()
                 else:
-                    # Invalid Opcode                                                                                                                
-                    if self.PC - 1 != self.IntLoc and (self.PC - 1 < self.VarLoc or self.PC - 1 > var_data_len):
-                        print("InvalidOpcode: %s at address %s" % (hex(ins), hex(self.PC-1)))
-            elif current_header == "data":
-                if ins == 0x0:                                                                                                              
-                    continue
-                
-                self.memory[self.VarLoc + data_index] = ins
-                data_index += 1
\ No newline at end of file
+                    cycles += SEGMENT_CYCLES
+                    halted = self.__Step()
+
+                if halted:
+                    reason = "halt"
+                    break
+
+                stop = retired # Check the flags again before the next block
+        finally:
+            self.instructions_retired = retired
+            self.cycles = cycles
+            clock.stop(cycles)
+
+        return reason
+
+    def __ExecuteObserved(self, budget: int, observer) -> str:
+        # `Execute` for an observer. It runs each instruction through
+        # `observer.step(pc, ins, step)`, which calls `step()` and returns True on a halt, and
+        # is told about each block with `observer.block(pc, block)` if it can take them
+        blocks = self.blocks.blocks
+        ran = getattr(observer, "block", None) if self.predecode else None
+        memory = self.memory
+        size = len(memory)
+        flags = self.PS
+        clock = self.clock
+        limit = float("inf") if budget is None else budget
+        retired = 0
+        cycles = 0
+        sync = clock.start(cycles)
+        reason = "end"
+
+        step = self.__Step
+        observe = observer.step
+        observer.start(self)
+
+        try:
+            while self.PC < size:
+                if flags.T:
+                    self.__RaiseInterrupt(self.SingleStepInterrupt)
+
+                if flags.R:
+                    flags.R = False
+                    self.PS = Flags()
+                    reason = "restart"
+                    break
+
+                if retired >= limit:
+                    reason = "budget"
+                    break
+
+                if cycles >= sync:
+                    sync = clock.sync(cycles)
+
+                pc = self.PC
+
+                if ran is not None and not flags.T:
+                    block = blocks.get(pc)
+                    if block is None:
+                        block = self.__Translate(pc)
+
+                    if block and retired + block[3] <= limit:
+                        block_ops, jump, end, count, block_cycles, _ = block
+                        for op in block_ops:
+                            op()
+
+                        self.PC = jump() if jump else end
+                        retired += count
+                        cycles += block_cycles
+                        ran(pc, block)
+                        continue
+
+                ins = memory[pc]
+
+                retired += 1
+                cycles += CYCLES[ins] if ins < OPCODE_COUNT else SEGMENT_CYCLES
+
+                if observe(pc, ins, step):
+                    reason = "halt"
+                    break
+        finally:
+            self.instructions_retired = retired
+            self.cycles = cycles
+            clock.stop(cycles)
+            observer.stop(retired)
+
+        return reason
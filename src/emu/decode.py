@@ -0,0 +1,295 @@
+"""The decode module for the SPK-8 emulator. Translates straight-line runs of text into
+predecoded basic blocks so loops don't re-fetch and re-decode every instruction.
+
+A block is a tuple `(ops, jump, end, count, cycles, pcs)`:
+
+    ops    closures for the block's straight-line instructions, run in order
+    jump   closure returning the next PC for a trailing jump, or None
+    end    the PC after the block when `jump` is None
+    count  how many instructions the block retires, including the jump
+    cycles what those instructions cost, see `clock`
+    pcs    the PC of each of those instructions
+
+Anything that isn't straight-line (INT, HLT, ULD, data and rom headers, invalid opcodes...)
+ends the block and is left to the CPU's interpreter. Linked text headers do nothing, so they
+are skipped like NOP.
+"""
+from ins_codes import *
+from clock import cost
+from memory import PAGE_BITS # Blocks are indexed by memory page for invalidation
+
+
+BLOCK_LIMIT = 64 # Max instructions per block
+
+RS = Code_RS - Code_EAX
+
+
+class BlockCache:
+    def __init__(self):
+        self.blocks = {} # PC -> block, or False if the PC must be interpreted
+        self.pages = {} # page -> PCs of blocks that read from it
+
+    def add(self, pc: int, end: int, block):
+        """Cache `block`, decoded from the cells in [pc, end).
+        """
+        self.blocks[pc] = block or False
+
+        for page in range(pc >> PAGE_BITS, ((max(end, pc + 1) - 1) >> PAGE_BITS) + 1):
+            self.pages.setdefault(page, []).append(pc)
+
+    def invalidate(self, start: int, end: int):
+        """Drop every block decoded from a cell in [start, end).
+        """
+        if not self.pages:
+            return
+
+        for page in range(start >> PAGE_BITS, ((end - 1) >> PAGE_BITS) + 1):
+            for pc in self.pages.pop(page, ()):
+                self.blocks.pop(pc, None)
+
+    def clear(self):
+        self.blocks.clear()
+        self.pages.clear()
+
+
+def _reg(value: int):
+    """Return the register file slot for operand `value`, or None for an immediate.
+    """
+    if Code_EAX <= value <= Code_RS:
+        return value - Code_EAX
+    return None
+
+def _const(regs: list, dest: int, value):
+    def op():
+        regs[dest] = value
+    return op
+
+def _copy(regs: list, dest: int, src: int):
+    def op():
+        regs[dest] = regs[src]
+    return op
+
+def _step(regs: list, dest: int, amount: int):
+    def op():
+        regs[dest] += amount
+    return op
+
+def _alu(regs: list, ins: int, a, b, value1: int, value2: int):
+    """Build the closure for an ALU instruction. `a` and `b` are register slots or None
+    for immediates `value1` and `value2`. Returns None if it must be interpreted.
+    """
+    if a is None and b is None:
+        try:
+            if ins == ADD:
+                result = value1 + value2
+            elif ins == SUB:
+                result = value1 - value2
+            elif ins == MUL:
+                result = value1 * value2
+            elif ins == DIV:
+                result = value1 / value2
+            else:
+                result = 1 if value1 > 0 and value2 > 0 else 0
+        except ZeroDivisionError:
+            return None # Let the interpreter raise it at the right PC
+
+        return _const(regs, RS, result)
+
+    if ins in (ADD, MUL, AND) and a is None:
+        a, b, value1, value2 = b, a, value2, value1 # Commutative, keep the register first
+
+    if ins == ADD:
+        if b is None:
+            def op():
+                regs[RS] = regs[a] + value2
+        else:
+            def op():
+                regs[RS] = regs[a] + regs[b]
+
+    elif ins == SUB:
+        if a is None:
+            def op():
+                regs[RS] = value1 - regs[b]
+        elif b is None:
+            def op():
+                regs[RS] = regs[a] - value2
+        else:
+            def op():
+                regs[RS] = regs[a] - regs[b]
+
+    elif ins == MUL:
+        if b is None:
+            def op():
+                regs[RS] = regs[a] * value2
+        else:
+            def op():
+                regs[RS] = regs[a] * regs[b]
+
+    elif ins == DIV:
+        if a is None or b is not None or value2 == 0:
+            return None # May fault, let the interpreter raise it at the right PC
+        def op():
+            regs[RS] = regs[a] / value2
+
+    else: # AND
+        if b is None:
+            if value2 > 0:
+                def op():
+                    regs[RS] = 1 if regs[a] > 0 else 0
+            else:
+                return _const(regs, RS, 0)
+        else:
+            def op():
+                regs[RS] = 1 if regs[a] > 0 and regs[b] > 0 else 0
+
+    return op
+
+def _jump(regs: list, ins: int, value: int, target: int, fall: int):
+    if ins == JNE:
+        def jump():
+            return target if regs[RS] != value else fall
+    elif ins == JE:
+        def jump():
+            return target if regs[RS] == value else fall
+    elif ins == JZ:
+        def jump():
+            return target if regs[RS] == 0 else fall
+    else: # JNZ
+        def jump():
+            return target if regs[RS] != 0 else fall
+    return jump
+
+def translate(memory, regs: list, pc: int) -> tuple:
+    """Decode the basic block starting at `pc`.
+
+    Returns `(block, end)` where `end` is the address after the last cell read,
+    or `(None, pc + 1)` if the instruction at `pc` has to be interpreted.
+    """
+    size = len(memory)
+    ops = []
+    pcs = []
+    jump = None
+    target = None
+    addr = pc
+    count = 0
+    cycles = 0
+
+    while count < BLOCK_LIMIT and addr < size:
+        ins = memory[addr]
+        pcs.append(addr) # One too many if this one isn't decoded
+
+        if ins == NOP or ins == HEADER_TEXT:
+            addr += 1
+
+        elif ins == MOV:
+            if addr + 1 >= size:
+                break
+            mode = memory[addr + 1]
+
+            if mode == Addr_RegIm8:
+                if addr + 3 >= size:
+                    break
+                dest = _reg(memory[addr + 2])
+                value = memory[addr + 3]
+                addr += 4
+            elif mode == Addr_RegIm16:
+                if addr + 4 >= size:
+                    break
+                dest = _reg(memory[addr + 2])
+                value = memory[addr + 3] << 8 | memory[addr + 4]
+                addr += 5
+            else:
+                dest = None
+                addr += 2
+
+            if dest is not None:
+                src = _reg(value)
+                ops.append(_const(regs, dest, value) if src is None else _copy(regs, dest, src))
+
+        elif ins in (ADD, SUB, MUL, DIV, AND):
+            if addr + 2 >= size:
+                break
+            value1 = memory[addr + 1]
+            value2 = memory[addr + 2]
+
+            op = _alu(regs, ins, _reg(value1), _reg(value2), value1, value2)
+            if op is None:
+                break
+
+            ops.append(op)
+            addr += 3
+
+        elif ins == INC or ins == DEC:
+            if addr + 1 >= size:
+                break
+            reg = memory[addr + 1]
+
+            if Code_EAX <= reg <= Code_EDX or reg == Code_RS:
+                ops.append(_step(regs, reg - Code_EAX, 1 if ins == INC else -1))
+            addr += 2
+
+        elif ins == JMP:
+            if addr + 1 >= size:
+                break
+            target = memory[addr + 1]
+            addr += 2
+            count += 1
+            cycles += cost(ins)
+            break
+
+        elif ins == JMPW:
+            if addr + 2 >= size:
+                break
+            target = memory[addr + 1] << 8 | memory[addr + 2]
+            addr += 3
+            count += 1
+            cycles += cost(ins)
+            break
+
+        elif ins == JNEW or ins == JEW:
+            if addr + 3 >= size:
+                break
+            jmp_loc = memory[addr + 2] << 8 | memory[addr + 3]
+            jump = _jump(regs, JNE if ins == JNEW else JE, memory[addr + 1], jmp_loc, addr + 4)
+            addr += 4
+            count += 1
+            cycles += cost(ins)
+            break
+
+        elif ins == JZW or ins == JNZW:
+            if addr + 2 >= size:
+                break
+            jump = _jump(regs, JZ if ins == JZW else JNZ, 0, memory[addr + 1] << 8 | memory[addr + 2], addr + 3)
+            addr += 3
+            count += 1
+            cycles += cost(ins)
+            break
+
+        elif ins == JNE or ins == JE:
+            if addr + 2 >= size:
+                break
+            jump = _jump(regs, ins, memory[addr + 1], memory[addr + 2], addr + 3)
+            addr += 3
+            count += 1
+            cycles += cost(ins)
+            break
+
+        elif ins == JZ or ins == JNZ:
+            if addr + 1 >= size:
+                break
+            jump = _jump(regs, ins, 0, memory[addr + 1], addr + 2)
+            addr += 2
+            count += 1
+            cycles += cost(ins)
+            break
+
+        else:
+            break # Not straight-line, the interpreter handles it
+
+        count += 1
+        cycles += cost(ins)
+
+    if count == 0:
+        return None, pc + 1
+
+    return (tuple(ops), jump, addr if target is None else target, count, cycles, tuple(pcs[:count])), addr
@@ -0,0 +1,305 @@
+"""The framebuffer module for the SPK-8 emulator. Holds the screen as an indexed-colour pixel
+buffer plus a character-cell text buffer, and renders it without a display server.
+
+Displays (the Tk `App` in `screen.py` and `Headless` here) wrap a `FrameBuffer` and expose
+the drawing calls the CPU makes: `writes`, `clear`, `draw_pix`, `fill_rect`, `blit`,
+`set_colour`, `set_palette` and `reset_scroll`, plus `snapshot` and `restore` for
+save states. Colours are palette codes.
+"""
+import struct
+import zlib
+
+from palette import Palette, BLACK, WHITE
+
+
+WIDTH = 640
+HEIGHT = 480
+
+FONT_SIZE = 20
+CELL_SIZE = int(FONT_SIZE * 0.75) # Pixels between text cells
+
+TEXT_COLUMNS = 81 # The cursor wraps once it moves past column 80
+TEXT_ROWS = 40
+
+ALL_CELLS = frozenset((row, column) for row in range(TEXT_ROWS) for column in range(TEXT_COLUMNS))
+
+class FrameBuffer:
+    __slots__ = (
+        "width", "height", "pixels", "background", "palette", "text", "text_x", "text_y", "text_colour",
+        "dirty", "dirty_cells", "scrolled", "cleared"
+    )
+
+    def __init__(self, width: int = WIDTH, height: int = HEIGHT):
+        self.width = width
+        self.height = height
+
+        self.pixels = bytearray(width * height) # One colour code per pixel
+        self.background = BLACK
+        self.palette = Palette()
+
+        self.text = [[None] * TEXT_COLUMNS for _ in range(TEXT_ROWS)] # (char, colour code) per cell
+        self.text_x = 0
+        self.text_y = 0
+        self.text_colour = WHITE
+
+        self.dirty = (0, 0, width, height) # Pixel rect changed since the last frame
+        self.dirty_cells = set() # (row, column) of text cells changed since the last frame
+        self.scrolled = False # The text layer moved, every cell must be redrawn
+        self.cleared = True # Everything, including the text layer, must be redrawn
+
+    def __mark(self, x0: int, y0: int, x1: int, y1: int):
+        if self.dirty is None:
+            self.dirty = (x0, y0, x1, y1)
+        else:
+            dx0, dy0, dx1, dy1 = self.dirty
+            self.dirty = (min(dx0, x0), min(dy0, y0), max(dx1, x1), max(dy1, y1))
+
+    def clear(self, colour: int):
+        self.pixels[:] = bytes([colour]) * len(self.pixels)
+        self.background = colour
+
+        for row in self.text:
+            row[:] = [None] * TEXT_COLUMNS
+
+        self.dirty = (0, 0, self.width, self.height)
+        self.dirty_cells.clear()
+        self.scrolled = False
+        self.cleared = True
+
+    def set_palette(self, start: int, colours: list):
+        """Swap palette entries. Stored codes don't change, so only the next frame is redrawn.
+        """
+        self.palette.set(start, colours)
+
+        self.dirty = (0, 0, self.width, self.height)
+        self.dirty_cells.update(
+            (y, x) for y, row in enumerate(self.text) for x, cell in enumerate(row) if cell is not None
+        )
+
+    def draw_pixel(self, x: int, y: int, colour: int):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.pixels[y * self.width + x] = colour
+            self.__mark(x, y, x + 1, y + 1)
+
+    def fill_rect(self, x: int, y: int, width: int, height: int, colour: int):
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        if x0 == 0 and x1 == self.width: # Whole rows are one contiguous run
+            self.pixels[y0 * self.width:y1 * self.width] = bytes([colour]) * ((y1 - y0) * self.width)
+        else:
+            span = bytes([colour]) * (x1 - x0)
+            for row in range(y0 * self.width + x0, y1 * self.width + x0, self.width):
+                self.pixels[row:row + x1 - x0] = span
+
+        self.__mark(x0, y0, x1, y1)
+
+    def blit(self, x: int, y: int, width: int, codes: bytes):
+        """Copy rows of `width` palette codes to (x, y), clipped to the screen.
+        """
+        if width <= 0:
+            return
+        height = len(codes) // width
+
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        if x0 == x and width == x1 - x0 == self.width:
+            self.pixels[y0 * self.width:y1 * self.width] = codes[(y0 - y) * width:(y1 - y) * width]
+        else:
+            src = (y0 - y) * width + (x0 - x)
+            for row in range(y0 * self.width + x0, y1 * self.width + x0, self.width):
+                self.pixels[row:row + x1 - x0] = codes[src:src + x1 - x0]
+                src += width
+
+        self.__mark(x0, y0, x1, y1)
+
+    def write_text(self, text: str):
+        """Write `text` at the cursor a line at a time. A newline, or running past the last
+        column, moves the cursor to the start of the next line.
+        """
+        colour = self.text_colour
+
+        while text:
+            x = self.text_x
+            room = TEXT_COLUMNS - x
+            end = text.find("\n", 0, room) + 1 or min(room, len(text)) # Up to and including a newline
+
+            chunk = text[:end]
+            text = text[end:]
+
+            self.text[self.text_y][x:x + end] = [(char, colour) for char in chunk]
+            if not self.scrolled:
+                self.dirty_cells.update((self.text_y, column) for column in range(x, x + end))
+
+            self.text_x += end
+            if chunk[-1] == "\n" or self.text_x >= TEXT_COLUMNS:
+                self.scroll_up()
+
+    def scroll_up(self, lines: int = 1):
+        """Move the cursor down `lines` lines. Past the last row, the text layer scrolls up
+        by whole lines instead.
+        """
+        self.text_y += lines
+        self.text_x = 0
+
+        if self.text_y >= TEXT_ROWS:
+            count = min(self.text_y - TEXT_ROWS + 1, TEXT_ROWS)
+
+            del self.text[:count]
+            self.text.extend([None] * TEXT_COLUMNS for _ in range(count))
+
+            self.text_y = TEXT_ROWS - 1
+            self.scrolled = True
+
+    def reset_scroll(self):
+        self.text_y = 0
+        self.text_x = 0
+
+    def snapshot(self) -> tuple:
+        """Return a copy of everything on screen, for `restore`.
+        """
+        return (
+            bytes(self.pixels), self.background, list(self.palette.colours),
+            [list(row) for row in self.text], self.text_x, self.text_y, self.text_colour
+        )
+
+    def restore(self, state: tuple):
+        pixels, self.background, colours, text, self.text_x, self.text_y, self.text_colour = state
+
+        self.pixels[:] = pixels
+        self.palette.set(0, colours)
+        self.text = [list(row) for row in text]
+
+        self.dirty = (0, 0, self.width, self.height)
+        self.dirty_cells = set(ALL_CELLS)
+        self.scrolled = False
+        self.cleared = True
+
+    def take_dirty(self) -> tuple:
+        """Return and reset `(pixel rect or None, dirty text cells, cleared)` for the next frame.
+        """
+        frame = (self.dirty, ALL_CELLS if self.scrolled else self.dirty_cells, self.cleared)
+
+        self.dirty = None
+        self.dirty_cells = set()
+        self.scrolled = False
+        self.cleared = False
+
+        return frame
+
+    def rgb(self, x0: int = 0, y0: int = 0, x1: int = None, y1: int = None) -> bytes:
+        """Return the pixels in the rect as packed 8-bit RGB.
+        """
+        if x1 is None:
+            x1 = self.width
+        if y1 is None:
+            y1 = self.height
+
+        if x0 == 0 and x1 == self.width:
+            codes = bytes(self.pixels[y0 * self.width:y1 * self.width])
+        else:
+            codes = b"".join(self.pixels[y * self.width + x0:y * self.width + x1] for y in range(y0, y1))
+
+        out = bytearray(len(codes) * 3)
+        for channel, table in enumerate(self.palette.channels):
+            out[channel::3] = codes.translate(table)
+
+        return bytes(out)
+
+    def lines(self) -> list:
+        """Return the text layer as one string per row, without trailing blanks.
+        """
+        return ["".join(" " if cell is None or cell[0] == "\n" else cell[0] for cell in row).rstrip() for row in self.text]
+
+
+def to_ppm(framebuffer: FrameBuffer) -> bytes:
+    """Encode the pixel layer as a binary PPM (P6) image.
+    """
+    return b"P6 %d %d 255\n" % (framebuffer.width, framebuffer.height) + framebuffer.rgb()
+
+def to_png(framebuffer: FrameBuffer) -> bytes:
+    """Encode the pixel layer as an 8-bit RGB PNG image.
+    """
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rgb = framebuffer.rgb()
+    stride = framebuffer.width * 3
+    rows = b"".join(b"\x00" + rgb[y * stride:(y + 1) * stride] for y in range(framebuffer.height))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", framebuffer.width, framebuffer.height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+def save_image(framebuffer: FrameBuffer, path: str):
+    """Save the pixel layer, as PNG unless `path` ends in `.ppm`.
+    """
+    data = to_ppm(framebuffer) if path.lower().endswith(".ppm") else to_png(framebuffer)
+
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class Headless:
+    """A display with no window. Drawing only touches the framebuffer, which can be saved
+    as a PNG or PPM file or read back as raw bytes.
+
+    If `mirror` is a text file, everything the program writes is copied to it as well.
+    """
+    __slots__ = ("framebuffer", "mirror")
+
+    def __init__(self, mirror=None):
+        self.framebuffer = FrameBuffer()
+        self.mirror = mirror
+
+    def callback(self):
+        pass # No window to close
+
+    def writes(self, text: str):
+        self.framebuffer.write_text(text)
+
+        if self.mirror is not None:
+            self.mirror.write(text)
+
+    def clear(self, colour: int = BLACK):
+        self.framebuffer.clear(colour)
+
+    def draw_pix(self, pos: tuple, colour: int = WHITE):
+        self.framebuffer.draw_pixel(pos[0], pos[1], colour)
+
+    def fill_rect(self, pos: tuple, size: tuple, colour: int = WHITE):
+        self.framebuffer.fill_rect(pos[0], pos[1], size[0], size[1], colour)
+
+    def blit(self, pos: tuple, width: int, codes: bytes):
+        self.framebuffer.blit(pos[0], pos[1], width, codes)
+
+    def set_colour(self, colour: int = WHITE):
+        self.framebuffer.text_colour = colour
+
+    def set_palette(self, start: int, colours: list):
+        self.framebuffer.set_palette(start, colours)
+
+    def reset_scroll(self):
+        self.framebuffer.reset_scroll()
+
+    def snapshot(self) -> tuple:
+        return self.framebuffer.snapshot()
+
+    def restore(self, state: tuple):
+        self.framebuffer.restore(state)
+
+    def tobytes(self) -> bytes:
+        """Return the pixel layer as packed RGB.
+        """
+        return self.framebuffer.rgb()
+
+    def save(self, path: str):
+        save_image(self.framebuffer, path)
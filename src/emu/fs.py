@@ -1,60 +1,907 @@
-"""The filesystem module for the SPK-8 emulator. Includes functions for emulating a virtual filesystem and interacting with it.
+"""The filesystem module for the SPK-8 emulator. Keeps the virtual filesystem in a single disk
+image, `fs.img` by default, mapped into memory with `mmap`. Files persist between runs, and an
+operation only touches the blocks it reads or writes, however big the filesystem is.
+
+A disk image (version 1) is a run of `BLOCK_SIZE` blocks:
+
+    superblock   magic b"SPK8FS", u16 version, u32 block size, block count and inode count,
+                 then the first block of the journal, bitmap, inode table and data
+    journal      `JOURNAL_BLOCKS` blocks: a header naming the metadata blocks of the last
+                 transaction, then their new contents
+    bitmap       one bit per block, set if the block is in use
+    inodes       `INODE_SIZE` bytes each: kind, parent directory, size in bytes, then up to
+                 `EXTENTS` (start, length) runs of blocks and a block holding any more runs
+    data         file contents and directories
+
+A directory's contents are `DIRENT` entries: u32 inode (0 for a free slot), u8 name length and
+the UTF-8 name. A directory is indexed by name in memory the first time it's looked in.
+
+Metadata (the bitmap, inodes and directories) only changes through a transaction: the blocks
+an operation changed are written to the journal, then to where they belong, and a journal
+left behind by a crash is replayed when the disk is opened again. File data is written in
+place before the metadata that points at it. Files grow by runs of blocks next to their last
+one, so appending rarely adds a run or touches the bitmap.
+
+Files hold cells like memory does, as little-endian u32s, so moving them to and from guest
+memory is a byte copy. Text is stored one character per cell.
 """
-import json
+import errno
+import mmap
 import os
+import re
+import struct
+
+
+MAGIC = b"SPK8FS"
+VERSION = 1
+
+DISK_PATH = "fs.img"
+
+BLOCK_SIZE = 4096
+DEFAULT_BLOCKS = 1024 # 4 MB
+JOURNAL_BLOCKS = 16 # Header and up to 15 metadata blocks per transaction
+
+INODE_SIZE = 128
+INODES_PER_BLOCK = BLOCK_SIZE // INODE_SIZE
+EXTENTS = 12 # Runs kept in the inode itself
+PREALLOCATE_LIMIT = 256 # Most blocks a file grows by ahead of its size
+
+KIND_FREE = 0
+KIND_FILE = 1
+KIND_DIRECTORY = 2
+
+ROOT = 1 # Inode of the root directory, 0 means none
+
+FD_BASE = 0x10 # First file descriptor, lower numbers are `Sys_Write`'s screen commands
+BUFFER_SIZE = 2**16 # Bytes of small writes a descriptor gathers before writing them
+
+SUPER = struct.Struct("<6sHIIIIIII")
+JOURNAL = struct.Struct("<6sH") # Magic, block count, then the block numbers as u32s
+JOURNAL_MAGIC = b"SPKJNL"
+INODE = struct.Struct("<IIQ%dII" % (2 * EXTENTS))
+RUN = struct.Struct("<II")
+DIRENT = struct.Struct("<IB59s")
+
+FREE = re.compile(rb"[^\xff]") # A bitmap byte with a free block
+
+
+class Inode:
+    __slots__ = ("number", "kind", "parent", "size", "extents", "indirect")
+
+    def __init__(self, number: int, kind: int, parent: int, size: int, extents: list, indirect: int):
+        self.number = number
+        self.kind = kind
+        self.parent = parent # Directory it is in
+        self.size = size # In bytes
+        self.extents = extents # [start, length] runs of blocks, in file order
+        self.indirect = indirect # Block holding the runs past `EXTENTS`, 0 for none
+
+    def blocks(self) -> int:
+        return sum(length for _, length in self.extents)
+
+
+class Disk:
+    """A disk image holding a filesystem. Creates and formats the image if it doesn't exist.
+
+    With `durable`, every commit is also flushed to the host's disk, so the image survives the
+    host crashing as well as the emulator.
+    """
+
+    def __init__(self, path: str, blocks: int = DEFAULT_BLOCKS, durable: bool = False):
+        self.path = path
+        self.durable = durable
+
+        new = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.file = open(path, "w+b" if new else "r+b")
+
+        try:
+            if new:
+                self.file.truncate(blocks * BLOCK_SIZE)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+            if new:
+                self.__format(blocks)
+            self.__mount()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __format(self, blocks: int):
+        inode_count = max(INODES_PER_BLOCK, blocks // 4)
+        bitmap = 1 + JOURNAL_BLOCKS
+        inodes = bitmap + -(-blocks // (8 * BLOCK_SIZE))
+        data = inodes + -(-inode_count // INODES_PER_BLOCK)
+
+        if data >= blocks:
+            raise ValueError("a disk needs more than %d blocks" % data)
+
+        self.map[:SUPER.size] = SUPER.pack(MAGIC, VERSION, BLOCK_SIZE, blocks, inode_count, 1, bitmap, inodes, data)
+        self.__mount()
+
+        # Everything before the data is in use, as are the bits past the last block
+        self.bitmap[:data >> 3] = b"\xff" * (data >> 3)
+        for block in range(data & ~7, data):
+            self.bitmap[block >> 3] |= 1 << (block & 7)
+        for block in range(blocks, len(self.bitmap) * 8):
+            self.bitmap[block >> 3] |= 1 << (block & 7)
+        self.__meta_write(self.bitmap_start * BLOCK_SIZE, self.bitmap)
+
+        self.__put_inode(Inode(ROOT, KIND_DIRECTORY, ROOT, 0, [], 0))
+        self.commit()
+
+    def __mount(self):
+        if len(self.map) < SUPER.size:
+            raise ValueError("not a disk image")
+
+        magic, version, block_size, blocks, inode_count, journal, bitmap, inodes, data = SUPER.unpack_from(self.map)
+
+        if magic != MAGIC:
+            raise ValueError("not a disk image")
+        if version != VERSION:
+            raise ValueError("unsupported disk version %d" % version)
+        if block_size != BLOCK_SIZE or len(self.map) < blocks * BLOCK_SIZE:
+            raise ValueError("truncated disk image")
+
+        self.blocks = blocks
+        self.inode_count = inode_count
+        self.journal_start = journal
+        self.bitmap_start = bitmap
+        self.inode_start = inodes
+        self.data_start = data
+
+        self.pending = {} # Block -> new contents, the metadata of the open transaction
+        self.dirty = set() # Blocks written since the last snapshot
+        self.base = None # The snapshot the disk was last taken or restored from
+
+        self.__replay()
+        self.__load()
+
+    def __load(self):
+        # Read what's kept in memory back from the image
+        start = self.bitmap_start * BLOCK_SIZE
+        self.bitmap = bytearray(self.map[start:start + -(-self.blocks // 8)])
+        self.hint = self.data_start # Where to look for free blocks
+        self.inode_hint = ROOT + 1 # Where to look for free inodes
+        self.inodes = {} # Number -> `Inode`, as read
+        self.directories = {} # Inode -> (name -> (inode, slot), free slots)
+
+    # Blocks and transactions
+
+    def __barrier(self):
+        if self.durable:
+            self.map.flush()
+
+    def __touch(self, start: int, end: int):
+        # Mark the bytes in [start, end) as written since the last snapshot
+        if end > start:
+            self.dirty.update(range(start // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1))
+
+    def __meta_read(self, offset: int, length: int) -> bytes:
+        # Read metadata bytes as the open transaction left them
+        out = bytearray()
+
+        while length:
+            block, skip = divmod(offset, BLOCK_SIZE)
+            run = min(length, BLOCK_SIZE - skip)
+            source = self.pending.get(block)
+
+            if source is None:
+                out += self.map[offset:offset + run]
+            else:
+                out += source[skip:skip + run]
+
+            offset += run
+            length -= run
+
+        return bytes(out)
+
+    def __meta_write(self, offset: int, data):
+        # Change metadata bytes in the open transaction
+        data = memoryview(data).cast("B")
+        position = 0
+
+        while position < len(data):
+            block, skip = divmod(offset, BLOCK_SIZE)
+            run = min(len(data) - position, BLOCK_SIZE - skip)
+
+            target = self.pending.get(block)
+            if target is None:
+                target = self.pending[block] = bytearray(self.map[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE])
+
+            target[skip:skip + run] = data[position:position + run]
+            offset += run
+            position += run
+
+    def commit(self):
+        """Write the open transaction's metadata to the journal, then to where it belongs.
+        """
+        if not self.pending:
+            return
+
+        blocks = sorted(self.pending)
+        if len(blocks) >= JOURNAL_BLOCKS:
+            self.pending.clear()
+            self.__load() # Forget what the transaction changed
+            raise OSError(errno.EFBIG, "transaction too large for the journal")
+
+        journal = self.journal_start * BLOCK_SIZE
+        for i, block in enumerate(blocks, 1):
+            self.map[journal + i * BLOCK_SIZE:journal + (i + 1) * BLOCK_SIZE] = self.pending[block]
+        self.__barrier()
+
+        header = JOURNAL.pack(JOURNAL_MAGIC, len(blocks)) + struct.pack("<%dI" % len(blocks), *blocks)
+        self.map[journal:journal + len(header)] = header # Committed from here on
+        self.__barrier()
+
+        for block in blocks:
+            self.map[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] = self.pending[block]
+            self.dirty.add(block)
+        self.__barrier()
+
+        self.map[journal:journal + JOURNAL.size] = bytes(JOURNAL.size)
+        self.__touch(journal, journal + (len(blocks) + 1) * BLOCK_SIZE)
+        self.pending.clear()
+
+    def __replay(self):
+        # Finish a transaction that was committed to the journal but not applied
+        journal = self.journal_start * BLOCK_SIZE
+        magic, count = JOURNAL.unpack_from(self.map, journal)
+
+        if magic != JOURNAL_MAGIC or count >= JOURNAL_BLOCKS:
+            return
+
+        blocks = struct.unpack_from("<%dI" % count, self.map, journal + JOURNAL.size)
+        for i, block in enumerate(blocks, 1):
+            if block < self.blocks:
+                self.map[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] = self.map[journal + i * BLOCK_SIZE:journal + (i + 1) * BLOCK_SIZE]
+
+        self.map[journal:journal + JOURNAL.size] = bytes(JOURNAL.size)
+        self.__barrier()
+
+    # Block allocation
+
+    def __used(self, block: int) -> bool:
+        return self.bitmap[block >> 3] & (1 << (block & 7))
+
+    def __find_free(self, block: int):
+        # Return the first free block from `block` on, wrapping around, or None
+        for start, end in ((block, self.blocks), (self.data_start, block)):
+            while start < end:
+                if not self.__used(start):
+                    return start
+
+                start += 1
+                if not start & 7: # Skip whole bytes of used blocks
+                    match = FREE.search(self.bitmap, start >> 3)
+                    if match is None:
+                        break
+                    start = max(start, match.start() << 3)
+
+        return None
+
+    def __mark(self, start: int, length: int, used: bool):
+        for block in range(start, start + length):
+            if used:
+                self.bitmap[block >> 3] |= 1 << (block & 7)
+            else:
+                self.bitmap[block >> 3] &= ~(1 << (block & 7))
+
+        first, last = start >> 3, (start + length - 1) >> 3
+        self.__meta_write(self.bitmap_start * BLOCK_SIZE + first, self.bitmap[first:last + 1])
+
+    def __allocate(self, count: int, near: int) -> list:
+        # Claim `count` free blocks, from `near` on if it's free, and return them as [start, length] runs
+        runs = []
+        block = near if self.data_start <= near < self.blocks and not self.__used(near) else self.hint
+
+        while count:
+            block = self.__find_free(block)
+            if block is None:
+                for start, length in runs:
+                    self.__mark(start, length, False)
+                raise OSError(errno.ENOSPC, "no space left on the disk")
+
+            start = block
+            while count and block < self.blocks and not self.__used(block):
+                block += 1
+                count -= 1
+
+            self.__mark(start, block - start, True)
+            runs.append([start, block - start])
+
+        self.hint = block
+        return runs
+
+    # Inodes
+
+    def inode(self, number: int) -> Inode:
+        inode = self.inodes.get(number)
+        if inode is not None:
+            return inode
+
+        if not 0 < number < self.inode_count:
+            raise OSError(errno.EINVAL, "no inode %d" % number)
+
+        kind, parent, size, *runs = INODE.unpack(self.__meta_read(self.inode_start * BLOCK_SIZE + number * INODE_SIZE, INODE.size))
+        indirect = runs.pop()
+        extents = [[runs[i], runs[i + 1]] for i in range(0, len(runs), 2) if runs[i + 1]]
+
+        if indirect:
+            data = self.__meta_read(indirect * BLOCK_SIZE, BLOCK_SIZE)
+            for start, length in RUN.iter_unpack(data):
+                if not length:
+                    break
+                extents.append([start, length])
+
+        inode = self.inodes[number] = Inode(number, kind, parent, size, extents, indirect)
+        return inode
+
+    def __put_inode(self, inode: Inode):
+        extents = inode.extents
+
+        if len(extents) > EXTENTS:
+            if len(extents) - EXTENTS > BLOCK_SIZE // RUN.size:
+                raise OSError(errno.EFBIG, "file too fragmented")
+            if not inode.indirect:
+                inode.indirect = self.__allocate(1, self.hint)[0][0]
+
+            more = b"".join(RUN.pack(start, length) for start, length in extents[EXTENTS:])
+            self.__meta_write(inode.indirect * BLOCK_SIZE, more.ljust(BLOCK_SIZE, b"\0"))
+        elif inode.indirect:
+            self.__mark(inode.indirect, 1, False)
+            inode.indirect = 0
+
+        runs = [value for extent in extents[:EXTENTS] for value in extent]
+        runs += [0] * (2 * EXTENTS - len(runs))
+
+        self.__meta_write(
+            self.inode_start * BLOCK_SIZE + inode.number * INODE_SIZE,
+            INODE.pack(inode.kind, inode.parent, inode.size, *runs, inode.indirect)
+        )
+        self.inodes[inode.number] = inode
+
+    def __new_inode(self, kind: int, parent: int) -> Inode:
+        for number in list(range(self.inode_hint, self.inode_count)) + list(range(ROOT + 1, self.inode_hint)):
+            if self.inode(number).kind == KIND_FREE:
+                self.inode_hint = number + 1
+                inode = Inode(number, kind, parent, 0, [], 0)
+                self.__put_inode(inode)
+                return inode
+
+        raise OSError(errno.ENOSPC, "no free inodes left on the disk")
+
+    # File contents
+
+    def __spans(self, inode: Inode, offset: int, length: int):
+        # Yield (byte offset on disk, length) runs covering [offset, offset + length) of a file
+        position = 0
+        for start, count in inode.extents:
+            size = count * BLOCK_SIZE
+
+            if offset < position + size:
+                skip = offset - position
+                run = min(size - skip, length)
+                yield start * BLOCK_SIZE + skip, run
+
+                offset += run
+                length -= run
+                if not length:
+                    return
+
+            position += size
+
+    def __reserve(self, inode: Inode, size: int, preallocate: bool = True):
+        # Give `inode` the blocks for `size` bytes, growing by as many as it has (up to a limit)
+        have = inode.blocks()
+        need = -(-size // BLOCK_SIZE) - have
+        if need <= 0:
+            return
+
+        if preallocate:
+            need = max(need, min(have, PREALLOCATE_LIMIT))
+
+        near = inode.extents[-1][0] + inode.extents[-1][1] if inode.extents else self.hint
+        for start, length in self.__allocate(need, near):
+            last = inode.extents[-1] if inode.extents else None
+            if last is not None and last[0] + last[1] == start:
+                last[1] += length
+            else:
+                inode.extents.append([start, length])
 
+    def __copy_in(self, inode: Inode, offset: int, data: memoryview):
+        # Write `data` at `offset` of a file that has the blocks for it
+        position = 0
 
-files = {"": {}}
-directory = files[""]
+        for disk, run in self.__spans(inode, offset, len(data)):
+            if inode.kind == KIND_DIRECTORY:
+                self.__meta_write(disk, data[position:position + run])
+            else:
+                self.map[disk:disk + run] = data[position:position + run]
+                self.__touch(disk, disk + run)
+            position += run
 
+    def readinto(self, number: int, offset: int, buffer) -> int:
+        """Copy the file's bytes from `offset` into the writable `buffer` and return how many.
+        """
+        inode = self.inode(number)
+        buffer = memoryview(buffer).cast("B")
+        length = max(0, min(len(buffer), inode.size - offset))
+        position = 0
 
-def init():
-    """Install the virtual filesystem and create `fs.json`.
+        with memoryview(self.map) as view:
+            for disk, run in self.__spans(inode, offset, length):
+                buffer[position:position + run] = view[disk:disk + run]
+                position += run
+
+        return length
+
+    def write(self, number: int, offset: int, data) -> int:
+        """Write the bytes of `data` at `offset` of the file, growing it if needed, and return
+        how many were written. Writing inside the file and its blocks changes no metadata, so
+        it's only a copy.
+        """
+        inode = self.inode(number)
+        if inode.kind != KIND_FILE:
+            raise IsADirectoryError(errno.EISDIR, "inode %d is a directory" % number)
+
+        data = memoryview(data).cast("B")
+        end = offset + len(data)
+        blocks = inode.blocks()
+
+        try:
+            self.__reserve(inode, end)
+
+            if offset > inode.size: # Blocks can hold old data, zero the gap
+                self.__copy_in(inode, inode.size, memoryview(bytes(offset - inode.size)))
+            self.__copy_in(inode, offset, data)
+
+            if end > inode.size or inode.blocks() != blocks:
+                inode.size = max(inode.size, end)
+                self.__put_inode(inode)
+                self.commit()
+        except BaseException:
+            self.pending.clear()
+            self.__load()
+            raise
+
+        return len(data)
+
+    def truncate(self, number: int, size: int = 0):
+        """Cut the file down to `size` bytes, and free the blocks it no longer needs.
+        """
+        inode = self.inode(number)
+        if size >= inode.size and -(-inode.size // BLOCK_SIZE) == inode.blocks():
+            return # Nothing to cut
+
+        inode.size = min(inode.size, size)
+
+        keep = -(-inode.size // BLOCK_SIZE)
+        extents = []
+        for start, length in inode.extents:
+            if keep >= length:
+                extents.append([start, length])
+                keep -= length
+                continue
+
+            if keep:
+                extents.append([start, keep])
+            self.__mark(start + keep, length - keep, False)
+            keep = 0
+
+        inode.extents = extents
+        self.__put_inode(inode)
+        self.commit()
+
+    # Directories
+
+    def __index(self, number: int) -> tuple:
+        index = self.directories.get(number)
+        if index is not None:
+            return index
+
+        inode = self.inode(number)
+        if inode.kind != KIND_DIRECTORY:
+            raise NotADirectoryError(errno.ENOTDIR, "not a directory")
+
+        names = {}
+        free = []
+        data = b"".join(self.__meta_read(disk, run) for disk, run in self.__spans(inode, 0, inode.size))
+
+        for slot, (child, length, name) in enumerate(DIRENT.iter_unpack(data)):
+            if child:
+                names[name[:length].decode("utf-8")] = (child, slot)
+            else:
+                free.append(slot)
+
+        index = self.directories[number] = (names, free)
+        return index
+
+    def names(self, number: int) -> list:
+        return list(self.__index(number)[0])
+
+    def lookup(self, number: int, name: str):
+        """Return the inode of `name` in directory `number`, or None.
+        """
+        entry = self.__index(number)[0].get(name)
+        return entry[0] if entry else None
+
+    def create(self, number: int, name: str, kind: int) -> int:
+        """Make a new, empty file or directory called `name` in directory `number` and return
+        its inode.
+        """
+        encoded = name.encode("utf-8")
+        if not name or "/" in name or name in (".", "..") or len(encoded) > DIRENT.size - 5:
+            raise OSError(errno.EINVAL, "invalid name \"%s\"" % name)
+
+        names, free = self.__index(number)
+        if name in names:
+            raise FileExistsError(errno.EEXIST, "\"%s\" already exists" % name)
+
+        directory = self.inode(number)
+
+        try:
+            child = self.__new_inode(kind, number)
+            slot = free.pop() if free else directory.size // DIRENT.size
+
+            if slot * DIRENT.size >= directory.size:
+                self.__reserve(directory, (slot + 1) * DIRENT.size, False)
+                directory.size = (slot + 1) * DIRENT.size
+                self.__put_inode(directory)
+
+            self.__copy_in(directory, slot * DIRENT.size, memoryview(DIRENT.pack(child.number, len(encoded), encoded)))
+            self.commit()
+        except BaseException:
+            self.pending.clear()
+            self.__load()
+            raise
+
+        names[name] = (child.number, slot)
+        return child.number
+
+    def remove(self, number: int, name: str):
+        """Delete `name` from directory `number` and free its blocks. Directories have to be
+        empty.
+        """
+        names, free = self.__index(number)
+        if name not in names:
+            raise FileNotFoundError(errno.ENOENT, "no file named \"%s\"" % name)
+
+        child, slot = names[name]
+        inode = self.inode(child)
+        if inode.kind == KIND_DIRECTORY and self.__index(child)[0]:
+            raise OSError(errno.ENOTEMPTY, "directory \"%s\" is not empty" % name)
+
+        for start, length in inode.extents:
+            self.__mark(start, length, False)
+        inode.extents = []
+        inode.size = 0
+        inode.kind = KIND_FREE
+        self.__put_inode(inode)
+
+        self.__copy_in(self.inode(number), slot * DIRENT.size, memoryview(bytes(DIRENT.size)))
+        self.commit()
+
+        del names[name]
+        free.append(slot)
+        self.directories.pop(child, None)
+        self.inode_hint = min(self.inode_hint, child)
+
+    # Snapshots, see `CPU.Snapshot`
+
+    def snapshot(self) -> tuple:
+        """Return the contents of the disk as a tuple of immutable blocks. Blocks that weren't
+        written since the last snapshot are shared with it.
+        """
+        if self.base is None:
+            blocks = [self.map[start:start + BLOCK_SIZE] for start in range(0, self.blocks * BLOCK_SIZE, BLOCK_SIZE)]
+        else:
+            blocks = list(self.base)
+            for block in self.dirty:
+                blocks[block] = self.map[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE]
+
+        self.base = tuple(blocks)
+        self.dirty = set()
+
+        return self.base
+
+    def restore(self, blocks: tuple):
+        """Put the disk back to the snapshot `blocks`.
+        """
+        if self.base is None:
+            changed = range(len(blocks))
+        elif blocks is self.base:
+            changed = self.dirty
+        else:
+            changed = self.dirty | {block for block, data in enumerate(blocks) if data is not self.base[block]}
+
+        for block in changed:
+            self.map[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] = blocks[block]
+
+        self.base = blocks
+        self.dirty = set()
+        self.__load()
+
+
+class FileSystem:
+    """The filesystem device a CPU is given: a mounted `Disk`, or none, and the current
+    directory. Every path is resolved against its own directory, so any number of them can
+    share one disk. A `Disk` isn't locked, so one shared between threads must only be used
+    by one of them at a time.
+
+    With `path` and no disk, the image at `path` is mounted the first time one is needed, so
+    a program that never touches a file never creates it.
     """
-    if not os.path.isfile("fs.json"):
-        file = open("fs.json", "a")
-    else:
-        file = open("fs.json", "w")
+    __slots__ = ("disk", "directory", "path")
+
+    def __init__(self, disk: Disk = None, path: str = None):
+        self.disk = disk # None if nothing is mounted
+        self.directory = ROOT # Inode of the current directory
+        self.path = path # Mounted on first use, if nothing is mounted by then
+
+    def mount(self, path: str = DISK_PATH, blocks: int = DEFAULT_BLOCKS):
+        """Mount the disk image at `path`, creating it if it doesn't exist.
+        """
+        self.unmount()
+        self.disk = Disk(path, blocks)
+        self.directory = ROOT
+
+    def unmount(self):
+        """Unmount the disk, and don't mount `path` on the next use.
+        """
+        self.path = None
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    def mounted(self) -> Disk:
+        """Return the disk, mounting `path` if it isn't yet, or raise `OSError` if there
+        isn't one.
+        """
+        if self.disk is None:
+            if self.path is None:
+                raise OSError(errno.ENODEV, "no disk mounted")
+
+            try:
+                self.disk = Disk(self.path)
+            except ValueError as e: # Not a disk image
+                raise OSError(errno.EIO, "can't mount \"%s\": %s" % (self.path, e))
+            self.directory = ROOT
+
+        return self.disk
 
-    file.write("")
-    json.dump(files, file)
+    def __resolve(self, path: str) -> tuple:
+        # Return (directory inode, name) for `path`, relative to the current directory
+        mounted = self.mounted()
+        parts = path.split("/")
+        node = ROOT if path.startswith("/") or path == "~" else self.directory
 
-    file.close()
+        for part in parts[:-1]:
+            if part in ("", "."):
+                continue
+            elif part == "..":
+                node = mounted.inode(node).parent
+            else:
+                child = mounted.lookup(node, part)
+                if child is None:
+                    raise FileNotFoundError(errno.ENOENT, "no directory named \"%s\"" % part)
+                node = child
 
-def ls():
-    """Returns a list of all files and folders in the specified directory.
+        return node, parts[-1]
+
+    def find(self, path: str) -> int:
+        """Return the inode of `path`.
+        """
+        node, name = self.__resolve(path)
+
+        if name in ("", ".", "~"):
+            return node
+        if name == "..":
+            return self.mounted().inode(node).parent
+
+        child = self.mounted().lookup(node, name)
+        if child is None:
+            raise FileNotFoundError(errno.ENOENT, "no file named \"%s\"" % path)
+        return child
+
+    def ls(self, path: str = "") -> list:
+        """Returns a list of all files and folders in the specified directory.
+        """
+        return self.mounted().names(self.find(path))
+
+    def cd(self, dir: str):
+        node = self.find(dir)
+        if self.mounted().inode(node).kind != KIND_DIRECTORY:
+            raise NotADirectoryError(errno.ENOTDIR, "\"%s\" is not a directory" % dir)
+
+        self.directory = node
+
+    def mkdir(self, name: str):
+        self.mounted().create(*self.__resolve(name), KIND_DIRECTORY)
+
+    def create_file(self, name: str) -> int:
+        """Create an empty file called `name`, or empty it if it exists, and return its inode.
+        """
+        mounted = self.mounted()
+        node, base = self.__resolve(name)
+        child = mounted.lookup(node, base)
+
+        if child is None:
+            return mounted.create(node, base, KIND_FILE)
+
+        if mounted.inode(child).kind != KIND_FILE:
+            raise IsADirectoryError(errno.EISDIR, "\"%s\" is a directory" % name)
+
+        mounted.truncate(child)
+        return child
+
+    def rm(self, name: str):
+        self.mounted().remove(*self.__resolve(name))
+
+    def writef(self, name: str, text: str, mode="w"):
+        mounted = self.mounted()
+        node = self.find(name)
+        if mode == "w":
+            mounted.truncate(node)
+
+        mounted.write(node, mounted.inode(node).size, text.encode("utf-32-le", "surrogatepass"))
+
+    def readf(self, name: str) -> str:
+        mounted = self.mounted()
+        node = self.find(name)
+        data = bytearray(mounted.inode(node).size)
+        mounted.readinto(node, 0, data)
+
+        return data.decode("utf-32-le", "surrogatepass")
+
+    def snapshot(self) -> tuple:
+        """Return the disk's blocks and the current directory, for `restore`.
+        """
+        return self.disk.snapshot() if self.disk is not None else None, self.directory
+
+    def restore(self, state: tuple):
+        blocks, self.directory = state
+        if self.disk is not None and blocks is not None:
+            self.disk.restore(blocks)
+
+
+class Handle:
+    __slots__ = ("inode", "position", "buffer", "start")
+
+    def __init__(self, inode: int, position: int = 0):
+        self.inode = inode
+        self.position = position # In bytes
+        self.buffer = bytearray() # Small writes not on the disk yet
+        self.start = 0 # Where `buffer` goes in the file
+
+
+class FileTable:
+    """A CPU's open files on `filesystem`, by descriptor. Small writes to a descriptor are gathered and written
+    to the disk together once `BUFFER_SIZE` bytes are waiting, or the file is read, seeked or
+    closed. Bigger writes and every read go straight between the caller's buffer and the disk.
     """
-    values = []
-    for key in directory:
-        value = directory[key]
-        values.append(value)
-    return values
-
-def cd(dir: str):
-    global directory
-
-    if dir == "~":
-        directory = files[""]
-
-    directory = directory[dir]
-
-def mkdir(name: str):
-    global directory
-    directory[name] = {}
-
-def create_file(name: str):
-    global directory
-    directory[name] = ""
-
-def rm(name: str):
-    global directory
-    return directory.pop(name)
-
-def writef(name: str, text: str, mode="w"):
-    if not directory[name]:
-        raise FileNotFoundError
-    
-    if mode == 'w':
-        directory[name] = text
-    elif mode == "a":
-        directory[name] = directory[name] + text
\ No newline at end of file
+    __slots__ = ("filesystem", "handles")
+
+    def __init__(self, filesystem: FileSystem):
+        self.filesystem = filesystem
+        self.handles = {} # Descriptor -> `Handle`
+
+    def __handle(self, fd: int) -> Handle:
+        handle = self.handles.get(fd)
+        if handle is None:
+            raise OSError(errno.EBADF, "bad file descriptor %d" % fd)
+        return handle
+
+    def __flush(self, handle: Handle):
+        if handle.buffer:
+            buffer = handle.buffer
+            handle.buffer = bytearray()
+            self.filesystem.mounted().write(handle.inode, handle.start, buffer)
+
+    def flush(self):
+        """Write every descriptor's waiting writes to the disk.
+        """
+        for handle in self.handles.values():
+            self.__flush(handle)
+
+    def open(self, path: str, create: bool = False) -> int:
+        """Open the file at `path` and return its descriptor. With `create`, the file is made
+        or emptied first.
+        """
+        self.flush() # Emptying a file drops what was waiting for it
+        node = self.filesystem.create_file(path) if create else self.filesystem.find(path)
+        if self.filesystem.mounted().inode(node).kind != KIND_FILE:
+            raise IsADirectoryError(errno.EISDIR, "\"%s\" is a directory" % path)
+
+        fd = FD_BASE
+        while fd in self.handles:
+            fd += 1
+
+        self.handles[fd] = Handle(node)
+        return fd
+
+    def read(self, fd: int, buffer) -> int:
+        """Read from `fd` into the writable `buffer` and return how many bytes.
+        """
+        handle = self.__handle(fd)
+        self.flush() # Any descriptor may have written to this file
+
+        count = self.filesystem.mounted().readinto(handle.inode, handle.position, buffer)
+        handle.position += count
+
+        return count
+
+    def write(self, fd: int, data) -> int:
+        """Write the bytes of `data` to `fd` and return how many.
+        """
+        handle = self.__handle(fd)
+        data = memoryview(data).cast("B")
+
+        if handle.buffer and handle.start + len(handle.buffer) != handle.position:
+            self.__flush(handle)
+
+        if len(data) >= BUFFER_SIZE:
+            self.__flush(handle)
+            self.filesystem.mounted().write(handle.inode, handle.position, data)
+        else:
+            if not handle.buffer:
+                handle.start = handle.position
+            handle.buffer += data
+
+            if len(handle.buffer) >= BUFFER_SIZE:
+                self.__flush(handle)
+
+        handle.position += len(data)
+        return len(data)
+
+    def seek(self, fd: int, offset: int, whence: int = os.SEEK_SET) -> int:
+        """Move `fd` to `offset` bytes from the start, its position or the end of the file,
+        and return the new position.
+        """
+        handle = self.__handle(fd)
+        self.__flush(handle)
+
+        if whence == os.SEEK_CUR:
+            offset += handle.position
+        elif whence == os.SEEK_END:
+            offset += self.filesystem.mounted().inode(handle.inode).size
+        elif whence != os.SEEK_SET:
+            raise OSError(errno.EINVAL, "bad whence %d" % whence)
+
+        handle.position = max(0, offset)
+        return handle.position
+
+    def close(self, fd: int) -> bool:
+        """Close `fd` and give back the blocks its file grew by ahead of its size. Returns
+        False if it wasn't open.
+        """
+        handle = self.handles.pop(fd, None)
+        if handle is None:
+            return False
+
+        self.__flush(handle)
+        disk = self.filesystem.disk
+        if disk is not None:
+            disk.truncate(handle.inode, disk.inode(handle.inode).size)
+
+        return True
+
+    def close_all(self):
+        """Close every descriptor, as a program's files are when it stops.
+        """
+        for fd in list(self.handles):
+            self.close(fd)
+
+    def snapshot(self) -> dict:
+        """Flush the waiting writes and return descriptor -> (inode, position), for `restore`.
+        """
+        self.flush()
+        return {fd: (handle.inode, handle.position) for fd, handle in self.handles.items()}
+
+    def restore(self, state: dict):
+        self.handles = {fd: Handle(inode, position) for fd, (inode, position) in state.items()}
@@ -0,0 +1,207 @@
+"""The image module for the SPK-8 emulator. Reads and writes program images.
+
+A binary image (version 1) is laid out as:
+
+    header     magic b"SPK8", u16 version, u16 section count, u32 entry point
+    sections   per section: u32 kind, u32 load address, u32 length in cells, u32 file offset in bytes
+    cells      packed little-endian u32 cells for every section
+
+Legacy `.mem` images (UTF-16 text, one character per cell) are still read by `load`.
+
+`save` streams the cells to a temp file in chunks and renames it over the target, so a failed
+write never leaves a truncated image behind. `place` loads sections that are already in memory,
+e.g. from the assembler, without going through a file at all, and `read` returns an image's
+sections without loading them, e.g. for the disassembler.
+"""
+import io
+import os
+import struct
+import sys
+import tempfile
+
+from array import array
+from collections import namedtuple
+
+try:
+    from memory import CELL_TYPE
+except ImportError: # Imported as part of the `emu` package, e.g. by the assembler
+    from emu.memory import CELL_TYPE
+
+
+MAGIC = b"SPK8"
+VERSION = 1
+
+SECTION_TEXT = 0
+SECTION_DATA = 1
+SECTION_ROM = 2
+
+HEADER = struct.Struct("<4sHHI")
+SECTION = struct.Struct("<IIII")
+
+CHUNK_CELLS = 2**16 # Cells per write when streaming an image
+
+Section = namedtuple("Section", ["kind", "address", "length"])
+
+
+def _array(data) -> array:
+    return data if isinstance(data, array) and data.typecode == CELL_TYPE else array(CELL_TYPE, data)
+
+def write(f, sections: list, entry: int = 0):
+    """Write a binary image made of `(kind, address, cells)` tuples to the binary file `f`,
+    a section at a time in chunks of `CHUNK_CELLS`, without packing the image in memory first.
+    """
+    sections = [(kind, address, _array(cells)) for kind, address, cells in sections]
+
+    f.write(HEADER.pack(MAGIC, VERSION, len(sections), entry))
+    offset = HEADER.size + SECTION.size * len(sections)
+
+    for kind, address, cells in sections:
+        f.write(SECTION.pack(kind, address, len(cells), offset))
+        offset += len(cells) * 4
+
+    for _, _, cells in sections:
+        for start in range(0, len(cells), CHUNK_CELLS):
+            if sys.byteorder == "big":
+                chunk = cells[start:start + CHUNK_CELLS]
+                chunk.byteswap()
+                f.write(chunk)
+            else:
+                f.write(memoryview(cells)[start:start + CHUNK_CELLS])
+
+def pack(sections: list, entry: int = 0) -> bytes:
+    """Build a binary image from `(kind, address, cells)` tuples.
+    """
+    out = io.BytesIO()
+    write(out, sections, entry)
+
+    return out.getvalue()
+
+def save_with(path: str, write_to):
+    """Call `write_to(f)` with a binary file next to `path` under a temporary name, then
+    rename it over `path`. If anything fails the temp file is removed and `path` is untouched.
+    """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=".tmp")
+
+    try:
+        # mkstemp makes the file private, give it the permissions `open` would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp, 0o666 & ~umask)
+
+        with os.fdopen(fd, "wb") as f:
+            write_to(f)
+
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+def save(path: str, sections: list, entry: int = 0):
+    """Write a binary image made of `(kind, address, cells)` tuples to `path`. The image is
+    written next to it under a temporary name first, then renamed over `path`.
+    """
+    save_with(path, lambda f: write(f, sections, entry))
+
+def place(sections: list, memory, entry: int = 0) -> tuple:
+    """Load `(kind, address, cells)` tuples into `memory` and return `(entry, sections)` like
+    `load` does. Raises `IndexError` if a section does not fit in memory.
+    """
+    placed = []
+
+    for kind, address, cells in sections:
+        length = memory.load(cells, address)
+        placed.append(Section(kind, address, length))
+
+    return entry, placed
+
+def _read_table(f) -> tuple:
+    # Read the header and section table of the image open as `f`. Returns `(entry, table)` with
+    # `(kind, address, length, offset)` for each section, or None for a legacy image
+    header = f.read(HEADER.size)
+
+    if header[:len(MAGIC)] != MAGIC:
+        return None
+
+    if len(header) < HEADER.size:
+        raise ValueError("truncated image header")
+
+    _, version, count, entry = HEADER.unpack(header)
+    if version > VERSION:
+        raise ValueError("unsupported image version %d" % version)
+
+    table = f.read(SECTION.size * count)
+    if len(table) < SECTION.size * count:
+        raise ValueError("truncated section table")
+
+    return entry, [SECTION.unpack_from(table, i * SECTION.size) for i in range(count)]
+
+def load(path: str, memory) -> tuple:
+    """Load the image at `path` into `memory` and return `(entry, sections)`.
+
+    Binary images are read straight into the memory array, legacy UTF-16 images
+    are decoded in one pass. Raises `IndexError` if a section does not fit in memory
+    and `ValueError` if the image is malformed.
+    """
+    with open(path, "rb") as f:
+        header = _read_table(f)
+        if header is None:
+            return _load_legacy(path, memory)
+
+        entry, table = header
+        cells = memoryview(memory.data)
+        sections = []
+
+        for i, (kind, address, length, offset) in enumerate(table):
+            if address + length > len(cells):
+                raise IndexError("section %d does not fit in memory" % i)
+
+            f.seek(offset)
+            if f.readinto(cells[address:address + length].cast("B")) != length * 4:
+                raise ValueError("truncated section %d" % i)
+
+            if sys.byteorder == "big":
+                swapped = memory.data[address:address + length]
+                swapped.byteswap()
+                memory.data[address:address + length] = swapped
+
+            memory.touch(address, address + length)
+            sections.append(Section(kind, address, length))
+
+    return entry, sections
+
+def read(path: str) -> tuple:
+    """Read the image at `path` without loading it and return `(entry, sections)`, with
+    sections as `(kind, address, cells)` tuples. Raises `ValueError` if it is malformed.
+    """
+    with open(path, "rb") as f:
+        header = _read_table(f)
+        if header is None:
+            with open(path, "r", encoding="utf-16") as legacy:
+                return 0, [(SECTION_TEXT, 0, array(CELL_TYPE, map(ord, legacy.read())))]
+
+        entry, table = header
+        sections = []
+
+        for i, (kind, address, length, offset) in enumerate(table):
+            f.seek(offset)
+            data = f.read(length * 4)
+            if len(data) != length * 4:
+                raise ValueError("truncated section %d" % i)
+
+            cells = array(CELL_TYPE)
+            cells.frombytes(data)
+            if sys.byteorder == "big":
+                cells.byteswap()
+
+            sections.append((kind, address, cells))
+
+    return entry, sections
+
+def _load_legacy(path: str, memory) -> tuple:
+    with open(path, "r", encoding="utf-16") as f:
+        length = memory.load(f.read().encode("utf-32-le"))
+
+    return 0, [Section(SECTION_TEXT, 0, length)]
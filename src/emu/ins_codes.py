@@ -46,4 +46,15 @@ CMP = 0x11
 NOR = 0x12
 INC = 0x13
 DEC = 0x14
-ULD = 0x15
\ No newline at end of file
+ULD = 0x15
+
+# Jumps with a word (hi, lo) target, for code past the first 256 cells
+JNEW = 0x16
+JEW = 0x17
+JNZW = 0x18
+JZW = 0x19
+JMPW = 0x1A
+
+BRK = 0xCC # Breakpoint, only used by the debugger
+
+OPCODE_COUNT = 0x100 # Size of the CPU's opcode dispatch table
@@ -0,0 +1,28 @@
+"""The linker module for the SPK-8 emulator. Resolves section headers once, when memory is
+loaded, so the CPU never checks for them while running.
+
+Every header cell is linked to a `Segment` that runs up to the next header. When execution
+reaches a header the CPU runs its segment: data is copied to the variable area and skipped,
+rom is skipped, and a text header does nothing. Memory itself is left as it was loaded, so
+every address (and a memory dump) stays the same.
+"""
+from collections import namedtuple
+
+from ins_codes import HEADER_DATA, HEADER_ROM, HEADER_TEXT
+
+
+HEADERS = (HEADER_DATA, HEADER_ROM, HEADER_TEXT)
+
+Segment = namedtuple("Segment", ["header", "start", "end"]) # Cells [start, end) follow the header
+
+
+def link(memory) -> dict:
+    """Find every header in `memory` and return a dict of header address -> `Segment`.
+    """
+    size = len(memory)
+    headers = [address for address, cell in enumerate(memory) if HEADER_TEXT <= cell <= HEADER_DATA]
+
+    return {
+        address: Segment(memory[address], address + 1, end)
+        for address, end in zip(headers, headers[1:] + [size])
+    }
@@ -0,0 +1,215 @@
+"""The machine module for the SPK-8 emulator. A `Machine` is a multi-processor SPK-8: several
+cores running out of one shared memory.
+
+Each core is a `CPU` with its own registers, flags, interrupt state and predecoded blocks.
+Memory, the screen, the filesystem and the open files are shared: a descriptor one core opens
+works on every core, and the writes they buffer to a file go out in the order the cores made
+them. A write by one core to memory drops the blocks every core decoded from it, so code one
+core writes is what the others run. A program finds out which core it's on with the core
+syscall (EAX 0x14), which leaves the core's number in RS.
+
+`run` schedules the cores round-robin in this process. Each core in turn runs for
+`time_slice` instructions, in core order, so a run does exactly the same thing every time.
+
+`run_processes` runs every core in its own process instead, over a
+`multiprocessing.shared_memory` block, so the cores really run in parallel. The cores race
+like hardware ones do, and a core's blocks don't see code that another process writes. They
+run headless without the disk: everything each core writes and draws is put on the machine's
+screen, in core order, once they have all stopped.
+"""
+import gc
+import multiprocessing
+
+from multiprocessing import shared_memory
+
+from cpu import CPU
+from memory import Memory
+from fs import FileSystem
+from palette import BLACK, WHITE
+
+
+TIME_SLICE = 1000 # Instructions a core runs before the next one's turn
+
+
+class Machine:
+    def __init__(self, cores: int, screen, filesystem: FileSystem = None, time_slice: int = TIME_SLICE):
+        if cores < 1:
+            raise ValueError("a machine needs at least one core")
+
+        self.screen = screen
+        self.filesystem = filesystem if filesystem is not None else FileSystem()
+        self.time_slice = time_slice
+        self.cores = [CPU(screen, self.filesystem) for _ in range(cores)]
+        self.ram = self.cores[0].ram
+
+        files = self.cores[0].files # One table, so no core's buffered writes hide another's
+        for number, core in enumerate(self.cores):
+            core.core = number
+            core.files = files
+            core.peers = tuple(other.blocks for other in self.cores if other is not core)
+
+        self.instructions_retired = [0] * cores # Per core, by the last run
+        self.cycles = [0] * cores # Per core, by the last run
+
+    def load(self, memory: Memory, entry: int):
+        """Share `memory` between the cores and start them all at `entry`.
+        """
+        self.ram = memory
+        for core in self.cores:
+            core.LoadMemory(memory)
+            core.PC = entry
+
+    def run(self, budget: int = None) -> list:
+        """Run the cores round-robin until every one stops, and return why each did (see
+        `CPU.Execute`). `budget` is per core.
+        """
+        cores = self.cores
+        retired = self.instructions_retired = [0] * len(cores)
+        cycles = self.cycles = [0] * len(cores)
+        reasons = [None] * len(cores)
+        running = list(range(len(cores)))
+
+        while running:
+            for number in running:
+                core = cores[number]
+                left = self.time_slice if budget is None else min(self.time_slice, budget - retired[number])
+
+                reason = core.Execute(left)
+                retired[number] += core.instructions_retired
+                cycles[number] += core.cycles
+
+                if reason != "budget" or retired[number] == budget:
+                    reasons[number] = reason
+
+            running = [number for number in running if reasons[number] is None]
+
+        return reasons
+
+    def run_processes(self, budget: int = None) -> list:
+        """Run every core in its own process until they all stop, and return why each did.
+        Memory is copied into a shared block for the run and back out after it.
+        """
+        size = len(self.ram)
+        block = shared_memory.SharedMemory(create=True, size=4 * size)
+        context = multiprocessing.get_context("spawn") # Don't fork a window or a mounted disk
+        workers = []
+
+        try:
+            block.buf[:4 * size] = memoryview(self.ram.data).cast("B")
+
+            for number, core in enumerate(self.cores):
+                reader, writer = context.Pipe(duplex=False)
+                process = context.Process(target=_run_core, args=(writer, block.name, size, number, core.PC, core.clock.mhz, budget))
+                process.start()
+                writer.close() # Only the worker's end is left, so a worker that dies reads as EOF
+                workers.append((process, reader))
+
+            results = []
+            for process, reader in workers:
+                try:
+                    results.append(reader.recv())
+                except EOFError:
+                    process.join()
+                    results.append(RuntimeError("a core's process exited with code %s" % process.exitcode))
+
+            memoryview(self.ram.data).cast("B")[:] = block.buf[:4 * size]
+        finally:
+            for process, reader in workers:
+                reader.close()
+                process.join()
+
+            block.close()
+            block.unlink()
+
+        self.ram.touch(0, size)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        for core, (reason, retired, cycles, pc, regs, index, flags, data_index, calls) in zip(self.cores, results):
+            core.blocks.clear()
+            core.PC = pc
+            core.regs[:] = regs
+            core.EDI, core.ESI, core.ESP, core.EBP = index
+            core.PS = flags
+            core.data_index = data_index
+            core.instructions_retired = retired
+            core.cycles = cycles
+
+            for method, args in calls:
+                getattr(self.screen, method)(*args)
+
+        self.instructions_retired = [result[1] for result in results]
+        self.cycles = [result[2] for result in results]
+
+        return [result[0] for result in results]
+
+
+class _Recording:
+    # The screen of a core in `Machine.run_processes`, which keeps every call made on it as
+    # `(method, args)` for the machine's screen to replay
+    __slots__ = ("calls",)
+
+    def __init__(self):
+        self.calls = []
+
+    def callback(self):
+        pass
+
+    def writes(self, text: str):
+        self.calls.append(("writes", (text,)))
+
+    def clear(self, colour: int = BLACK):
+        self.calls.append(("clear", (colour,)))
+
+    def draw_pix(self, pos: tuple, colour: int = WHITE):
+        self.calls.append(("draw_pix", (tuple(pos), colour)))
+
+    def fill_rect(self, pos: tuple, size: tuple, colour: int = WHITE):
+        self.calls.append(("fill_rect", (tuple(pos), tuple(size), colour)))
+
+    def blit(self, pos: tuple, width: int, codes: bytes):
+        self.calls.append(("blit", (tuple(pos), width, bytes(codes))))
+
+    def set_colour(self, colour: int = WHITE):
+        self.calls.append(("set_colour", (colour,)))
+
+    def set_palette(self, start: int, colours: list):
+        self.calls.append(("set_palette", (start, list(colours))))
+
+    def reset_scroll(self):
+        self.calls.append(("reset_scroll", ()))
+
+    def snapshot(self):
+        return None # Nothing for `CPU.Restore` to put back, the calls only replay forwards
+
+
+def _run_core(connection, name: str, size: int, number: int, pc: int, mhz: float, budget: int):
+    # Run one core of `Machine.run_processes` on the shared block `name`, and send back
+    # `(reason, instructions, cycles, pc, regs, index, flags, data_index, calls)` or the
+    # exception it raised
+    block = shared_memory.SharedMemory(name)
+    screen = _Recording()
+    cpu = None
+
+    try:
+        cpu = CPU(screen)
+        cpu.core = number
+        cpu.clock.mhz = mhz
+        cpu.LoadMemory(Memory(size, block.buf))
+        cpu.PC = pc
+
+        reason = cpu.Execute(budget)
+        connection.send((
+            reason, cpu.instructions_retired, cpu.cycles, cpu.PC, list(cpu.regs),
+            (cpu.EDI, cpu.ESI, cpu.ESP, cpu.EBP), cpu.PS, cpu.data_index, screen.calls
+        ))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+        cpu = None
+        gc.collect() # The CPU's bound methods refer to it, its views of the block must go first
+        block.close()
@@ -10,35 +10,103 @@
 
 
 import argparse
+import os
+import sys
 
 from cpu import CPU
 from memory import Memory
+from image import load, save, place, SECTION_TEXT
 from ins_codes import *
-from screen import *
-from fs import *
+from framebuffer import Headless, save_image
+from profiler import Profiler
+from machine import Machine, TIME_SLICE
+from srcmap import find, load as load_map
+from fs import FileSystem, DISK_PATH
 
 
-def main():
-    screen = App()
+SOURCE_EXTENSION = ".asm"
+
+
+def assemble_source(path: str) -> tuple:
+    """Assemble the source at `path`, and everything it includes, into image sections in this
+    process. Returns `(sections, source_map, error)`.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The assembler lives in `src`
+    from asm import build_objects
+    import objfile
+
+    objects, error = build_objects(path)
+    if error:
+        return None, None, error
 
+    sections, error = objfile.link(objects)
+    if error:
+        return None, None, error
+
+    return sections, objfile.source_map(objects), None
+
+
+def main():
     parser = argparse.ArgumentParser(description="A custom CPU emulator written in Python.")
-    parser.add_argument("-f", "--file", help="the binary file to be loaded", required=True)
+    parser.add_argument("-f", "--file", help="the binary file to be loaded, or an assembly source (.asm) to assemble and run", required=True)
     parser.add_argument("-d", "--debug", action="store_true", help="sets the emulator into debug mode, enabling special info")
-    parser.add_argument("-D", "--dump", action="store_true", help="dumps memory contents a file after running the emulator")
-    parser.add_argument("-m", "--memory", help="how many bytes of memory the CPU is allocated, default is 256K", default=2**16)
+    parser.add_argument("-D", "--dump", action="store_true", help="dumps memory contents to `dump.spk` as a binary image after running the emulator, overwriting it")
+    parser.add_argument("-m", "--memory", help="how many bytes of memory the CPU is allocated, default is 256K", default=2**16, type=int)
+    parser.add_argument("-H", "--headless", action="store_true", help="run without a window, drawing only to the framebuffer")
+    parser.add_argument("-s", "--screenshot", help="save the screen to a PNG (or .ppm) file after running the emulator")
+    parser.add_argument("-b", "--budget", type=int, help="stop the program after this many instructions")
+    parser.add_argument("-c", "--clock", type=float, help="throttle the CPU to this many MHz, default is as fast as possible")
+    parser.add_argument("-p", "--profile", help="profile the program and write the report to `PROFILE.txt` and folded stacks to `PROFILE.folded`")
+    parser.add_argument("-o", "--output", help="with --headless, also write the program's text output to this file, `-` for stdout")
+    parser.add_argument("--disk", help="the virtual filesystem's disk image, created if it doesn't exist, default is `%s` the first time the program uses a file" % DISK_PATH)
+    parser.add_argument("--map", help="the source map naming addresses in errors and the profile, default is the one the assembler wrote next to the file")
+    parser.add_argument("-n", "--cores", type=int, help="run the program on this many cores sharing memory, default is 1", default=1)
+    parser.add_argument("--slice", type=int, help="with --cores, instructions each core runs before the next one's turn, default is %d" % TIME_SLICE, default=TIME_SLICE)
+    parser.add_argument("--processes", action="store_true", help="with --cores, run each core in its own process instead of taking turns in this one")
     args = parser.parse_args()
 
+    if args.cores < 1:
+        parser.error("--cores must be at least 1")
+    if args.cores > 1 and args.profile:
+        parser.error("--profile only runs on one core")
+
+    output = None
+    if args.headless and args.output:
+        output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+
+    if args.headless:
+        screen = Headless(output)
+    else:
+        from screen import App # Only needs Tk when there is a window
+        screen = App()
+
     memory = Memory(args.memory)
-    cpu = CPU(screen)
+    filesystem = FileSystem(path=DISK_PATH)
+    machine = Machine(args.cores, screen, filesystem, args.slice) if args.cores > 1 else None
+    cpu = machine.cores[0] if machine is not None else CPU(screen, filesystem)
+    cores = machine.cores if machine is not None else [cpu]
+
+    for core in cores:
+        if args.debug == True:
+            core.debug = True
 
-    if args.debug == True:
-        cpu.debug = True
+        core.clock.mhz = args.clock
+
+    assembled = None
+    source_map = None
+    if args.file.endswith(SOURCE_EXTENSION):
+        assembled, source_map, error = assemble_source(args.file)
+
+        if error:
+            print(f"ERR: Failed to assemble \"{args.file}\": {error}")
+            screen.callback()
+            exit(1)
 
     try:
-        with open(args.file, "r", encoding="utf-16") as f:
-            data = list(f.read())
-            for i, char in enumerate(data):
-                memory.data[i] = ord(char)
+        if assembled is not None:
+            entry, sections = place(assembled, memory)
+        else:
+            entry, sections = load(args.file, memory)
     except OSError:
         print(f"ERR: No file named \"{args.file}\"")
         screen.callback()
@@ -47,32 +115,84 @@ def main():
         print(f"ERR: Memory size too small! Cannot load file \"{args.file}\"")
         screen.callback()
         exit(1)
-    except UnicodeDecodeError:
+    except (UnicodeDecodeError, ValueError):
         print(f"ERR: Failed to read file \"{args.file}\", it may be corrupted")
         screen.callback()
         exit(1)
 
-    init()
+    if args.map:
+        try:
+            source_map = load_map(args.map)
+        except (OSError, ValueError):
+            print(f"ERR: Failed to read source map \"{args.map}\"")
+            screen.callback()
+            exit(1)
+    elif assembled is None:
+        source_map = find(args.file)
+
+    if args.disk is not None:
+        try:
+            filesystem.mount(args.disk)
+        except (OSError, ValueError) as e:
+            print(f"ERR: Failed to mount disk image \"{args.disk}\": {e}")
+            screen.callback()
+            exit(1)
 
-    if args.debug:
-        print("Loaded virtual filesystem")
+        if args.debug:
+            print("Loaded virtual filesystem")
+
+    if machine is not None:
+        machine.load(memory, entry)
+    else:
+        cpu.LoadMemory(memory)
+        cpu.PC = entry
 
-    cpu.LoadMemory(memory)
+    for core in cores:
+        core.source_map = source_map
     if args.debug:
+        print("Loaded %d section(s)" % len(sections))
         print("Loaded memory")
         print("Executing...")
-    cpu.Execute()
+    profiler = Profiler() if args.profile else None
+
+    if machine is not None:
+        reasons = machine.run_processes(args.budget) if args.processes else machine.run(args.budget)
+
+        if args.debug:
+            for number, reason in enumerate(reasons):
+                print("Core %d stopped (%s) after %d instructions, %d cycles" % (number, reason, machine.instructions_retired[number], machine.cycles[number]))
+    else:
+        reason = cpu.Execute(args.budget, profiler)
+
+        if args.debug:
+            print("Stopped (%s) after %d instructions, %d cycles at %.2f MHz" % (reason, cpu.instructions_retired, cpu.cycles, cpu.clock.effective_mhz))
 
     #* This is some code used to dump the memory into a file for easier running and turning code into an executable *#
     if args.dump:
-        f = open("dump.mem", "a", encoding="utf-16")
-        for dat in memory.data:
-            f.write(chr(dat))
-        f.close()
+        save("dump.spk", [(SECTION_TEXT, 0, memory.data)])
 
         if args.debug:
             print("Dumped memory")
 
+    for core in cores:
+        core.files.close_all()
+    filesystem.unmount()
+
+    if output is not None:
+        output.flush()
+
+    if profiler is not None:
+        profiler.save(args.profile, cpu.memory, source_map)
+
+        if args.debug:
+            print("Saved profile")
+
+    if args.screenshot:
+        save_image(screen.framebuffer, args.screenshot)
+
+        if args.debug:
+            print("Saved screenshot")
+
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,124 @@
+"""The memory module for the SPK-8 emulator. Memory is a flat array of unsigned 32-bit cells,
+wide enough to hold the register codes and section headers from `ins_codes`.
+
+Memory is split into pages for snapshots. A snapshot is a tuple of immutable pages, and pages
+that haven't been written since the last snapshot are shared with it instead of copied, so
+taking or restoring one only costs the pages written in between. Anything that writes to
+`data` directly, rather than through `load` or the CPU, has to `touch` what it wrote.
+
+Memory can also live in a buffer it doesn't own, like a `multiprocessing.shared_memory`
+block, so CPUs in different processes can share it. `data` is then a memoryview of the
+buffer's cells, in the host's byte order, instead of an array.
+"""
+import sys
+
+from array import array
+
+
+CELL_TYPE = "I"
+
+if array(CELL_TYPE).itemsize != 4:
+    CELL_TYPE = "L" # Some platforms have a 16-bit unsigned int
+
+assert array(CELL_TYPE).itemsize == 4, "No 32-bit unsigned array type on this platform"
+
+PAGE_BITS = 8
+PAGE_BYTES = 4 << PAGE_BITS
+
+
 class Memory:
-    def __init__(self, size=2**16):
-        self.data = []
+    def __init__(self, size=2**16, buffer=None):
+        if buffer is None:
+            self.data = array(CELL_TYPE, bytes(4 * int(size)))
+        else:
+            self.data = memoryview(buffer).cast("B")[:4 * int(size)].cast(CELL_TYPE)
+
+        self.base = None # The snapshot memory was last taken or restored from
+        self.dirty = set() # Pages written since then
+
+    def __len__(self):
+        return len(self.data)
+
+    def load(self, data, offset: int = 0) -> int:
+        """Copy `data` into memory starting at `offset` and return the number of cells written.
+
+        `data` is either packed little-endian 32-bit cells (`bytes`, `bytearray`, `memoryview`)
+        or any iterable of ints. Raises `IndexError` if it does not fit.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            cells = array(CELL_TYPE)
+            cells.frombytes(data)
+
+            if sys.byteorder == "big":
+                cells.byteswap()
+        else:
+            cells = array(CELL_TYPE, data)
+
+        end = offset + len(cells)
+        if offset < 0 or end > len(self.data):
+            raise IndexError("cannot load %d cells at address %s" % (len(cells), hex(offset)))
+
+        self.data[offset:end] = cells
+        self.touch(offset, end)
+
+        return len(cells)
+
+    def dump(self, offset: int = 0, length: int = None) -> bytes:
+        """Return memory as packed little-endian 32-bit cells.
+        """
+        if length is None:
+            length = len(self.data) - offset
+
+        cells = self.data[offset:offset + length]
+        if sys.byteorder == "big":
+            cells = array(CELL_TYPE, cells)
+            cells.byteswap()
+
+        return cells.tobytes()
+
+    def view(self, offset: int, length: int) -> memoryview:
+        """Return a zero-copy view of `length` cells starting at `offset`.
+        """
+        return memoryview(self.data)[offset:offset + length]
+
+    def touch(self, start: int, end: int):
+        """Mark the cells in [start, end) as written since the last snapshot.
+        """
+        if end > start:
+            self.dirty.update(range(start >> PAGE_BITS, ((end - 1) >> PAGE_BITS) + 1))
+
+    def snapshot(self) -> tuple:
+        """Return the contents of memory as a tuple of immutable pages.
+        """
+        cells = memoryview(self.data).cast("B")
+
+        if self.base is None:
+            pages = [cells[start:start + PAGE_BYTES].tobytes() for start in range(0, len(cells), PAGE_BYTES)]
+        else:
+            pages = list(self.base)
+            for page in self.dirty:
+                pages[page] = cells[page * PAGE_BYTES:(page + 1) * PAGE_BYTES].tobytes()
+
+        self.base = tuple(pages)
+        self.dirty = set()
+
+        return self.base
+
+    def restore(self, pages: tuple) -> set:
+        """Put memory back to the snapshot `pages` and return the pages that were copied.
+        """
+        if self.base is None:
+            changed = set(range(len(pages)))
+        elif pages is self.base:
+            changed = self.dirty
+        else:
+            changed = self.dirty | {page for page, data in enumerate(pages) if data is not self.base[page]}
+
+        cells = memoryview(self.data).cast("B")
+        for page in changed:
+            cells[page * PAGE_BYTES:page * PAGE_BYTES + len(pages[page])] = pages[page]
+
+        self.base = pages
+        self.dirty = set()
 
-        for i in range(size):
-            self.data.append(0x0)
\ No newline at end of file
+        return changed
@@ -0,0 +1,70 @@
+"""The palette module for the SPK-8 emulator. Maps the 16 colour codes the CPU draws with
+to RGB values that are resolved once, not on every pixel.
+"""
+import sys
+
+
+PALETTE_SIZE = 16
+
+# The default colours, in colour code order
+DEFAULT_NAMES = [
+    "black", "blue3", "green3", "cyan3", "red3", "magenta3", "brown3", "gray",
+    "gray3", "blue", "green", "cyan", "red", "magenta", "yellow", "white"
+]
+
+# What Tk resolves the default names to, used when there is no Tk to ask
+DEFAULT_COLOURS = [
+    (0, 0, 0), (0, 0, 205), (0, 205, 0), (0, 205, 205),
+    (205, 0, 0), (205, 0, 205), (205, 51, 51), (190, 190, 190),
+    (8, 8, 8), (0, 0, 255), (0, 255, 0), (0, 255, 255),
+    (255, 0, 0), (255, 0, 255), (255, 255, 0), (255, 255, 255)
+]
+
+BLACK = 0x0
+WHITE = 0xF
+
+_LOW_BYTE = 0 if sys.byteorder == "little" else 3
+_MASK = bytes(code % PALETTE_SIZE for code in range(256))
+
+
+def unpack(cell: int) -> tuple:
+    """Split a 0xRRGGBB memory cell into an RGB tuple.
+    """
+    return (cell >> 16 & 0xFF, cell >> 8 & 0xFF, cell & 0xFF)
+
+def codes(cells: memoryview) -> bytes:
+    """Pack a view of memory cells into one palette code per byte, keeping the low bits
+    of each cell the same way the pixel syscall would.
+    """
+    return bytes(cells.cast("B")[_LOW_BYTE::4]).translate(_MASK)
+
+
+class Palette:
+    __slots__ = ("colours", "hex", "channels")
+
+    def __init__(self, colours: list = None):
+        self.colours = list(colours or DEFAULT_COLOURS) # (r, g, b) per colour code
+        self.__update()
+
+    def __update(self):
+        # "#rrggbb" strings for Tk, and byte translation tables from colour code to each channel
+        self.hex = ["#%02x%02x%02x" % colour for colour in self.colours]
+        self.channels = [
+            bytes(self.colours[code % PALETTE_SIZE][channel] for code in range(256))
+            for channel in range(3)
+        ]
+
+    def resolve(self, root):
+        """Resolve the default colour names through Tk once, so the palette matches
+        what Tk would have drawn for each name.
+        """
+        self.colours = [tuple(value >> 8 for value in root.winfo_rgb(name)) for name in DEFAULT_NAMES]
+        self.__update()
+
+    def set(self, start: int, colours: list):
+        """Replace the colours from code `start` on. Codes past the end of the palette are ignored.
+        """
+        for code, colour in enumerate(colours, start):
+            if 0 <= code < PALETTE_SIZE:
+                self.colours[code] = colour
+        self.__update()
@@ -0,0 +1,167 @@
+"""The profiler module for the SPK-8 emulator. Counts what a guest program spends its time on:
+executions per opcode and per PC, and calls and host time per syscall.
+
+Pass a `Profiler` to `CPU.Execute` as its observer to run the program on a separate loop.
+Every instruction is interpreted there so each one is counted at its own PC, while the normal
+loop stays free of profiling checks.
+
+Given the program's source map, the report names each hot PC's label and source line, and
+the folded stacks group PCs under the label they belong to.
+"""
+import time
+
+from collections import Counter
+
+from ins_codes import *
+from srcmap import describe
+from fs import FD_BASE
+
+
+# Opcode -> mnemonic, for the report
+OPCODE_NAMES = {
+    NOP: "nop", INT: "int", HLT: "hlt", MOV: "mov", JNE: "jne", JE: "je", JNZ: "jnz", JZ: "jz",
+    ADD: "add", SUB: "sub", MUL: "mul", DIV: "div", JMP: "jmp", INB: "inb", OUTB: "outb", AND: "and",
+    OR: "or", CMP: "cmp", NOR: "nor", INC: "inc", DEC: "dec", ULD: "uld", BRK: "brk",
+    JNEW: "jnew", JEW: "jew", JNZW: "jnzw", JZW: "jzw", JMPW: "jmpw",
+    HEADER_DATA: "[data]", HEADER_ROM: "[rom]", HEADER_TEXT: "[text]"
+}
+
+# (EAX, EBX) -> syscall name, for the report
+SYSCALL_NAMES = {
+    (0x00, None): "restart",
+    (0x03, None): "read",
+    (0x05, None): "open",
+    (0x06, None): "close",
+    (0x08, None): "create",
+    (0x13, None): "seek",
+    (0x14, None): "core",
+    (0x04, 1): "write:text",
+    (0x04, 2): "write:clear",
+    (0x04, 3): "write:pixel",
+    (0x04, 4): "write:colour",
+    (0x04, 5): "write:palette",
+    (0x04, 6): "write:blit",
+    (0x04, 7): "write:fill",
+    (0x04, 8): "write:hspan",
+}
+
+REPORT_LINES = 20 # Rows per table in the report
+
+
+def opcode_name(ins: int) -> str:
+    return OPCODE_NAMES.get(ins, "invalid(%s)" % hex(ins))
+
+def syscall_name(eax: int, ebx: int) -> str:
+    if eax == 0x04 and ebx >= FD_BASE:
+        return "write:file"
+    return SYSCALL_NAMES.get((eax, ebx)) or SYSCALL_NAMES.get((eax, None)) or "syscall(%s, %s)" % (hex(eax), hex(ebx))
+
+
+class Profiler:
+    def __init__(self):
+        self.cpu = None
+        self.opcodes = Counter() # Opcode -> executions
+        self.pcs = [] # Executions per address
+        self.syscalls = Counter() # (PC, name) -> calls
+        self.syscall_time = Counter() # Name -> host seconds
+
+        self.instructions = 0
+        self.elapsed = 0.0
+
+    def start(self, cpu):
+        """Reset the counters for a run of `cpu`.
+        """
+        self.__init__()
+        self.cpu = cpu
+        self.pcs = [0] * len(cpu.memory)
+        self.__started = time.perf_counter()
+
+    def step(self, pc: int, ins: int, step) -> bool:
+        self.opcodes[ins] += 1
+        self.pcs[pc] += 1
+
+        cpu = self.cpu
+        if ins != INT or pc + 1 >= len(cpu.memory) or cpu.memory[pc + 1] != cpu.Syscall:
+            return step()
+
+        name = syscall_name(cpu.EAX, cpu.EBX)
+        called = time.perf_counter()
+        halted = step()
+
+        self.syscalls[(pc, name)] += 1
+        self.syscall_time[name] += time.perf_counter() - called
+
+        return halted
+
+    def stop(self, retired: int):
+        self.instructions = retired
+        self.elapsed = time.perf_counter() - self.__started
+
+    def hotspots(self) -> list:
+        """Return `(pc, executions)` for every executed address, most executed first.
+        """
+        return sorted(((pc, count) for pc, count in enumerate(self.pcs) if count), key=lambda item: -item[1])
+
+    def report(self, memory, source_map=None) -> str:
+        """Format the counters as a plain text report. `memory` names the opcode at each PC,
+        and `source_map` its label and line.
+        """
+        total = self.instructions or 1
+        lines = [
+            "%d instructions in %.3fs (%.0f ins/s)" % (self.instructions, self.elapsed, self.instructions / self.elapsed if self.elapsed else 0),
+            "",
+            "%-12s %12s %7s" % ("opcode", "executions", "%"),
+        ]
+
+        for ins, count in self.opcodes.most_common():
+            lines.append("%-12s %12d %6.2f%%" % (opcode_name(ins), count, 100 * count / total))
+
+        lines += ["", "%-8s %-12s %12s %7s" % ("pc", "opcode", "executions", "%")]
+        for pc, count in self.hotspots()[:REPORT_LINES]:
+            lines.append(("%-8s %-12s %12d %6.2f%%  %s" % (hex(pc), opcode_name(memory[pc]), count, 100 * count / total, source_map.label(pc) if source_map else "")).rstrip())
+
+        calls = Counter()
+        for (_, name), count in self.syscalls.items():
+            calls[name] += count
+
+        lines += ["", "%-16s %10s %12s %12s" % ("syscall", "calls", "total ms", "avg us")]
+        for name, count in calls.most_common():
+            seconds = self.syscall_time[name]
+            lines.append("%-16s %10d %12.3f %12.3f" % (name, count, seconds * 1e3, seconds / count * 1e6))
+
+        return "\n".join(lines) + "\n"
+
+    def folded(self, memory, root: str = "spk8", source_map=None) -> str:
+        """Format executions as folded stacks (`root;pc opcode;syscall count` per line), the
+        input format of flamegraph.pl and speedscope. With a `source_map`, each PC is named by
+        its line and sits under a frame for its label.
+        """
+        syscalls = {}
+        for (pc, name), count in self.syscalls.items():
+            syscalls.setdefault(pc, []).append((name, count))
+
+        lines = []
+        for pc, count in enumerate(self.pcs):
+            if not count:
+                continue
+
+            name = "%s %s" % (describe(source_map, pc), opcode_name(memory[pc]))
+            symbol = source_map.symbol(pc) if source_map is not None and source_map.line(pc) else None
+            frame = "%s;%s;%s" % (root, symbol[0], name) if symbol else "%s;%s" % (root, name)
+            for name, calls in syscalls.get(pc, ()):
+                lines.append("%s;%s %d" % (frame, name, calls))
+                count -= calls
+
+            if count > 0:
+                lines.append("%s %d" % (frame, count))
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, prefix: str, memory, source_map=None):
+        """Write the report to `<prefix>.txt` and the folded stacks to `<prefix>.folded`.
+        """
+        with open(prefix + ".txt", "w") as f:
+            f.write(self.report(memory, source_map))
+
+        with open(prefix + ".folded", "w") as f:
+            f.write(self.folded(memory, source_map=source_map))
@@ -1,23 +1,33 @@
 import tkinter as tk
 import threading
 import pyglet
+
+from collections import deque
 pyglet.font.add_file('fonts/VGA.ttf')
 
+from framebuffer import FrameBuffer, FONT_SIZE, CELL_SIZE, WIDTH, HEIGHT
+from palette import BLACK, WHITE
 
-text_x = 0
-text_y = 0
-font_size = 20
 
-rows = 80
-columns = 40
-text_colour = "white"
+FRAME_RATE = 60 # Frames presented per second
+MAX_COMMANDS = 2**16 # Queued draw commands before the CPU waits for the next frame
+SNAPSHOT_TIMEOUT = 5.0 # Seconds to wait for the Tk thread before snapshotting without it
 
 
 class App(threading.Thread):
+    """The emulator window. The CPU thread only queues draw commands, the Tk thread drains
+    them into its framebuffer and presents it at `FRAME_RATE`. A CPU that gets `MAX_COMMANDS`
+    ahead waits for a frame to drain them. Once the window is gone the oldest are dropped.
+    """
 
     def __init__(self):
         threading.Thread.__init__(self)
+        self.framebuffer = FrameBuffer() # Only touched by the Tk thread
+        self.commands = deque(maxlen=MAX_COMMANDS) # Draw commands from the CPU, appends and pops are thread safe
+        self.drained = threading.Event() # Set after every drain
+        self.ready = threading.Event()
         self.start()
+        self.ready.wait() # Don't let the CPU draw before the canvas exists
 
     def callback(self):
         self.root.quit()
@@ -30,45 +40,161 @@ class App(threading.Thread):
         self.root.title("SP-8 Emulator")
         self.root.resizable(False, False)
 
-        self.canvas = tk.Canvas(self.root, border="0",background=self.root["bg"], width=640, height=480, highlightthickness=0)
-        self.canvas.pack(fill=tk.BOTH, expand=tk.YES)
-
-        self.root.mainloop()
-
-
-def writes(window: App, text: str):
-    global text_x, text_y
+        # Resolve the colour names once, every draw after this uses the palette's RGB values
+        self.framebuffer.palette.resolve(self.root)
 
-    # Loop over every character
-    for char in text:
-        window.canvas.create_text(text_x * (font_size * 0.75), text_y * (font_size * 0.75), text=char, fill=text_colour, font=('8 x 8 Font',font_size // 2), anchor="nw")
-
-        text_x += 1
-
-        if char == "\n":
-            scroll_up()
-
-        if text_x > rows:
-            scroll_up()
-
-def scroll_up(lines: int = 1):
-    global text_x, text_y
-    text_y += lines
-    text_x = 0
+        self.canvas = tk.Canvas(self.root, border="0",background=self.root["bg"], width=WIDTH, height=HEIGHT, highlightthickness=0)
+        self.canvas.pack(fill=tk.BOTH, expand=tk.YES)
 
-def reset_scroll():
-    global text_x, text_y
-    text_y = 0
-    text_x = 0
+        # The pixel layer is a single image, text cells are drawn over it
+        self.image = tk.PhotoImage(width=WIDTH, height=HEIGHT)
+        self.canvas.create_image(0, 0, image=self.image, anchor="nw")
+        self.cells = {} # (row, column) -> canvas text item
 
-def clear(window: App, colour: str = "black"):
-    window.canvas.delete("all")
-    window.canvas.configure(background=colour)
-    window.root.configure(background=colour)
+        self.ready.set()
+        self.root.after(1000 // FRAME_RATE, self.frame)
+        self.root.mainloop()
 
-def draw_pix(window: App, pos: tuple, colour: str = "white"):
-    window.canvas.create_rectangle(pos[0], pos[1], pos[0]+1, pos[1]+1, fill=colour, outline="")
+    def frame(self):
+        self.drain()
+        self.present()
+        self.root.after(1000 // FRAME_RATE, self.frame)
+
+    def drain(self):
+        """Apply every queued draw command to the framebuffer. Pixel writes are merged so
+        only the last colour written to each coordinate this frame is drawn, and flushed
+        before any fill or blit that could cover them.
+        """
+        framebuffer = self.framebuffer
+        commands = self.commands
+        pixels = {}
+
+        for _ in range(len(commands)):
+            command = commands.popleft()
+            kind = command[0]
+
+            if kind == "pixel":
+                pixels[command[1]] = command[2]
+            elif kind == "fill" or kind == "blit":
+                for (x, y), colour in pixels.items():
+                    framebuffer.draw_pixel(x, y, colour)
+                pixels.clear()
+
+                if kind == "fill":
+                    framebuffer.fill_rect(*command[1], *command[2], command[3])
+                else:
+                    framebuffer.blit(*command[1], command[2], command[3])
+            elif kind == "text":
+                framebuffer.write_text(command[1])
+            elif kind == "clear":
+                pixels.clear() # Anything drawn before the clear is gone anyway
+                framebuffer.clear(command[1])
+                self.root.configure(background=framebuffer.palette.hex[command[1]])
+            elif kind == "colour":
+                framebuffer.text_colour = command[1]
+            elif kind == "home":
+                framebuffer.reset_scroll()
+            elif kind == "palette":
+                framebuffer.set_palette(command[1], command[2])
+            elif kind == "snapshot":
+                for (x, y), colour in pixels.items():
+                    framebuffer.draw_pixel(x, y, colour)
+                pixels.clear()
+
+                command[1].append(framebuffer.snapshot())
+                command[2].set()
+            elif kind == "restore":
+                pixels.clear()
+                framebuffer.restore(command[1])
+                self.root.configure(background=framebuffer.palette.hex[framebuffer.background])
+
+        for (x, y), colour in pixels.items():
+            framebuffer.draw_pixel(x, y, colour)
+
+        self.drained.set()
+
+    def present(self):
+        """Push everything drawn since the last frame to Tk: one image update for the dirty
+        pixel rect, and one reused canvas item per changed text cell.
+        """
+        framebuffer = self.framebuffer
+        rect, cells, cleared = framebuffer.take_dirty()
+
+        if rect is not None:
+            x0, y0, x1, y1 = rect
+            self.image.put(b"P6 %d %d 255\n" % (x1 - x0, y1 - y0) + framebuffer.rgb(x0, y0, x1, y1), to=(x0, y0))
+
+        if cleared:
+            self.canvas.delete("text")
+            self.cells.clear()
+
+        for row, column in cells:
+            cell = framebuffer.text[row][column]
+            if cell is None:
+                item = self.cells.pop((row, column), None)
+                if item is not None: # Scrolled away
+                    self.canvas.delete(item)
+                continue
+
+            char, colour = cell
+            item = self.cells.get((row, column))
+
+            if item is None:
+                self.cells[(row, column)] = self.canvas.create_text(column * CELL_SIZE, row * CELL_SIZE, text=char, fill=framebuffer.palette.hex[colour], font=('8 x 8 Font',FONT_SIZE // 2), anchor="nw", tags="text")
+            else:
+                self.canvas.itemconfigure(item, text=char, fill=framebuffer.palette.hex[colour])
+
+    # Queue a draw command, first waiting for a frame if the queue is full and the Tk thread
+    # is still there to drain it
+    def __queue(self, command: tuple):
+        commands = self.commands
+
+        while len(commands) >= MAX_COMMANDS and self.is_alive():
+            self.drained.clear()
+            self.drained.wait(1 / FRAME_RATE)
+
+        commands.append(command)
+
+    def writes(self, text: str):
+        self.__queue(("text", text))
+
+    def clear(self, colour: int = BLACK):
+        self.__queue(("clear", colour))
+
+    def draw_pix(self, pos: tuple, colour: int = WHITE):
+        self.__queue(("pixel", (pos[0], pos[1]), colour))
+
+    def fill_rect(self, pos: tuple, size: tuple, colour: int = WHITE):
+        self.__queue(("fill", (pos[0], pos[1]), (size[0], size[1]), colour))
+
+    def blit(self, pos: tuple, width: int, codes: bytes):
+        self.__queue(("blit", (pos[0], pos[1]), width, codes))
+
+    def set_colour(self, colour: int = WHITE):
+        self.__queue(("colour", colour))
+
+    def set_palette(self, start: int, colours: list):
+        self.__queue(("palette", start, list(colours)))
+
+    def reset_scroll(self):
+        self.__queue(("home",))
+
+    def snapshot(self) -> tuple:
+        """Wait for the Tk thread to reach everything queued so far and return the screen. If
+        the window was closed, or doesn't answer within `SNAPSHOT_TIMEOUT`, return the
+        framebuffer as the Tk thread last left it.
+        """
+        state = []
+        done = threading.Event()
+
+        if self.is_alive():
+            self.__queue(("snapshot", state, done))
+            done.wait(SNAPSHOT_TIMEOUT)
+
+        if not state:
+            return self.framebuffer.snapshot()
+
+        return state[0]
 
-def set_colour(colour: str = "white"):
-    global text_colour
-    text_colour = colour
\ No newline at end of file
+    def restore(self, state: tuple):
+        self.__queue(("restore", state))
@@ -0,0 +1,197 @@
+"""The source map module for the SPK-8 emulator. Maps image addresses back to the assembly
+source they were assembled from, so errors, profiles and traces can name a label and a line
+instead of a bare address.
+
+The assembler writes a map next to every image, at the image's path plus `EXTENSION`. A source
+map (version 1) is laid out as:
+
+    header     magic b"SPKMAP", u16 version, u32 file, entry and symbol counts
+    files      u32 length in bytes, then the source paths joined by newlines, UTF-8
+    entries    u32 address of every entry, sorted, then the u32 line and u16 file of each
+    symbols    u32 address of every label, sorted, then a u32 length and the names joined by
+               newlines, UTF-8
+
+Each entry is where the cells of one source line start. An entry on line 0 marks cells that
+didn't come from any source, like the end of a file. Addresses are kept in their own arrays
+so a lookup is one binary search over them.
+"""
+import struct
+import sys
+
+from array import array
+from bisect import bisect_right
+
+try:
+    from image import save_with
+    from memory import CELL_TYPE
+except ImportError: # Imported as part of the `emu` package, e.g. by the assembler
+    from emu.image import save_with
+    from emu.memory import CELL_TYPE
+
+
+MAGIC = b"SPKMAP"
+VERSION = 1
+
+EXTENSION = ".map" # Added to the image's path
+
+HEADER = struct.Struct("<6sHIII")
+LENGTH = struct.Struct("<I")
+
+
+class SourceMap:
+    def __init__(self, files: list, addresses: array, lines: array, indices: array, symbol_addresses: array, symbols: list):
+        self.files = files # Source paths
+        self.addresses = addresses # Start of each entry, sorted
+        self.lines = lines # Line of each entry, 0 for none
+        self.indices = indices # File of each entry, into `files`
+        self.symbol_addresses = symbol_addresses # Address of each label, sorted
+        self.symbols = symbols # Name of each label
+
+    def line(self, pc: int):
+        """Return `(path, line)` of the source that `pc` was assembled from, or None.
+        """
+        i = bisect_right(self.addresses, pc) - 1
+        if i < 0 or not self.lines[i]:
+            return None
+
+        return self.files[self.indices[i]], self.lines[i]
+
+    def symbol(self, pc: int):
+        """Return `(label, offset)` of the nearest label at or before `pc`, or None.
+        """
+        i = bisect_right(self.symbol_addresses, pc) - 1
+        if i < 0:
+            return None
+
+        return self.symbols[i], pc - self.symbol_addresses[i]
+
+    def label(self, pc: int) -> str:
+        """Name `pc` as `label+offset, path:line`, or return an empty string if it didn't come
+        from the source.
+        """
+        source = self.line(pc)
+        if source is None:
+            return "" # Past the program, a label before it would only mislead
+
+        where = "%s:%d" % source
+        symbol = self.symbol(pc)
+        if symbol is None:
+            return where
+
+        name, offset = symbol
+        return "%s+%s, %s" % (name, hex(offset), where) if offset else "%s, %s" % (name, where)
+
+
+def describe(source_map, pc: int) -> str:
+    """Format `pc` for a message, with its label and line if `source_map` has them.
+    """
+    label = source_map.label(pc) if source_map is not None else ""
+    return "%s (%s)" % (hex(pc), label) if label else hex(pc)
+
+def build(entries: list, symbols: dict) -> SourceMap:
+    """Build a map from `(address, path, line)` entries and a dict of label -> address.
+    Entries at the same address keep their order, the last one wins.
+    """
+    files = []
+    numbers = {} # Path -> index in `files`
+    entries = sorted(entries, key=lambda entry: entry[0])
+
+    indices = array("H")
+    for _, path, _ in entries:
+        if path not in numbers:
+            numbers[path] = len(files)
+            files.append(path)
+        indices.append(numbers[path])
+
+    labels = sorted(symbols.items(), key=lambda item: item[1])
+
+    return SourceMap(
+        files,
+        array(CELL_TYPE, [address for address, _, _ in entries]),
+        array(CELL_TYPE, [line for _, _, line in entries]),
+        indices,
+        array(CELL_TYPE, [address for _, address in labels]),
+        [name for name, _ in labels]
+    )
+
+def _le(cells: array) -> bytes:
+    if sys.byteorder == "big":
+        cells = cells[:]
+        cells.byteswap()
+    return cells.tobytes()
+
+def _text(names: list) -> bytes:
+    text = "\n".join(names).encode("utf-8")
+    return LENGTH.pack(len(text)) + text
+
+def pack(source_map: SourceMap) -> bytes:
+    return b"".join([
+        HEADER.pack(MAGIC, VERSION, len(source_map.files), len(source_map.addresses), len(source_map.symbols)),
+        _text(source_map.files),
+        _le(source_map.addresses), _le(source_map.lines), _le(source_map.indices),
+        _le(source_map.symbol_addresses),
+        _text(source_map.symbols)
+    ])
+
+def unpack(data: bytes) -> SourceMap:
+    """Read a map back from `pack`'s bytes. Raises `ValueError` if they are malformed.
+    """
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a source map")
+
+    _, version, file_count, count, symbol_count = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("unsupported source map version %d" % version)
+
+    offset = HEADER.size
+
+    def take(typecode: str, length: int) -> array:
+        nonlocal offset
+        cells = array(typecode)
+        size = cells.itemsize * length
+        if offset + size > len(data):
+            raise ValueError("truncated source map")
+
+        cells.frombytes(data[offset:offset + size])
+        offset += size
+        if sys.byteorder == "big":
+            cells.byteswap()
+        return cells
+
+    def text(length: int) -> list:
+        nonlocal offset
+        size, = take(CELL_TYPE, 1)
+        names = data[offset:offset + size].decode("utf-8").split("\n") if length else []
+        offset += size
+        if len(names) != length:
+            raise ValueError("truncated source map")
+        return names
+
+    files = text(file_count)
+    addresses = take(CELL_TYPE, count)
+    lines = take(CELL_TYPE, count)
+    indices = take("H", count)
+    symbol_addresses = take(CELL_TYPE, symbol_count)
+    symbols = text(symbol_count)
+
+    return SourceMap(files, addresses, lines, indices, symbol_addresses, symbols)
+
+def save(path: str, source_map: SourceMap):
+    """Write `source_map` to `path`, through a temp file like `image.save`.
+    """
+    save_with(path, lambda f: f.write(pack(source_map)))
+
+def load(path: str) -> SourceMap:
+    """Read the map at `path`. Raises `OSError` if it can't be read and `ValueError` if it
+    is malformed.
+    """
+    with open(path, "rb") as f:
+        return unpack(f.read())
+
+def find(image_path: str):
+    """Return the map saved next to the image at `image_path`, or None if there isn't one.
+    """
+    try:
+        return load(image_path + EXTENSION)
+    except (OSError, ValueError):
+        return None # Missing or damaged, run without it
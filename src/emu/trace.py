@@ -0,0 +1,579 @@
+"""The trace module for the SPK-8 emulator. Records a run instruction by instruction so it can
+be replayed exactly, or re-entered at any instruction. Run from `src/emu` like `main.py`:
+
+    python trace.py record program.spk -o run.trace
+    python trace.py replay run.trace
+    python trace.py seek run.trace 100000 -m program.spk.map
+
+A trace file is `MAGIC` and a u16 version, then a zlib-compressed body of blobs, each
+prefixed with its u32 length:
+
+    meta      JSON: starting PC and registers, every syscall with its inputs, checkpoints...
+    memory    memory when recording started, as little-endian u32 cells
+    pcs       each instruction's PC minus the previous one's, i32
+    opcodes   the cell executed at each PC, u32
+    steps     for each row of registers, instructions since the last one, u32
+    rows      the registers after each of those instructions, i64
+    pages     the memory pages saved by each checkpoint, in checkpoint order
+    outputs   the memory pages each host syscall wrote, in syscall order
+
+There is a row after every interpreted instruction that left the registers different from
+the last row, and replays check the registers there. Predecoded blocks are recorded whole:
+their PCs and opcodes never change, so they are logged from a copy kept per block instead
+of instruction by instruction. What a block did to the registers shows up in the row after
+the next interpreted instruction, which every syscall and halt is.
+
+Rows that don't fit in i64s (floats from DIV, huge products) are kept in the meta as
+`[step, registers]` instead. Rows repeat most registers unchanged, which zlib squeezes out
+for far less than diffing them register by register would cost while recording.
+
+Host syscalls are the ones answered from outside the machine: the file syscalls, which go
+to whatever disk is mounted, and the core syscall. A replay doesn't run them. It plays back
+the registers and memory pages they left instead, so it doesn't need the same disk, or any
+disk at all. Version 1 traces have no `outputs` and re-run them.
+
+A checkpoint every `CHECKPOINT_INTERVAL` instructions saves the registers and the memory
+pages written since the previous one, so `seek` only has to run the instructions after the
+nearest checkpoint.
+"""
+
+import argparse
+import bisect
+import json
+import operator
+import struct
+import sys
+import zlib
+
+from array import array
+from itertools import chain
+
+from cpu import CPU
+from memory import Memory, CELL_TYPE, PAGE_BITS, PAGE_BYTES
+from image import load
+from srcmap import describe, find, load as load_map
+from framebuffer import Headless
+from ins_codes import INT, Code_EAX, Code_RS
+from fs import FileSystem, FD_BASE, DISK_PATH
+
+
+MAGIC = b"SPKTRACE"
+VERSION = 2
+
+HEADER = struct.Struct("<8sH")
+BLOB = struct.Struct("<I")
+
+CHECKPOINT_INTERVAL = 10000 # Instructions between checkpoints
+
+ROW = Code_RS - Code_EAX + 1 # Registers per row
+
+HOST_SYSCALLS = {CPU.Sys_Open, CPU.Sys_Create, CPU.Sys_Read, CPU.Sys_Close, CPU.Sys_Seek, CPU.Sys_Core}
+
+
+class TraceMismatch(Exception):
+    """A replay did something the trace didn't.
+    """
+
+
+def _le(cells: array) -> bytes:
+    if sys.byteorder == "big":
+        cells = cells[:]
+        cells.byteswap()
+    return cells.tobytes()
+
+def _le_cells(data: bytes) -> bytes:
+    # Native-order memory cells, e.g. snapshot pages, as little-endian
+    if sys.byteorder == "big":
+        cells = array(CELL_TYPE)
+        cells.frombytes(data)
+        return _le(cells)
+    return data
+
+def _native(typecode: str, data: bytes) -> array:
+    cells = array(typecode)
+    cells.frombytes(data)
+    if sys.byteorder == "big":
+        cells.byteswap()
+    return cells
+
+def _index(cpu: CPU) -> list:
+    return [cpu.EDI, cpu.ESI, cpu.ESP, cpu.EBP]
+
+def _state(cpu: CPU) -> dict:
+    return {"pc": cpu.PC, "regs": list(cpu.regs), "index": _index(cpu), "data_index": cpu.data_index}
+
+def _host(cpu: CPU) -> bool:
+    # Whether the syscall about to run is a host syscall, see above
+    return cpu.EAX in HOST_SYSCALLS or (cpu.EAX == cpu.Sys_Write and cpu.EBX >= FD_BASE)
+
+
+class Recorder:
+    """Records a run when passed to `CPU.Execute` as its observer, then `save` it.
+    """
+
+    def __init__(self, interval: int = CHECKPOINT_INTERVAL):
+        self.interval = interval
+
+    def start(self, cpu: CPU):
+        self.cpu = cpu
+        self.regs = cpu.regs
+        self.last = tuple(cpu.regs) # Registers after the previous instruction
+        self.last_pc = cpu.PC
+        self.last_write = 0 # Step of the previous register write in `rows`
+
+        self.initial = _state(cpu)
+        self.size = len(cpu.memory)
+        self.pages = cpu.ram.snapshot()
+        self.memory = b"".join(self.pages)
+
+        self.steps = 0
+        self.pcs = array("i")
+        self.opcodes = array("I")
+        self.write_steps = array("I")
+        self.rows = array("q")
+        self.odd = [] # [step, registers] rows that don't fit in `rows`
+
+        # Rows since the last checkpoint and the steps they were written at. Appending a
+        # tuple costs a fraction of converting the row into `rows` straight away
+        self.pending = []
+        self.pending_steps = array("I")
+
+        self.syscalls = []
+        self.outputs = [] # Pages written by host syscalls
+        self.checkpoints = []
+        self.checkpoint_pages = []
+        self.next_checkpoint = self.interval
+
+        self.blocks = {} # PC -> (block, its PC deltas after the first, its opcodes, its last PC)
+
+        # Bound once, `step` runs for every instruction and `block` for every block
+        self.__pc = self.pcs.append
+        self.__pcs = self.pcs.extend
+        self.__opcode = self.opcodes.append
+        self.__opcodes = self.opcodes.extend
+        self.__row = self.pending.append
+        self.__written = self.pending_steps.append
+
+    def step(self, pc: int, ins: int, step) -> bool:
+        self.__pc(pc - self.last_pc)
+        self.__opcode(ins)
+        self.last_pc = pc
+
+        if ins == INT:
+            halted = self.__syscall(pc, step)
+        else:
+            halted = step()
+
+        steps = self.steps = self.steps + 1
+
+        row = tuple(self.regs)
+        if row != self.last:
+            self.__row(row)
+            self.__written(steps)
+            self.last = row
+
+        if steps >= self.next_checkpoint:
+            self.__checkpoint()
+
+        return halted
+
+    def block(self, pc: int, block: tuple):
+        decoded = self.blocks.get(pc)
+        if decoded is None or decoded[0] is not block:
+            pcs = block[5]
+            memory = self.cpu.memory
+            decoded = self.blocks[pc] = (block, array("i", map(operator.sub, pcs[1:], pcs)), array("I", [memory[cell] for cell in pcs]), pcs[-1])
+
+        _, pcs, opcodes, last_pc = decoded
+        self.__pc(pc - self.last_pc)
+        self.__pcs(pcs)
+        self.__opcodes(opcodes)
+        self.last_pc = last_pc
+
+        self.steps += block[3]
+        if self.steps >= self.next_checkpoint:
+            self.__checkpoint()
+
+    def stop(self, retired: int):
+        self.__flush()
+        self.final = _state(self.cpu)
+
+    def __flush(self):
+        # Move the pending rows into `rows`, or `odd` for a float or a huge int
+        rows, steps = self.pending, self.pending_steps
+
+        try:
+            self.rows.fromlist(list(chain.from_iterable(rows)))
+        except (TypeError, OverflowError): # Left unchanged, go row by row
+            fits = array("I")
+            for step, row in zip(steps, rows):
+                try:
+                    self.rows.fromlist(list(row))
+                except (TypeError, OverflowError):
+                    self.odd.append([step, list(row)])
+                else:
+                    fits.append(step)
+            steps = fits
+
+        if steps:
+            self.write_steps.fromlist(list(map(operator.sub, steps, chain((self.last_write,), steps))))
+            self.last_write = steps[-1]
+
+        rows.clear()
+        del self.pending_steps[:]
+
+    def __syscall(self, pc: int, step) -> bool:
+        cpu = self.cpu
+        if pc + 1 >= len(cpu.memory) or cpu.memory[pc + 1] != cpu.Syscall:
+            return step()
+
+        # The memory the syscall reads, so a replay can show what was drawn or written
+        data = None
+        try:
+            if cpu.EAX == cpu.Sys_Write and cpu.EBX in (1, 5):
+                data = cpu.ram.view(cpu.VarLoc, cpu.EDX).tolist()
+            elif cpu.EAX == cpu.Sys_Write and cpu.EBX == 6:
+                data = cpu.ram.view(cpu.VarLoc + cpu.ECX, cpu.CX * cpu.DX).tolist()
+            elif cpu.EAX == cpu.Sys_Write and cpu.EBX >= FD_BASE:
+                data = cpu.ram.view(cpu.VarLoc + cpu.ECX, cpu.EDX).tolist()
+            elif cpu.EAX in (cpu.Sys_Open, cpu.Sys_Create):
+                data = cpu.ram.view(cpu.VarLoc + cpu.ECX, cpu.EDX).tolist()
+        except (TypeError, ValueError):
+            pass # Bad registers, the syscall itself will fail
+
+        syscall = {"step": self.steps, "pc": pc, "regs": list(cpu.regs), "data": data}
+        self.syscalls.append(syscall)
+
+        if not _host(cpu):
+            return step()
+
+        # Catch the pages it writes in a set of their own. The registers it leaves are
+        # recorded like any other instruction's
+        ram = cpu.ram
+        dirty, ram.dirty = ram.dirty, set()
+        try:
+            halted = step()
+        finally:
+            written, ram.dirty = ram.dirty, dirty
+            dirty |= written
+
+        syscall["pages"] = sorted(written)
+        self.outputs.extend(ram.dump(page << PAGE_BITS, 1 << PAGE_BITS) for page in syscall["pages"])
+
+        return halted
+
+    def __checkpoint(self):
+        self.__flush()
+        pages = self.cpu.ram.snapshot()
+        changed = [page for page, (new, old) in enumerate(zip(pages, self.pages)) if new is not old]
+
+        self.checkpoint_pages.extend(pages[page] for page in changed)
+        self.checkpoints.append(dict(_state(self.cpu), step=self.steps, pages=changed))
+        self.pages = pages
+        self.next_checkpoint = self.steps + self.interval
+
+    def save(self, path: str):
+        meta = {
+            "size": self.size,
+            "steps": self.steps,
+            "interval": self.interval,
+            "initial": self.initial,
+            "final": self.final,
+            "odd": self.odd,
+            "syscalls": self.syscalls,
+            "checkpoints": self.checkpoints,
+        }
+
+        blobs = [
+            json.dumps(meta).encode(),
+            _le_cells(self.memory),
+            _le(self.pcs),
+            _le(self.opcodes),
+            _le(self.write_steps),
+            _le(self.rows),
+            b"".join(map(_le_cells, self.checkpoint_pages)),
+            b"".join(self.outputs),
+        ]
+        body = b"".join(BLOB.pack(len(blob)) + blob for blob in blobs)
+
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION))
+            f.write(zlib.compress(body))
+
+
+class Trace:
+    """A trace file read back in.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a trace file")
+
+            _, version = HEADER.unpack(header)
+            if version > VERSION:
+                raise ValueError("unsupported trace version %d" % version)
+
+            body = zlib.decompress(f.read())
+
+        blobs = []
+        offset = 0
+        while offset < len(body):
+            (length,) = BLOB.unpack_from(body, offset)
+            blobs.append(body[offset + BLOB.size:offset + BLOB.size + length])
+            offset += BLOB.size + length
+
+        meta, self.memory, pcs, opcodes, steps, rows, pages, *outputs = blobs
+        meta = json.loads(meta)
+
+        self.size = meta["size"]
+        self.steps = meta["steps"]
+        self.initial = meta["initial"]
+        self.final = meta["final"]
+        self.syscalls = meta["syscalls"]
+        self.checkpoints = meta["checkpoints"]
+
+        self.pcs = _native("i", pcs)
+        self.opcodes = _native("I", opcodes)
+
+        # Step -> registers after it, for every step that changed them
+        self.writes = {}
+        rows = _native("q", rows)
+        step = 0
+        for i, gap in enumerate(_native("I", steps)):
+            step += gap
+            self.writes[step] = rows[i * ROW:(i + 1) * ROW].tolist()
+        for step, regs in meta["odd"]:
+            self.writes[step] = regs
+
+        # Checkpoint i's pages, in its `pages` order
+        self.pages = []
+        offset = 0
+        for checkpoint in self.checkpoints:
+            count = len(checkpoint["pages"])
+            self.pages.append([pages[offset + i * PAGE_BYTES:offset + (i + 1) * PAGE_BYTES] for i in range(count)])
+            offset += count * PAGE_BYTES
+
+        # Step -> [(page, data)...] written by the host syscall run at that step
+        self.outputs = {}
+        outputs = outputs[0] if outputs else b""
+        offset = 0
+        for syscall in self.syscalls:
+            if "pages" not in syscall:
+                continue
+
+            written = []
+            for page in syscall["pages"]:
+                length = min(PAGE_BYTES, 4 * (self.size - (page << PAGE_BITS)))
+                written.append((page, outputs[offset:offset + length]))
+                offset += length
+
+            self.outputs[syscall["step"]] = written
+
+    def machine(self, screen=None, checkpoint: int = None) -> CPU:
+        """Build a CPU in the state the recording started in, or at checkpoint number
+        `checkpoint`.
+        """
+        memory = Memory(self.size)
+        memory.load(self.memory)
+
+        cpu = CPU(screen if screen is not None else Headless())
+        cpu.LoadMemory(memory)
+        state = self.initial
+
+        if checkpoint is not None:
+            for number in range(checkpoint + 1):
+                for page, data in zip(self.checkpoints[number]["pages"], self.pages[number]):
+                    memory.load(data, page << PAGE_BITS)
+            state = self.checkpoints[checkpoint]
+
+        cpu.PC = state["pc"]
+        cpu.regs[:] = state["regs"]
+        cpu.EDI, cpu.ESI, cpu.ESP, cpu.EBP = state["index"]
+        cpu.data_index = state["data_index"]
+
+        return cpu
+
+
+class Verifier:
+    """Checks a replay against a trace when passed to `CPU.Execute` as its observer, and
+    plays back the host syscalls from it. `first` is the step the CPU starts at, for a CPU
+    built at a checkpoint.
+    """
+
+    def __init__(self, trace: Trace, source_map=None, first: int = 0):
+        self.trace = trace
+        self.source_map = source_map # Names the PCs in mismatches
+        self.first = first
+
+    def start(self, cpu: CPU):
+        trace = self.trace
+
+        self.cpu = cpu
+        self.steps = self.first
+        self.pc = cpu.PC - (trace.pcs[self.first] if self.first < trace.steps else 0) # The PC before it
+
+    def step(self, pc: int, ins: int, step) -> bool:
+        trace = self.trace
+        i = self.steps
+
+        if i >= trace.steps:
+            raise TraceMismatch("instruction %d: ran past the end of the trace" % i)
+
+        if pc != self.pc + trace.pcs[i] or ins != trace.opcodes[i]:
+            raise TraceMismatch("instruction %d: expected %s at %s, ran %s at %s" % (
+                i, hex(trace.opcodes[i]), describe(self.source_map, self.pc + trace.pcs[i]), hex(ins), describe(self.source_map, pc)
+            ))
+        self.pc = pc
+
+        if ins == INT and i in trace.outputs:
+            halted = self.__inject(pc, trace.outputs[i])
+        else:
+            halted = step()
+        self.steps += 1
+
+        expected = trace.writes.get(self.steps)
+        if expected is not None and self.cpu.regs != expected:
+            raise TraceMismatch("instruction %d at %s: expected registers %s, got %s" % (i, describe(self.source_map, pc), expected, self.cpu.regs))
+
+        return halted
+
+    def stop(self, retired: int):
+        pass
+
+    def __inject(self, pc: int, pages: list) -> bool:
+        # Do what the host syscall at `pc` did when it was recorded
+        cpu = self.cpu
+
+        for page, data in pages:
+            start = page << PAGE_BITS
+            cpu.ram.load(data, start)
+            cpu.blocks.invalidate(start, start + len(data) // 4)
+
+        cpu.regs[:] = self.trace.writes.get(self.steps + 1, cpu.regs)
+        cpu.PC = pc + 2
+        cpu.interrupt = cpu.Syscall
+        cpu.in_interrupt = True
+        cpu.PS.E = 0
+
+        return False
+
+
+def replay(trace: Trace, screen=None, source_map=None) -> CPU:
+    """Re-run `trace` from the start, raising `TraceMismatch` where it diverges. `source_map`
+    names the addresses in the error.
+    """
+    cpu = trace.machine(screen)
+    cpu.source_map = source_map
+    cpu.Execute(trace.steps, Verifier(trace, source_map))
+
+    if cpu.instructions_retired != trace.steps:
+        raise TraceMismatch("stopped after %d of %d instructions" % (cpu.instructions_retired, trace.steps))
+
+    if cpu.PC != trace.final["pc"]:
+        raise TraceMismatch("finished at %s, expected %s" % (describe(source_map, cpu.PC), describe(source_map, trace.final["pc"])))
+
+    return cpu
+
+def seek(trace: Trace, step: int, screen=None) -> CPU:
+    """Return a CPU stopped after instruction `step` of `trace`. Runs on from the nearest
+    checkpoint, so the screen only shows what was drawn after it, raising `TraceMismatch` if
+    it diverges.
+    """
+    if not 0 <= step <= trace.steps:
+        raise IndexError("the trace has %d instructions" % trace.steps)
+
+    number = bisect.bisect_right([checkpoint["step"] for checkpoint in trace.checkpoints], step) - 1
+    cpu = trace.machine(screen, number if number >= 0 else None)
+
+    first = trace.checkpoints[number]["step"] if number >= 0 else 0
+    if step > first:
+        cpu.Execute(step - first, Verifier(trace, first=first))
+
+    return cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="spk8-trace", description="Record, replay and seek SPK-8 execution traces.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="run an image and record a trace of it")
+    record.add_argument("file", help="the binary file to be loaded")
+    record.add_argument("-o", "--output", help="the trace file, default is `run.trace`", default="run.trace")
+    record.add_argument("-b", "--budget", type=int, help="stop the program after this many instructions")
+    record.add_argument("-i", "--interval", type=int, help="instructions between checkpoints", default=CHECKPOINT_INTERVAL)
+    record.add_argument("--disk", help="the disk image the program's files are on, default is `%s` the first time it uses one" % DISK_PATH)
+
+    play = commands.add_parser("replay", help="re-run a trace and check it does the same thing")
+    play.add_argument("trace", help="the trace file")
+    play.add_argument("-m", "--map", help="the program's source map, to name addresses by label and line")
+
+    go = commands.add_parser("seek", help="print the machine state after an instruction")
+    go.add_argument("trace", help="the trace file")
+    go.add_argument("step", type=int, help="how many instructions to run")
+    go.add_argument("-m", "--map", help="the program's source map, to name addresses by label and line")
+
+    args = parser.parse_args()
+
+    source_map = None
+    if getattr(args, "map", None):
+        try:
+            source_map = load_map(args.map)
+        except (OSError, ValueError) as e:
+            print("ERR: Can't read the source map: %s" % e)
+            exit(1)
+
+    if args.command == "record":
+        memory = Memory()
+        entry, _ = load(args.file, memory)
+
+        filesystem = FileSystem(path=DISK_PATH)
+        if args.disk is not None:
+            try:
+                filesystem.mount(args.disk)
+            except (OSError, ValueError) as e:
+                print("ERR: Can't mount the disk image: %s" % e)
+                exit(1)
+
+        cpu = CPU(Headless(), filesystem)
+        cpu.LoadMemory(memory)
+        cpu.PC = entry
+        cpu.source_map = find(args.file)
+
+        recorder = Recorder(args.interval)
+        try:
+            reason = cpu.Execute(args.budget, recorder)
+        finally:
+            cpu.files.close_all()
+            filesystem.unmount()
+        recorder.save(args.output)
+
+        print("Recorded %d instructions (%s) to \"%s\"" % (recorder.steps, reason, args.output))
+
+    elif args.command == "replay":
+        trace = Trace(args.trace)
+        try:
+            cpu = replay(trace, source_map=source_map)
+        except TraceMismatch as e:
+            print("ERR: Replay diverged: %s" % e)
+            exit(1)
+
+        print("Replayed %d instructions, final PC %s" % (trace.steps, describe(source_map, cpu.PC)))
+
+    else:
+        try:
+            cpu = seek(Trace(args.trace), args.step)
+        except IndexError as e:
+            print("ERR: Can't seek there: %s" % e)
+            exit(1)
+        except TraceMismatch as e:
+            print("ERR: Seek diverged: %s" % e)
+            exit(1)
+
+        print("PC %s" % describe(source_map, cpu.PC))
+        print(" ".join("%s=%s" % (name, getattr(cpu, name)) for name in ["EAX", "EBX", "ECX", "EDX", "AX", "BX", "CX", "DX", "BAX", "BBX", "BCX", "BDX", "RS"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Relocatable object files for the SPK-8 assembler. Every source file of a project is
+assembled on its own into an object, cached on disk by the hash of its source, and the
+objects are linked into one image.
+
+An object file (version 2) is laid out as:
+
+    header     magic b"SPKOBJ", u16 version, u32 length of the meta in bytes, u32 cell count
+    meta       JSON: sections, label offsets, relocations and included paths
+    cells      packed little-endian u32 cells
+    lines      packed little-endian u32 (offset, line) pairs, where each source line's cells
+               start, for the source map
+
+Relocations are `[offset, word, label, line, column]`. The linker writes the label's
+address at `offset`, as a (hi, lo) pair when `word` is set.
+"""
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+
+from array import array
+
+from emu import image
+from emu import ins_codes
+from emu import srcmap
+from emu.memory import CELL_TYPE
+
+
+MAGIC = b"SPKOBJ"
+VERSION = 2
+
+HEADER = struct.Struct("<6sHII")
+
+
+class ObjectFile:
+    def __init__(self, cells=None, sections=None, symbols=None, relocations=None, includes=None, lines=None):
+        self.cells = cells if cells is not None else array(CELL_TYPE)
+        self.sections = sections if sections is not None else [[image.SECTION_TEXT, 0]] # [kind, start] of every section
+        self.symbols = symbols if symbols is not None else {} # Label -> offset
+        self.relocations = relocations if relocations is not None else []
+        self.includes = includes if includes is not None else [] # Paths as written in the source
+        self.lines = lines if lines is not None else array(CELL_TYPE) # Flat (offset, line) pairs, line 0 for none
+
+        self.name = "<source>" # Where it came from, for link errors. Not saved
+        self.base = 0 # Where `link` placed it. Not saved
+
+    def starts_with_header(self) -> bool:
+        return len(self.sections) > 1 and self.sections[1][1] == 0
+
+
+def pack(obj: ObjectFile) -> bytes:
+    meta = json.dumps({
+        "sections": obj.sections,
+        "symbols": obj.symbols,
+        "relocations": obj.relocations,
+        "includes": obj.includes,
+    }).encode()
+
+    cells = obj.cells + obj.lines
+    if sys.byteorder == "big":
+        cells.byteswap()
+
+    return HEADER.pack(MAGIC, VERSION, len(meta), len(obj.cells)) + meta + cells.tobytes()
+
+def unpack(data: bytes) -> ObjectFile:
+    """Read an object back from `pack`'s bytes. Raises `ValueError` if they are malformed.
+    """
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not an object file")
+
+    _, version, length, count = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("unsupported object version %d" % version)
+
+    meta = json.loads(data[HEADER.size:HEADER.size + length])
+
+    cells = array(CELL_TYPE)
+    cells.frombytes(data[HEADER.size + length:])
+    if sys.byteorder == "big":
+        cells.byteswap()
+
+    if len(cells) < count or (len(cells) - count) % 2:
+        raise ValueError("truncated object")
+
+    return ObjectFile(cells[:count], meta["sections"], meta["symbols"], meta["relocations"], meta["includes"], cells[count:])
+
+def source_key(source: bytes, relocatable: bool) -> str:
+    """Return the cache key for a source file's bytes. The root file of a project is
+    assembled at address 0 and the rest relocatable, which gives different objects.
+    """
+    digest = hashlib.sha256(b"%d %d\n" % (VERSION, relocatable))
+    digest.update(source)
+    return digest.hexdigest()
+
+
+class ObjectCache:
+    """Assembled objects on disk, one file per source key.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".obj")
+
+    def get(self, key: str):
+        """Return the cached object for `key`, or None.
+        """
+        try:
+            with open(self.__path(key), "rb") as f:
+                return unpack(f.read())
+        except (OSError, ValueError):
+            return None # Missing or damaged, assemble it again
+
+    def put(self, key: str, obj: ObjectFile):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Through a temp file, so a build running alongside never reads half an object
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(pack(obj))
+            os.replace(temp, self.__path(key))
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+
+def link(objects: list) -> tuple:
+    """Link `objects` in order into one program placed at address 0. Returns
+    `(sections, error)`, with sections as the `(kind, address, cells)` tuples `image.save` takes.
+    """
+    cells = array(CELL_TYPE)
+    sections = []
+    symbols = {}
+    owners = {} # Label -> the object defining it
+    bases = []
+
+    for obj in objects:
+        # Objects start in a text section, so one following data or rom gets its own header
+        if sections and sections[-1][0] != image.SECTION_TEXT and not obj.starts_with_header():
+            sections.append([image.SECTION_TEXT, len(cells)])
+            cells.append(ins_codes.HEADER_TEXT)
+
+        base = len(cells)
+        bases.append(base)
+        obj.base = base
+
+        sections.extend([kind, base + start] for kind, start in obj.sections)
+        cells.extend(obj.cells)
+
+        for name, offset in obj.symbols.items():
+            if name in symbols:
+                return None, f"Label \"{name}\" is defined in both {owners[name].name} and {obj.name}"
+            symbols[name] = base + offset
+            owners[name] = obj
+
+    for obj, base in zip(objects, bases):
+        for offset, word, name, line, column in obj.relocations:
+            if name not in symbols:
+                return None, f"Undefined label \"{name}\" in {obj.name} at line {line}, column {column}"
+
+            value = symbols[name]
+            at = base + offset
+
+            if word:
+                if value > 0xFFFF:
+                    return None, f"Label \"{name}\" at {hex(value)} does not fit in a word in {obj.name} at line {line}, column {column}"
+                cells[at] = value >> 8
+                cells[at + 1] = value & 0xFF
+            else:
+                if value > 0xFF:
+                    return None, f"Label \"{name}\" at {hex(value)} does not fit in a byte in {obj.name} at line {line}, column {column}"
+                cells[at] = value
+
+    # Split the cells into the sections started by each header
+    ends = [start for _, start in sections[1:]] + [len(cells)]
+    return [
+        (kind, start, cells[start:end])
+        for (kind, start), end in zip(sections, ends) if end > start
+    ], None
+
+def source_map(objects: list) -> srcmap.SourceMap:
+    """Build the source map of `objects` once `link` has placed them.
+    """
+    entries = []
+    symbols = {}
+
+    for obj in objects:
+        lines = obj.lines
+        entries.extend((obj.base + lines[i], obj.name, lines[i + 1]) for i in range(0, len(lines), 2))
+        symbols.update((name, obj.base + offset) for name, offset in obj.symbols.items())
+
+    return srcmap.build(entries, symbols)